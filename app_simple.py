@@ -6,11 +6,35 @@ LibraryManager - 智慧图书馆管理系统
 """
 
 import sqlite3
+import atexit
 import hashlib
+import hmac
 import os
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, session, flash, g
+import re
+import unicodedata
+import json
+import base64
+import cProfile
+import csv
+import gzip
+import io
+import binascii
+import queue
+import random
+import shutil
+import smtplib
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta, timezone
+from email.message import EmailMessage
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, jsonify, has_request_context
 from functools import wraps
+from markupsafe import Markup
 
 # 创建Flask应用
 app = Flask(__name__)
@@ -19,24 +43,790 @@ app.secret_key = 'library_management_system_secret_key_2024'
 # 数据库配置
 DATABASE = 'library.db'
 
+# 分馆：每个分馆的图书、库存、借阅和预约保存在各自的数据库文件中，写入互不争用
+# 同一把数据库锁；读者账户和借阅规则全馆统一，保存在总馆DATABASE。
+# 格式 {代码: (名称, 数据库文件)}，为空时只有总馆。启动时从环境变量BRANCHES_ENV加载，
+# 取值为JSON对象 {"代码": ["名称", "数据库文件"]}，或保存该JSON的文件路径
+BRANCHES = {}
+BRANCHES_ENV = 'LIBRARY_BRANCHES'
+MAIN_BRANCH = 'main'
+MAIN_BRANCH_NAME = '总馆'
+BRANCH_SEARCH_WORKERS = 8    # 跨分馆搜索的并发线程数
+BRANCH_SEARCH_TIMEOUT = 5    # 跨分馆搜索等待各分馆结果的秒数，超时的分馆不计入结果
+
+# 连接池配置
+DB_POOL_SIZE = 10         # 每个进程最多打开的连接数
+DB_POOL_TIMEOUT = 10      # 连接池耗尽时等待空闲连接的秒数
+DB_BUSY_TIMEOUT = 5000    # 写锁被占用时的等待毫秒数
+DB_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',       # 读写互不阻塞
+    'PRAGMA synchronous = NORMAL',     # WAL模式下兼顾安全与写入性能
+    'PRAGMA cache_size = -20000',      # 约20MB页缓存
+    'PRAGMA mmap_size = 268435456',    # 256MB内存映射
+    'PRAGMA temp_store = MEMORY',
+    f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}',
+]
+
+# 与isbn字段上的表达式索引保持一致，用于按ISBN去重查找（忽略连字符、空格和大小写）
+ISBN_KEY_SQL = "REPLACE(REPLACE(UPPER(isbn), '-', ''), ' ', '')"
+
+# 借还书事务遇到锁冲突时的重试次数与初始退避秒数
+TXN_MAX_RETRIES = 5
+TXN_RETRY_DELAY = 0.01
+
+# 后台任务（逾期、搜索建议、预约、提醒、统计、审计、备份）和通知发送器在处理请求的进程收到
+# 第一个请求时启动，gunicorn等多进程部署下每个进程各自启动；环境变量LIBRARY_BACKGROUND_JOBS=0时不启动
+BACKGROUND_JOBS_ENABLED = os.environ.get('LIBRARY_BACKGROUND_JOBS', '1') != '0'
+
+# 逾期计算后台任务的执行间隔（秒）
+OVERDUE_REFRESH_INTERVAL = 300
+
+# 搜索建议：后台更新间隔（秒）、每批处理图书数、索引的前缀长度与默认返回数量
+SUGGEST_REFRESH_INTERVAL = 10
+SUGGEST_BATCH_SIZE = 1000
+SUGGEST_PREFIX_LENGTH = 3
+SUGGEST_LIMIT = 8
+
+# 借阅规则的兜底默认值（loan_policies表中没有任何规则时使用）：
+# 借期天数、每人最多同时在借数量、每逾期一天的罚金（元）
+LOAN_DAYS = 14
+LOAN_MAX_ACTIVE = 5
+FINE_PER_DAY = 0.5
+
+# 读者角色（借阅规则按角色和图书分类区分），以及其他进程修改规则后本进程重新加载的检查间隔（秒）
+USER_ROLES = {'reader': '读者', 'student': '学生', 'faculty': '教师', 'staff': '馆员'}
+DEFAULT_USER_ROLE = 'reader'
+POLICY_RELOAD_INTERVAL = 30
+
+# 借还书台：单次批量请求最多的条目数
+DESK_BATCH_MAX = 100
+
+# 预约：到书后保留天数、每人最多同时预约数量、过期检查间隔（秒）
+HOLD_PICKUP_DAYS = 3
+HOLD_MAX_PER_USER = 5
+HOLD_EXPIRY_INTERVAL = 300
+
+# 借阅统计：汇总任务间隔（秒）、每批处理的事件数、报表默认月数
+ROLLUP_REFRESH_INTERVAL = 60
+ROLLUP_BATCH_SIZE = 5000
+REPORT_DEFAULT_MONTHS = 12
+
+# 到期提醒：扫描间隔（秒）、到期前几天提醒、逾期后每隔几天再提醒一次
+NOTIFY_SCAN_INTERVAL = 600
+NOTIFY_DUE_SOON_DAYS = 2
+NOTIFY_OVERDUE_REPEAT_DAYS = 7
+
+# 通知发送：传输方式（file/smtp）、工作线程数、每秒最多发送数、每批领取数量、
+# 最多尝试次数、首次重试间隔（秒，之后翻倍）、领取租约（秒）、空闲时轮询间隔（秒）
+NOTIFY_TRANSPORT = 'file'
+NOTIFY_OUTBOX_DIR = 'outbox'
+NOTIFY_SMTP_HOST = 'localhost'
+NOTIFY_SMTP_PORT = 25
+NOTIFY_SMTP_SENDER = 'library@library.com'
+NOTIFY_WORKERS = 4
+NOTIFY_RATE_PER_SECOND = 20
+NOTIFY_BATCH_SIZE = 100
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_RETRY_DELAY = 60
+NOTIFY_LEASE_SECONDS = 300
+NOTIFY_POLL_INTERVAL = 5
+
+# 在线备份：快照目录、后台快照间隔（秒）、每个数据库保留的快照份数、
+# 每步复制的页数与步间停顿（秒，让出写锁）、因写入重启超过该次数后改为一次复制完
+BACKUP_DIR = 'backups'
+BACKUP_INTERVAL = 24 * 3600
+BACKUP_KEEP = 7
+BACKUP_PAGES_PER_STEP = 1024
+BACKUP_STEP_PAUSE = 0.005
+BACKUP_MAX_RESTARTS = 3
+
+# 审计日志：缓冲满多少条事件写入一次、后台定时写入的间隔（秒）
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 5
+
+# 密码哈希：默认scrypt，可切换为pbkdf2_sha256；调高参数前先用benchmark_login.py测量登录延迟
+PASSWORD_HASH_METHOD = 'scrypt'
+PASSWORD_SCRYPT_N = 2 ** 14
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+PASSWORD_PBKDF2_ITERATIONS = 600000
+PASSWORD_SALT_BYTES = 16
+
+# 数据导出：每累积多少行输出一块
+EXPORT_CHUNK_ROWS = 1000
+
+# 请求性能分析（默认关闭，环境变量LIBRARY_PROFILING=1开启）：记录每个请求的耗时与SQL统计，由 /metrics 输出
+PROFILING_ENABLED = os.environ.get('LIBRARY_PROFILING', '0') == '1'
+# 开启性能分析时，耗时超过该秒数的请求保存cProfile结果到PROFILE_DUMP_DIR；None表示不采集。
+# 分别取自环境变量LIBRARY_PROFILE_DUMP_THRESHOLD（秒，可为小数）和LIBRARY_PROFILE_DUMP_DIR
+PROFILE_DUMP_THRESHOLD = (float(os.environ['LIBRARY_PROFILE_DUMP_THRESHOLD'])
+                          if os.environ.get('LIBRARY_PROFILE_DUMP_THRESHOLD') else None)
+PROFILE_DUMP_DIR = os.environ.get('LIBRARY_PROFILE_DUMP_DIR', 'profiles')
+PROFILE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# 页面缓存：memory为进程内LRU，file为多进程共享的文件缓存
+PAGE_CACHE_BACKEND = 'memory'
+PAGE_CACHE_DIR = 'page_cache'
+PAGE_CACHE_MAX_ENTRIES = 500
+PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# 用户缓存配置（多进程部署时，其他进程对用户的修改最多延迟TTL秒生效）
+USER_CACHE_TTL = 60
+USER_CACHE_MAX_SIZE = 10000
+
+# 数据库迁移：(版本号, 说明, SQL语句列表)
+# 已发布的迁移不可修改，结构变更只能追加新版本
+MIGRATIONS = [
+    (1, '分页排序索引', [
+        'CREATE INDEX IF NOT EXISTS idx_books_created_at ON books (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_loans_loan_date ON loans (loan_date, id)',
+    ]),
+    (2, '借阅与图书热点查询索引', [
+        # 未归还借阅的部分索引：借书前的重复借阅检查和借阅数量限制
+        'CREATE INDEX IF NOT EXISTS idx_loans_user_active ON loans (user_id, book_id) WHERE is_returned = 0',
+        # 逾期统计
+        'CREATE INDEX IF NOT EXISTS idx_loans_due_active ON loans (due_date) WHERE is_returned = 0',
+        # 我的借阅 / 图书借阅历史
+        'CREATE INDEX IF NOT EXISTS idx_loans_user_date ON loans (user_id, loan_date)',
+        'CREATE INDEX IF NOT EXISTS idx_loans_book_date ON loans (book_id, loan_date)',
+        # 分类筛选
+        'CREATE INDEX IF NOT EXISTS idx_books_category ON books (category, created_at, id)',
+    ]),
+    (3, '统计计数表与图书借阅次数', [
+        '''CREATE TABLE IF NOT EXISTS library_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )''',
+        '''INSERT OR REPLACE INTO library_stats (name, value) VALUES
+            ('total_books', (SELECT COUNT(*) FROM books)),
+            ('total_users', (SELECT COUNT(*) FROM users)),
+            ('active_loans', (SELECT COUNT(*) FROM loans WHERE is_returned = 0))''',
+        'ALTER TABLE books ADD COLUMN loan_count INTEGER NOT NULL DEFAULT 0',
+        'UPDATE books SET loan_count = (SELECT COUNT(*) FROM loans WHERE loans.book_id = books.id)',
+        'CREATE INDEX IF NOT EXISTS idx_books_loan_count ON books (loan_count, created_at)',
+        # 触发器增量维护计数
+        '''CREATE TRIGGER IF NOT EXISTS stats_books_ai AFTER INSERT ON books BEGIN
+            UPDATE library_stats SET value = value + 1 WHERE name = 'total_books';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_books_ad AFTER DELETE ON books BEGIN
+            UPDATE library_stats SET value = value - 1 WHERE name = 'total_books';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_users_ai AFTER INSERT ON users BEGIN
+            UPDATE library_stats SET value = value + 1 WHERE name = 'total_users';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_users_ad AFTER DELETE ON users BEGIN
+            UPDATE library_stats SET value = value - 1 WHERE name = 'total_users';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_loans_ai AFTER INSERT ON loans BEGIN
+            UPDATE library_stats SET value = value + 1
+            WHERE name = 'active_loans' AND new.is_returned = 0;
+            UPDATE books SET loan_count = loan_count + 1 WHERE id = new.book_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_loans_ad AFTER DELETE ON loans BEGIN
+            UPDATE library_stats SET value = value - 1
+            WHERE name = 'active_loans' AND old.is_returned = 0;
+            UPDATE books SET loan_count = loan_count - 1 WHERE id = old.book_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_loans_au_returned
+        AFTER UPDATE OF is_returned ON loans BEGIN
+            UPDATE library_stats
+            SET value = value + (new.is_returned = 0) - (old.is_returned = 0)
+            WHERE name = 'active_loans';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_loans_au_book
+        AFTER UPDATE OF book_id ON loans WHEN new.book_id != old.book_id BEGIN
+            UPDATE books SET loan_count = loan_count - 1 WHERE id = old.book_id;
+            UPDATE books SET loan_count = loan_count + 1 WHERE id = new.book_id;
+        END''',
+    ]),
+    (4, '批量导入：ISBN去重索引与断点记录', [
+        f'CREATE INDEX IF NOT EXISTS idx_books_isbn_key ON books ({ISBN_KEY_SQL})',
+        '''CREATE TABLE IF NOT EXISTS import_checkpoints (
+            source TEXT PRIMARY KEY,
+            records_done INTEGER NOT NULL DEFAULT 0,
+            inserted INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ]),
+    (5, '逾期状态与应计罚金（由后台任务批量计算）', [
+        'ALTER TABLE loans ADD COLUMN is_overdue BOOLEAN NOT NULL DEFAULT 0',
+        'ALTER TABLE loans ADD COLUMN accrued_fine REAL NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_loans_overdue ON loans (is_overdue) WHERE is_returned = 0',
+        "INSERT OR IGNORE INTO library_stats (name, value) VALUES ('overdue_loans', 0)",
+        # 归还时立即扣减逾期计数，不必等下一次后台计算
+        '''CREATE TRIGGER IF NOT EXISTS stats_loans_au_overdue
+        AFTER UPDATE OF is_overdue, is_returned ON loans BEGIN
+            UPDATE library_stats
+            SET value = value + (new.is_overdue = 1 AND new.is_returned = 0)
+                              - (old.is_overdue = 1 AND old.is_returned = 0)
+            WHERE name = 'overdue_loans';
+        END''',
+    ]),
+    (6, '表变更计数（API的ETag/Last-Modified）', [
+        '''CREATE TABLE IF NOT EXISTS change_counters (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        "INSERT OR IGNORE INTO change_counters (name) VALUES ('books'), ('loans')",
+    ] + [
+        f'''CREATE TRIGGER IF NOT EXISTS version_{table}_{suffix} AFTER {event} ON {table} BEGIN
+            UPDATE change_counters SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE name = '{table}';
+        END'''
+        for table in ('books', 'loans')
+        for suffix, event in (('ai', 'INSERT'), ('au', 'UPDATE'), ('ad', 'DELETE'))
+    ]),
+    (7, '搜索建议前缀索引', [
+        '''CREATE TABLE IF NOT EXISTS book_suggestions (
+            term TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            PRIMARY KEY (term, book_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_book_suggestions_book ON book_suggestions (book_id)',
+        # 归一化和拼音首字母需要Python计算，触发器只记录待更新的图书，由后台任务处理
+        'CREATE TABLE IF NOT EXISTS suggest_dirty (book_id INTEGER PRIMARY KEY)',
+        'INSERT OR IGNORE INTO suggest_dirty (book_id) SELECT id FROM books',
+        '''CREATE TRIGGER IF NOT EXISTS suggest_books_ai AFTER INSERT ON books BEGIN
+            INSERT OR IGNORE INTO suggest_dirty (book_id) VALUES (new.id);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS suggest_books_au AFTER UPDATE OF title, author ON books BEGIN
+            INSERT OR IGNORE INTO suggest_dirty (book_id) VALUES (new.id);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS suggest_books_ad AFTER DELETE ON books BEGIN
+            DELETE FROM book_suggestions WHERE book_id = old.id;
+            DELETE FROM suggest_dirty WHERE book_id = old.id;
+        END''',
+    ]),
+    (8, '用户表变更计数（页面缓存失效）', [
+        "INSERT OR IGNORE INTO change_counters (name) VALUES ('users')",
+    ] + [
+        f'''CREATE TRIGGER IF NOT EXISTS version_users_{suffix} AFTER {event} ON users BEGIN
+            UPDATE change_counters SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE name = 'users';
+        END'''
+        for suffix, event in (('ai', 'INSERT'), ('au', 'UPDATE'), ('ad', 'DELETE'))
+    ]),
+    (9, '图书预约队列', [
+        'ALTER TABLE users ADD COLUMN hold_priority INTEGER NOT NULL DEFAULT 0',
+        '''CREATE TABLE IF NOT EXISTS holds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            book_id INTEGER NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'waiting',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ready_at TIMESTAMP,
+            expires_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (book_id) REFERENCES books (id)
+        )''',
+        # 每本书的等待队列：优先级高的在前，同优先级先到先得；取队首只需一次索引查找
+        "CREATE INDEX IF NOT EXISTS idx_holds_queue ON holds (book_id, priority DESC, created_at, id) "
+        "WHERE status = 'waiting'",
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_user_book
+        ON holds (user_id, book_id) WHERE status IN ('waiting', 'ready')''',
+        'CREATE INDEX IF NOT EXISTS idx_holds_user ON holds (user_id, created_at)',
+        "CREATE INDEX IF NOT EXISTS idx_holds_expiry ON holds (expires_at) WHERE status = 'ready'",
+    ]),
+    (10, '通知发件箱', [
+        '''CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            dedup_key TEXT NOT NULL UNIQUE,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''',
+        # 待发送和发送中（租约到期可重新领取）的通知，按计划发送时间领取
+        "CREATE INDEX IF NOT EXISTS idx_notifications_due ON notifications (next_attempt_at, id) "
+        "WHERE status IN ('pending', 'sending')",
+    ]),
+    (11, '借阅统计汇总表', [
+        # 按月、按分类汇总：借出数按借阅月份计，归还相关指标按归还月份计
+        '''CREATE TABLE IF NOT EXISTS circulation_monthly (
+            month TEXT NOT NULL,
+            category TEXT NOT NULL,
+            loans INTEGER NOT NULL DEFAULT 0,
+            returns INTEGER NOT NULL DEFAULT 0,
+            loan_days REAL NOT NULL DEFAULT 0,
+            late_returns INTEGER NOT NULL DEFAULT 0,
+            fines REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, category)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS borrower_monthly (
+            month TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            loans INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, user_id)
+        ) WITHOUT ROWID''',
+        # 触发器只记录借出/归还事件，由后台任务增量汇总，汇总后删除
+        '''CREATE TABLE IF NOT EXISTS loan_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            loan_id INTEGER NOT NULL,
+            kind TEXT NOT NULL
+        )''',
+        "INSERT INTO loan_events (loan_id, kind) SELECT id, 'loan' FROM loans",
+        "INSERT INTO loan_events (loan_id, kind) SELECT id, 'return' FROM loans WHERE is_returned = 1",
+        '''CREATE TRIGGER IF NOT EXISTS events_loans_ai AFTER INSERT ON loans BEGIN
+            INSERT INTO loan_events (loan_id, kind) VALUES (new.id, 'loan');
+            INSERT INTO loan_events (loan_id, kind) SELECT new.id, 'return' WHERE new.is_returned = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS events_loans_au_returned
+        AFTER UPDATE OF is_returned ON loans WHEN new.is_returned = 1 AND old.is_returned = 0 BEGIN
+            INSERT INTO loan_events (loan_id, kind) VALUES (new.id, 'return');
+        END''',
+    ]),
+    (12, '按读者角色和图书分类的借阅规则', [
+        "ALTER TABLE users ADD COLUMN role TEXT NOT NULL DEFAULT 'reader'",
+        # role/category为'*'表示任意；规则字段为NULL时继承更通用的规则
+        '''CREATE TABLE IF NOT EXISTS loan_policies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            role TEXT NOT NULL DEFAULT '*',
+            category TEXT NOT NULL DEFAULT '*',
+            loan_days INTEGER,
+            max_loans INTEGER,
+            fine_per_day REAL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (role, category)
+        )''',
+        '''INSERT OR IGNORE INTO loan_policies (role, category, loan_days, max_loans, fine_per_day)
+        VALUES ('*', '*', 14, 5, 0.5)''',
+        # 罚金标准在借出时确定，之后修改规则不影响已借出的图书
+        'ALTER TABLE loans ADD COLUMN fine_per_day REAL NOT NULL DEFAULT 0.5',
+        "INSERT OR IGNORE INTO change_counters (name) VALUES ('loan_policies')",
+    ] + [
+        f'''CREATE TRIGGER IF NOT EXISTS version_loan_policies_{suffix} AFTER {event} ON loan_policies BEGIN
+            UPDATE change_counters SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE name = 'loan_policies';
+        END'''
+        for suffix, event in (('ai', 'INSERT'), ('au', 'UPDATE'), ('ad', 'DELETE'))
+    ]),
+    (13, '审计日志分区登记表', [
+        # 审计事件按月分表（audit_YYYYMM），首次写入该月事件时建表并登记；
+        # 旧月份可以整表归档或删除，不影响其他月份
+        '''CREATE TABLE IF NOT EXISTS audit_partitions (
+            month TEXT PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID''',
+    ]),
+    (14, '分类馆藏册数（借阅报表周转率）', [
+        '''CREATE TABLE IF NOT EXISTS category_copies (
+            category TEXT PRIMARY KEY,
+            copies INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''',
+        '''INSERT OR REPLACE INTO category_copies (category, copies)
+        SELECT COALESCE(category, '未分类'), SUM(COALESCE(total_copies, 0)) FROM books GROUP BY 1''',
+        # 触发器增量维护，报表不必每次汇总books全表
+        '''CREATE TRIGGER IF NOT EXISTS copies_books_ai AFTER INSERT ON books BEGIN
+            INSERT INTO category_copies (category, copies)
+            VALUES (COALESCE(new.category, '未分类'), COALESCE(new.total_copies, 0))
+            ON CONFLICT (category) DO UPDATE SET copies = copies + excluded.copies;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS copies_books_ad AFTER DELETE ON books BEGIN
+            UPDATE category_copies SET copies = copies - COALESCE(old.total_copies, 0)
+            WHERE category = COALESCE(old.category, '未分类');
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS copies_books_au
+        AFTER UPDATE OF category, total_copies ON books BEGIN
+            UPDATE category_copies SET copies = copies - COALESCE(old.total_copies, 0)
+            WHERE category = COALESCE(old.category, '未分类');
+            INSERT INTO category_copies (category, copies)
+            VALUES (COALESCE(new.category, '未分类'), COALESCE(new.total_copies, 0))
+            ON CONFLICT (category) DO UPDATE SET copies = copies + excluded.copies;
+        END''',
+    ]),
+    (15, '借阅日期改为本地时间并重新汇总借阅统计', [
+        # loan_date原来取默认值CURRENT_TIMESTAMP（UTC），应还和归还日期是本地时间，
+        # 借阅天数和按月归属会偏差一个时区差；借书时改为显式写入本地时间，旧数据一次性转换
+        "UPDATE loans SET loan_date = datetime(loan_date, 'localtime') WHERE loan_date IS NOT NULL",
+        'DELETE FROM circulation_monthly',
+        'DELETE FROM borrower_monthly',
+        'DELETE FROM loan_events',
+        "INSERT INTO loan_events (loan_id, kind) SELECT id, 'loan' FROM loans",
+        "INSERT INTO loan_events (loan_id, kind) SELECT id, 'return' FROM loans WHERE is_returned = 1",
+    ]),
+    (16, '后台任务调度表（多进程部署时共享任务每个间隔只执行一次）', [
+        '''CREATE TABLE IF NOT EXISTS job_schedule (
+            name TEXT PRIMARY KEY,
+            next_run REAL NOT NULL DEFAULT 0
+        )''',
+    ]),
+    (17, '搜索建议按借阅次数取候选', [
+        # 原表只能按词序取前若干个候选再排序，前缀相同的冷门书多时热门书会被挤掉；
+        # 改为按前缀（前SUGGEST_PREFIX_LENGTH个字符内的每个长度）分组、组内按借阅次数排序，
+        # 索引顺序即热度顺序，取前N条即可
+        'DROP TABLE IF EXISTS book_suggestions',
+        '''CREATE TABLE book_suggestions (
+            prefix TEXT NOT NULL,
+            term TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            loan_count INTEGER NOT NULL DEFAULT 0
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_book_suggestions_rank ON book_suggestions (prefix, loan_count DESC, book_id, term)',
+        'CREATE INDEX IF NOT EXISTS idx_book_suggestions_book ON book_suggestions (book_id)',
+        '''CREATE TRIGGER IF NOT EXISTS suggest_books_loans AFTER UPDATE OF loan_count ON books BEGIN
+            UPDATE book_suggestions SET loan_count = new.loan_count WHERE book_id = new.id;
+        END''',
+        'INSERT OR IGNORE INTO suggest_dirty (book_id) SELECT id FROM books',
+    ]),
+    (18, '分类图书数（图书浏览和借阅规则页的分类列表）', [
+        # SELECT DISTINCT category FROM books 要遍历整个分类索引；分类表再记一份图书数，
+        # 图书数大于0的分类即为现有分类
+        'ALTER TABLE category_copies ADD COLUMN books INTEGER NOT NULL DEFAULT 0',
+        '''UPDATE category_copies SET books = (
+            SELECT COUNT(*) FROM books WHERE COALESCE(books.category, '未分类') = category_copies.category
+        )''',
+        'DROP TRIGGER IF EXISTS copies_books_ai',
+        'DROP TRIGGER IF EXISTS copies_books_ad',
+        'DROP TRIGGER IF EXISTS copies_books_au',
+        '''CREATE TRIGGER IF NOT EXISTS copies_books_ai AFTER INSERT ON books BEGIN
+            INSERT INTO category_copies (category, copies, books)
+            VALUES (COALESCE(new.category, '未分类'), COALESCE(new.total_copies, 0), 1)
+            ON CONFLICT (category) DO UPDATE SET copies = copies + excluded.copies, books = books + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS copies_books_ad AFTER DELETE ON books BEGIN
+            UPDATE category_copies SET copies = copies - COALESCE(old.total_copies, 0), books = books - 1
+            WHERE category = COALESCE(old.category, '未分类');
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS copies_books_au
+        AFTER UPDATE OF category, total_copies ON books BEGIN
+            UPDATE category_copies SET copies = copies - COALESCE(old.total_copies, 0), books = books - 1
+            WHERE category = COALESCE(old.category, '未分类');
+            INSERT INTO category_copies (category, copies, books)
+            VALUES (COALESCE(new.category, '未分类'), COALESCE(new.total_copies, 0), 1)
+            ON CONFLICT (category) DO UPDATE SET copies = copies + excluded.copies, books = books + 1;
+        END''',
+    ]),
+]
+
+# 全文检索配置（trigram分词器要求每个词至少3个字符，更短的词使用二元分词的短词索引）
+SEARCH_MIN_TERM_LENGTH = 3
+SEARCH_RANK_WEIGHTS = (10.0, 5.0, 3.0, 1.0)  # title, author, isbn, description
+
+# 分页配置
+PAGE_SIZE_DEFAULT = 20
+PAGE_SIZE_MAX = 100
+
+class ConnectionPool:
+    """SQLite连接池：复用已配置好PRAGMA的连接，并记录使用情况"""
+    
+    def __init__(self, database, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        # 后进先出：同一线程连续请求通常拿回刚归还的连接，页缓存更热
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.open_connections = 0
+        self.checkouts = 0
+        self.waits = 0
+    
+    def _connect(self, share_users=True):
+        """创建新连接并设置PRAGMA；分馆的连接同时附加总馆的读者账户（见share_main_users）"""
+        conn = sqlite3.connect(self.database, timeout=DB_BUSY_TIMEOUT / 1000,
+                               check_same_thread=False, uri=True)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        if share_users and not is_main_database(self.database):
+            share_main_users(conn)
+        return conn
+    
+    def acquire(self):
+        """取出一个连接，连接数已达上限时等待其他请求归还"""
+        with self._lock:
+            self.checkouts += 1
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            create = self.open_connections < self.max_size
+            if create:
+                self.open_connections += 1
+            else:
+                self.waits += 1
+        
+        if create:
+            try:
+                return self._connect()
+            except sqlite3.Error:
+                with self._lock:
+                    self.open_connections -= 1
+                raise
+        
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('数据库连接池已耗尽')
+    
+    def release(self, conn):
+        """归还连接，未提交的事务会被回滚"""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+    
+    def stats(self):
+        """连接池指标"""
+        return {
+            'database': self.database,
+            'max_size': self.max_size,
+            'open_connections': self.open_connections,
+            'idle_connections': self._idle.qsize(),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+        }
+
+def load_branches(value):
+    """解析分馆配置（JSON文本或JSON文件路径），返回 {代码: (名称, 数据库文件)}，格式错误时抛出ValueError"""
+    value = value.strip()
+    if not value:
+        return {}
+    if not value.startswith('{'):
+        try:
+            with open(value, encoding='utf-8') as f:
+                value = f.read()
+        except OSError as e:
+            raise ValueError(f'无法读取分馆配置文件: {e}')
+    try:
+        config = json.loads(value)
+    except json.JSONDecodeError as e:
+        raise ValueError(f'分馆配置不是有效的JSON: {e}')
+    if not isinstance(config, dict):
+        raise ValueError('分馆配置应为 {"代码": ["名称", "数据库文件"]}')
+    
+    branches = {}
+    for code, entry in config.items():
+        if code == MAIN_BRANCH or not re.fullmatch(r'[A-Za-z0-9_-]+', code):
+            raise ValueError(f'无效的分馆代码: {code}')
+        if (not isinstance(entry, list) or len(entry) != 2
+                or not all(isinstance(item, str) and item for item in entry)):
+            raise ValueError(f'分馆 {code} 的配置应为 ["名称", "数据库文件"]')
+        branches[code] = tuple(entry)
+    databases = [os.path.abspath(database) for _, database in branches.values()]
+    if len(set(databases)) != len(databases):
+        raise ValueError('多个分馆使用了同一个数据库文件')
+    return branches
+
+BRANCHES.update(load_branches(os.environ.get(BRANCHES_ENV, '')))
+
+def branch_databases():
+    """全部分馆 {代码: (名称, 数据库文件)}，总馆在前"""
+    branches = {MAIN_BRANCH: (MAIN_BRANCH_NAME, DATABASE)}
+    branches.update(BRANCHES)
+    return branches
+
+def branch_database(code):
+    """分馆代码对应的数据库文件，未知代码抛出ValueError"""
+    branches = branch_databases()
+    if code not in branches:
+        raise ValueError(f'未知的分馆: {code}')
+    return branches[code][1]
+
+def current_branch():
+    """当前请求所在的分馆（会话中选择的分馆，默认及请求之外为总馆）"""
+    if has_request_context():
+        code = session.get('branch')
+        if code in BRANCHES:
+            return code
+    return MAIN_BRANCH
+
+def is_main_database(database):
+    """是否为总馆的数据库文件"""
+    return os.path.abspath(database) == os.path.abspath(DATABASE)
+
+def share_main_users(db):
+    """让分馆的连接读取总馆的读者账户
+    
+    以只读方式附加总馆数据库，再用同名临时视图遮住分馆文件中的users表（临时对象
+    先于本库的表解析），借阅、预约、报表等查询原样JOIN users即可。只读附加的库
+    不参与BEGIN IMMEDIATE的写锁，分馆的写事务不会占用总馆的锁；读者账户的修改
+    通过get_main_db()写入总馆。连接需要以uri=True打开。
+    """
+    db.execute('ATTACH DATABASE ? AS library_main',
+               (f'file:{urllib.parse.quote(os.path.abspath(DATABASE))}?mode=ro',))
+    db.execute('CREATE TEMP VIEW IF NOT EXISTS users AS SELECT * FROM library_main.users')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(database=None):
+    """获取数据库文件对应的连接池，默认为当前分馆；分馆的连接池在首次使用时创建"""
+    database = database or branch_database(current_branch())
+    pool = _pools.get(database)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(database, ConnectionPool(database))
+    return pool
+
 def get_db():
     """获取数据库连接"""
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
+        g.db_pool = get_pool()
+        g.db = g.db_pool.acquire()
+        if PROFILING_ENABLED and has_request_context():
+            g.db = ProfiledConnection(g.db)
     return g.db
 
+def get_main_db():
+    """获取总馆数据库连接（全馆统一的数据：借阅规则，读者账户的写入）；当前即为总馆时与get_db()相同"""
+    if current_branch() == MAIN_BRANCH:
+        return get_db()
+    if 'main_db' not in g:
+        g.main_db = get_pool(DATABASE).acquire()
+    return g.main_db
+
 @app.teardown_appcontext
 def close_db(error=None):
-    """关闭数据库连接"""
+    """归还数据库连接"""
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        if isinstance(db, ProfiledConnection):
+            db = db.connection
+        g.pop('db_pool').release(db)
+    main_db = g.pop('main_db', None)
+    if main_db is not None:
+        get_pool(DATABASE).release(main_db)
 
-def init_db():
-    """初始化数据库"""
-    db = get_db()
+class ProfiledConnection:
+    """包装sqlite3连接，统计本次请求执行的SQL条数、总耗时和最慢的语句
+    
+    只计execute/executemany本身的耗时，游标后续fetch的时间不计入。
+    """
+    
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_sql = None
+    
+    def _timed(self, method, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.statements += 1
+            self.sql_seconds += elapsed
+            if elapsed > self.slowest_seconds:
+                self.slowest_seconds = elapsed
+                self.slowest_sql = sql
+    
+    def execute(self, sql, parameters=()):
+        return self._timed(self.connection.execute, sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(self.connection.executemany, sql, seq_of_parameters)
+    
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+class RequestMetrics:
+    """按endpoint汇总请求耗时与SQL统计"""
+    
+    def __init__(self, buckets=PROFILE_BUCKETS):
+        self.buckets = buckets
+        self._endpoints = {}
+        self._lock = threading.Lock()
+    
+    def record(self, endpoint, status, seconds, db=None):
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = {
+                    'statuses': {}, 'count': 0, 'seconds': 0.0,
+                    'buckets': [0] * len(self.buckets),
+                    'sql_statements': 0, 'sql_seconds': 0.0,
+                    'slowest_sql_seconds': 0.0, 'slowest_sql': None,
+                }
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+            if db is not None:
+                entry['sql_statements'] += db.statements
+                entry['sql_seconds'] += db.sql_seconds
+                if db.slowest_seconds > entry['slowest_sql_seconds']:
+                    entry['slowest_sql_seconds'] = db.slowest_seconds
+                    entry['slowest_sql'] = ' '.join(db.slowest_sql.split())[:200]
+    
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(entry, statuses=dict(entry['statuses']), buckets=list(entry['buckets']))
+                    for endpoint, entry in self._endpoints.items()}
+
+request_metrics = RequestMetrics()
+_profiler_lock = threading.Lock()
+
+@app.before_request
+def start_request_profile():
+    """请求计时；需要时启动cProfile（同一时间只分析一个请求，分析器在解释器内不可嵌套）"""
+    if not PROFILING_ENABLED:
+        return
+    g.request_start = time.perf_counter()
+    if PROFILE_DUMP_THRESHOLD is not None and _profiler_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def record_response_status(response):
+    if PROFILING_ENABLED:
+        g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_profile(error=None):
+    """记录请求指标，超过阈值时保存cProfile结果"""
+    start = g.pop('request_start', None)
+    if start is None:
+        return
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profiler_lock.release()
+    
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or 'unknown'
+    status = 500 if error is not None else g.pop('response_status', 500)
+    db = g.get('db')
+    request_metrics.record(endpoint, status, elapsed, db if isinstance(db, ProfiledConnection) else None)
     
+    if profiler is not None and elapsed >= PROFILE_DUMP_THRESHOLD:
+        os.makedirs(PROFILE_DUMP_DIR, exist_ok=True)
+        filename = f"{datetime.now():%Y%m%d-%H%M%S}-{endpoint}-{elapsed * 1000:.0f}ms.prof"
+        profiler.dump_stats(os.path.join(PROFILE_DUMP_DIR, filename))
+
+def init_db(database=None):
+    """初始化数据库，database为空时初始化当前分馆"""
+    database = database or branch_database(current_branch())
+    # 建表和迁移针对数据库文件自身的表，不附加总馆的读者账户
+    db = get_pool(database)._connect(share_users=False)
+    try:
+        return setup_database(db, accounts=is_main_database(database))
+    finally:
+        db.close()
+
+def init_branches():
+    """初始化总馆和全部分馆的数据库"""
+    for name, database in branch_databases().values():
+        if BRANCHES:
+            print(f"初始化{name}（{database}）")
+        init_db(database)
+
+def setup_database(db, accounts=True):
+    """建表、应用迁移并写入初始数据；分馆不保存读者账户（accounts=False），不创建管理员"""
     # 创建用户表
     db.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -83,17 +873,25 @@ def init_db():
     
     db.commit()
     
+    # 应用数据库迁移（索引等结构变更）
+    apply_migrations(db)
+    
+    # 创建图书全文索引
+    init_search_index(db)
+    init_short_search_index(db)
+    
     # 创建默认管理员账户
-    admin_password = hashlib.sha256('admin123'.encode()).hexdigest()
-    try:
-        db.execute('''
-            INSERT OR IGNORE INTO users (username, email, password_hash, is_admin)
-            VALUES (?, ?, ?, ?)
-        ''', ('admin', 'admin@library.com', admin_password, 1))
-        db.commit()
-        print("默认管理员账户已创建: admin / admin123")
-    except Exception as e:
-        print(f"创建管理员账户时出错: {e}")
+    if accounts:
+        admin_password = hash_password('admin123')
+        try:
+            db.execute('''
+                INSERT OR IGNORE INTO users (username, email, password_hash, is_admin)
+                VALUES (?, ?, ?, ?)
+            ''', ('admin', 'admin@library.com', admin_password, 1))
+            db.commit()
+            print("默认管理员账户已创建: admin / admin123")
+        except Exception as e:
+            print(f"创建管理员账户时出错: {e}")
     
     # 检查是否已有示例图书数据，如果没有才添加
     existing_books_count = db.execute('SELECT COUNT(*) FROM books').fetchone()[0]
@@ -108,90 +906,2117 @@ def init_db():
             ('978-7-111-56789-4', '设计模式：可复用面向对象软件的基础', 'Erich Gamma', '软件工程', '经典设计模式书籍', 2, 2),
         ]
         
-        for book_data in sample_books:
+        try:
+            db.executemany('''
+                INSERT INTO books (isbn, title, author, category, description, total_copies, available_copies)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', sample_books)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"添加图书时出错: {e}")
+        
+        print("示例图书数据已初始化")
+    else:
+        print(f"数据库中已有 {existing_books_count} 本图书，跳过示例数据初始化")
+    
+    # 构建尚未建立的搜索建议
+    refresh_suggestions(db, drain=True)
+
+def apply_migrations(db):
+    """按版本号依次应用未执行的数据库迁移，每个迁移在独立事务中完成"""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    current_version = db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version:
+            continue
+        try:
+            db.execute('BEGIN')
+            for statement in statements:
+                db.execute(statement)
+            db.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                       (version, description))
+            db.commit()
+        except sqlite3.Error:
+            db.rollback()
+            raise
+        print(f"已应用数据库迁移 {version}: {description}")
+    
+    return max([current_version] + [version for version, _, _ in MIGRATIONS])
+
+def init_search_index(db):
+    """创建图书全文索引（FTS5）及同步触发器"""
+    exists = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+    ).fetchone()
+    
+    try:
+        # trigram分词器支持中文等无空格文本的子串匹配
+        db.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+                title, author, isbn, description,
+                content='books', content_rowid='id',
+                tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"当前SQLite不支持FTS5 trigram，搜索将使用LIKE查询: {e}")
+        return False
+    
+    # 触发器保持索引与books表同步
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts(rowid, title, author, isbn, description)
+            VALUES (new.id, new.title, new.author, new.isbn, new.description);
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, author, isbn, description)
+            VALUES ('delete', old.id, old.title, old.author, old.isbn, old.description);
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_au
+        AFTER UPDATE OF title, author, isbn, description ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, author, isbn, description)
+            VALUES ('delete', old.id, old.title, old.author, old.isbn, old.description);
+            INSERT INTO books_fts(rowid, title, author, isbn, description)
+            VALUES (new.id, new.title, new.author, new.isbn, new.description);
+        END
+    ''')
+    
+    # 已有数据的旧数据库首次建立索引时需要全量构建
+    if not exists:
+        rebuild_search_index(db)
+    
+    db.commit()
+    return True
+
+def rebuild_search_index(db):
+    """根据books表重建全文索引"""
+    db.execute("INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
+    db.commit()
+
+def bigram_sql(column):
+    """把列值切分为二元词的SQL表达式（“算法导论”→“算法 法导 导论 论”）
+    
+    在触发器中计算，不依赖注册到连接上的Python函数，导入脚本等直接写books表也能同步；
+    json_each展开一个与文本等长的数组得到每个字符的位置。
+    """
+    return (f"(SELECT group_concat(substr({column}, position.key + 1, 2), ' ') FROM json_each("
+            f"'[' || replace(hex(zeroblob(length({column}) - 1)), '00', '0,') || '0]') AS position)")
+
+def bigram_values(row):
+    """title, author, isbn, description四列的二元词表达式"""
+    return ', '.join(bigram_sql(f'{row}.{column}') for column in ('title', 'author', 'isbn', 'description'))
+
+def init_short_search_index(db):
+    """创建短词索引（FTS5，保存二元分词）及同步触发器
+    
+    trigram索引检索不了1~2个字的词，而中文书名、作者的查询大多只有两个字。
+    每个字符和下一个字符组成一个词（末尾的字符单独成词）：两字的查询精确匹配该词，
+    单字的查询用前缀匹配。索引只保存分词结果（contentless），不重复保存原文。
+    """
+    exists = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts_short'"
+    ).fetchone()
+    
+    try:
+        db.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS books_fts_short USING fts5(
+                title, author, isbn, description,
+                content='', prefix='1',
+                tokenize='unicode61 remove_diacritics 0'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"当前SQLite不支持FTS5，短词搜索将使用LIKE查询: {e}")
+        return False
+    
+    # contentless表删除时要提供原来写入的分词结果，由old.*重新计算
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_fts_short_ai AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts_short(rowid, title, author, isbn, description)
+            VALUES (new.id, {bigram_values('new')});
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_fts_short_ad AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts_short(books_fts_short, rowid, title, author, isbn, description)
+            VALUES ('delete', old.id, {bigram_values('old')});
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_fts_short_au
+        AFTER UPDATE OF title, author, isbn, description ON books BEGIN
+            INSERT INTO books_fts_short(books_fts_short, rowid, title, author, isbn, description)
+            VALUES ('delete', old.id, {bigram_values('old')});
+            INSERT INTO books_fts_short(rowid, title, author, isbn, description)
+            VALUES (new.id, {bigram_values('new')});
+        END
+    ''')
+    
+    if not exists:
+        rebuild_short_search_index(db)
+    
+    db.commit()
+    return True
+
+def rebuild_short_search_index(db):
+    """根据books表重建短词索引（contentless表不支持rebuild命令，清空后重新写入）"""
+    db.execute("INSERT INTO books_fts_short(books_fts_short) VALUES ('delete-all')")
+    db.execute(f'''
+        INSERT INTO books_fts_short(rowid, title, author, isbn, description)
+        SELECT id, {bigram_values('books')} FROM books
+    ''')
+    db.commit()
+
+def build_search_query(search):
+    """把用户输入转换为FTS5查询，词太短无法使用trigram索引时返回None"""
+    terms = search.split()
+    if not terms or any(len(term) < SEARCH_MIN_TERM_LENGTH for term in terms):
+        return None
+    # 每个词作为短语加引号，避免用户输入被当作FTS语法解析
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def build_short_search_query(search):
+    """包含短词的搜索转换为 (短词索引查询, 其余长词的trigram查询或None)，无法使用短词索引时返回None
+    
+    短词只能由文字和数字组成：标点在分词时是分隔符，带标点的短词用索引会比LIKE匹配得更宽。
+    """
+    terms = search.split()
+    short_terms = [term for term in terms if len(term) < SEARCH_MIN_TERM_LENGTH]
+    if not short_terms or not all(term.isalnum() for term in short_terms):
+        return None
+    short_query = ' '.join(f'"{term}"' + ('*' if len(term) == 1 else '') for term in short_terms)
+    long_terms = [term for term in terms if len(term) >= SEARCH_MIN_TERM_LENGTH]
+    return short_query, build_search_query(' '.join(long_terms)) if long_terms else None
+
+def encode_cursor(values):
+    """把排序键值编码为URL安全的分页游标"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    """解析分页游标，无效时返回None"""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, binascii.Error):
+        return None
+    return values if isinstance(values, list) else None
+
+def get_page_size():
+    """读取每页数量，限制在 [1, PAGE_SIZE_MAX] 范围内"""
+    page_size = request.args.get('per_page', PAGE_SIZE_DEFAULT, type=int)
+    return max(1, min(page_size, PAGE_SIZE_MAX))
+
+def paginate(db, query, params, keys, descending=True, prefix=''):
+    """基于游标（keyset）的分页
+    
+    query为不含ORDER BY/LIMIT的SELECT语句，keys为唯一确定顺序的排序键列。
+    游标记录本页首/尾行的排序键，翻页时用行值比较定位，每次只读取一页数据。
+    """
+    page_size = get_page_size()
+    after = decode_cursor(request.args.get(prefix + 'after'))
+    before = decode_cursor(request.args.get(prefix + 'before'))
+    
+    # 向前翻页时反向查询，取出后再倒序
+    backwards = after is None and before is not None
+    cursor = before if backwards else after
+    if cursor is not None and len(cursor) != len(keys):
+        cursor = None
+    
+    scan_descending = descending != backwards
+    order = ' DESC' if scan_descending else ' ASC'
+    
+    sql = f'SELECT * FROM ({query}) AS page_source'
+    params = list(params)
+    if cursor is not None:
+        placeholders = ', '.join('?' * len(keys))
+        sql += f' WHERE ({", ".join(keys)}) {"<" if scan_descending else ">"} ({placeholders})'
+        params.extend(cursor)
+    sql += ' ORDER BY ' + ', '.join(key + order for key in keys) + ' LIMIT ?'
+    params.append(page_size + 1)
+    
+    rows = db.execute(sql, params).fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    
+    if backwards:
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, cursor is not None
+    
+    next_cursor = prev_cursor = None
+    if rows and has_next:
+        next_cursor = encode_cursor([rows[-1][key] for key in keys])
+    if rows and has_prev:
+        prev_cursor = encode_cursor([rows[0][key] for key in keys])
+    
+    return {
+        'items': rows,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+        'page_size': page_size,
+    }
+
+@app.template_global()
+def page_url(prefix, direction, cursor):
+    """生成翻页链接，保留其他查询参数"""
+    args = request.args.to_dict()
+    args.pop(prefix + 'after', None)
+    args.pop(prefix + 'before', None)
+    args[prefix + direction] = cursor
+    return url_for(request.endpoint, **args)
+
+def isbn13_check_digit(digits):
+    """计算ISBN-13校验位（digits为前12位）"""
+    total = sum(int(c) * (1 if i % 2 == 0 else 3) for i, c in enumerate(digits))
+    return str((10 - total % 10) % 10)
+
+def normalize_isbn(value):
+    """规范化ISBN：去掉分隔符并校验，ISBN-10统一转换为ISBN-13
+    
+    空值返回None，格式或校验位错误时抛出ValueError
+    """
+    if value is None:
+        return None
+    # NFKC把全角数字、全角连字符转换为半角
+    isbn = re.sub(r'[\s\-]', '', unicodedata.normalize('NFKC', str(value))).upper()
+    if not isbn:
+        return None
+    
+    if re.fullmatch(r'[0-9]{9}[0-9X]', isbn):
+        total = sum((10 - i) * (10 if c == 'X' else int(c)) for i, c in enumerate(isbn))
+        if total % 11:
+            raise ValueError(f'ISBN-10校验位错误: {value}')
+        isbn = '978' + isbn[:9]
+        return isbn + isbn13_check_digit(isbn)
+    
+    if re.fullmatch(r'[0-9]{13}', isbn):
+        if isbn[-1] != isbn13_check_digit(isbn[:12]):
+            raise ValueError(f'ISBN-13校验位错误: {value}')
+        return isbn
+    
+    raise ValueError(f'ISBN格式错误: {value}')
+
+def fold_text(value):
+    """文本归一化：全角转半角、忽略大小写，去掉空白和标点符号（含中文标点）"""
+    if not value:
+        return ''
+    text = unicodedata.normalize('NFKC', value).casefold()
+    return ''.join(c for c in text if unicodedata.category(c)[0] not in 'PZS' and not c.isspace())
+
+# GB2312一级汉字按拼音排序，各声母首字的区位码（编码值）
+_PINYIN_INITIAL_BOUNDARIES = [
+    (0xB0A1, 'a'), (0xB0C5, 'b'), (0xB2C1, 'c'), (0xB4EE, 'd'), (0xB6EA, 'e'),
+    (0xB7A2, 'f'), (0xB8C1, 'g'), (0xB9FE, 'h'), (0xBBF7, 'j'), (0xBFA6, 'k'),
+    (0xC0AC, 'l'), (0xC2E8, 'm'), (0xC4C3, 'n'), (0xC5B6, 'o'), (0xC5BE, 'p'),
+    (0xC6DA, 'q'), (0xC8BB, 'r'), (0xC8F6, 's'), (0xCBFA, 't'), (0xCDDA, 'w'),
+    (0xCEF4, 'x'), (0xD1B9, 'y'), (0xD4D1, 'z'),
+]
+
+def pinyin_initials(text):
+    """汉字转拼音首字母（如“算法导论”→“sfdl”），字母数字原样保留
+    
+    基于GB2312一级汉字的拼音顺序，不依赖第三方库；二级汉字和生僻字会被忽略。
+    """
+    initials = []
+    for c in fold_text(text):
+        if c.isascii():
+            initials.append(c)
+            continue
+        try:
+            encoded = c.encode('gb2312')
+        except UnicodeEncodeError:
+            continue
+        if len(encoded) != 2:
+            continue
+        code = (encoded[0] << 8) + encoded[1]
+        if not 0xB0A1 <= code <= 0xD7F9:
+            continue
+        initial = None
+        for boundary, letter in _PINYIN_INITIAL_BOUNDARIES:
+            if code < boundary:
+                break
+            initial = letter
+        initials.append(initial)
+    return ''.join(initials)
+
+def isbn_lookup_keys(isbn13):
+    """返回同一本书可能的存储形式（ISBN-13及对应的ISBN-10），用于和已有数据比对"""
+    keys = [isbn13]
+    if isbn13.startswith('978'):
+        digits = isbn13[3:12]
+        check = (11 - sum((10 - i) * int(c) for i, c in enumerate(digits)) % 11) % 11
+        keys.append(digits + ('X' if check == 10 else str(check)))
+    return keys
+
+def _scrypt(password, salt, n, r, p):
+    # maxmem需要覆盖 128*n*r 字节的工作内存，默认32MB限制了可调的n
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+def hash_password(password, method=None):
+    """密码哈希，结果格式为 算法$参数$盐$哈希，参数随哈希一起保存以便日后调整"""
+    method = method or PASSWORD_HASH_METHOD
+    salt = os.urandom(PASSWORD_SALT_BYTES)
+    if method == 'scrypt':
+        n, r, p = PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P
+        digest = _scrypt(password, salt, n, r, p)
+        return f'scrypt${n}${r}${p}${salt.hex()}${digest.hex()}'
+    if method == 'pbkdf2_sha256':
+        iterations = PASSWORD_PBKDF2_ITERATIONS
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+        return f'pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}'
+    raise ValueError(f'不支持的密码哈希算法: {method}')
+
+def password_needs_rehash(password_hash):
+    """哈希算法或参数与当前配置不一致时需要重新哈希"""
+    parts = password_hash.split('$')
+    if PASSWORD_HASH_METHOD == 'scrypt':
+        return parts[:4] != ['scrypt', str(PASSWORD_SCRYPT_N), str(PASSWORD_SCRYPT_R), str(PASSWORD_SCRYPT_P)]
+    return parts[:2] != ['pbkdf2_sha256', str(PASSWORD_PBKDF2_ITERATIONS)]
+
+def verify_password(password, password_hash):
+    """校验密码（常量时间比较），兼容旧版无盐SHA-256哈希"""
+    parts = password_hash.split('$')
+    try:
+        if parts[0] == 'scrypt' and len(parts) == 6:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            digest = _scrypt(password, bytes.fromhex(parts[4]), n, r, p).hex()
+            expected = parts[5]
+        elif parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+            digest = hashlib.pbkdf2_hmac('sha256', password.encode(),
+                                         bytes.fromhex(parts[2]), int(parts[1])).hex()
+            expected = parts[3]
+        elif len(parts) == 1:
+            # 旧版：无盐单次SHA-256
+            digest = hashlib.sha256(password.encode()).hexdigest()
+            expected = password_hash
+        else:
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, expected)
+
+def get_stats(db):
+    """读取统计计数表（由触发器增量维护）"""
+    rows = db.execute('SELECT name, value FROM library_stats').fetchall()
+    return {row['name']: row['value'] for row in rows}
+
+def parse_datetime(value):
+    """解析数据库中的时间字符串（兼容带微秒的旧数据）"""
+    return datetime.fromisoformat(value)
+
+def login_required(f):
+    """登录装饰器"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            flash('请先登录', 'warning')
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def admin_required(f):
+    """管理员装饰器"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            flash('请先登录', 'warning')
+            return redirect(url_for('login'))
+        
+        user = current_user()
+        
+        if not user or not user['is_admin']:
+            flash('您没有权限访问此页面', 'danger')
+            return redirect(url_for('index'))
+        
+        return f(*args, **kwargs)
+    return decorated_function
+
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+user_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+def load_user(user_id):
+    """按id读取用户，优先使用进程内缓存（读者账户全馆统一，分馆连接经视图读取总馆）"""
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry is not None and entry[0] > now:
+            user_cache_stats['hits'] += 1
+            return entry[1]
+        user_cache_stats['misses'] += 1
+    
+    row = get_db().execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    user = dict(row) if row else None
+    if user is not None:
+        with _user_cache_lock:
+            if len(_user_cache) >= USER_CACHE_MAX_SIZE:
+                # 先清理过期条目，仍然已满则整体清空
+                for key in [key for key, (expires, _) in _user_cache.items() if expires <= now]:
+                    del _user_cache[key]
+                if len(_user_cache) >= USER_CACHE_MAX_SIZE:
+                    _user_cache.clear()
+            _user_cache[user_id] = (now + USER_CACHE_TTL, user)
+    return user
+
+def invalidate_user(user_id):
+    """用户信息变更（禁用、权限修改等）后必须调用，使缓存失效"""
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+        user_cache_stats['invalidations'] += 1
+
+def current_user():
+    """获取当前用户（同一请求内只读取一次）"""
+    if 'user' not in g:
+        g.user = load_user(session['user_id']) if 'user_id' in session else None
+    return g.user
+
+@app.before_request
+def before_request():
+    """请求前设置当前用户"""
+    current_user()
+
+class LoanError(Exception):
+    """借还书业务校验失败"""
+    
+    def __init__(self, message, category='warning', code='invalid'):
+        super().__init__(message)
+        self.message = message
+        self.category = category
+        self.code = code
+
+def is_busy_error(error):
+    """判断是否为数据库锁冲突（可重试）"""
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+def run_transaction(db, func, *args):
+    """在BEGIN IMMEDIATE事务中执行func(db, *args)，锁冲突时退避重试
+    
+    BEGIN IMMEDIATE一开始就取得写锁，事务内的读取与后续写入之间
+    不会被其他写者插入，避免“先读后写”的竞争。
+    """
+    for attempt in range(TXN_MAX_RETRIES):
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            result = func(db, *args)
+            db.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            if db.in_transaction:
+                db.rollback()
+            if not is_busy_error(e) or attempt == TXN_MAX_RETRIES - 1:
+                raise
+            time.sleep(TXN_RETRY_DELAY * (2 ** attempt) * (1 + random.random()))
+        except Exception:
+            if db.in_transaction:
+                db.rollback()
+            raise
+
+LoanPolicy = namedtuple('LoanPolicy', 'loan_days max_loans fine_per_day')
+
+class PolicyTable:
+    """借阅规则查找表
+    
+    loan_policies表中的规则按 (角色, 分类) 预先合并成字典，借还书时只做字典查找，
+    不查询数据库。每个字段分别按 (角色, 分类) > (角色, *) > (*, 分类) > (*, *)
+    的顺序取第一个非NULL值。规则变更后调用load()整体替换，读取无需加锁。
+    规则全馆统一，保存在总馆数据库中。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._compiled = None  # (版本号, 角色集合, 分类集合, 规则字典)
+        self.loads = 0
+    
+    def load(self, db):
+        """从数据库读取规则并重新编译，返回规则条数"""
+        with self._lock:
+            version = db.execute(
+                "SELECT version FROM change_counters WHERE name = 'loan_policies'").fetchone()[0]
+            rows = db.execute(
+                'SELECT role, category, loan_days, max_loans, fine_per_day FROM loan_policies').fetchall()
+            self._compiled = (version,) + self.compile(rows)
+            self.loads += 1
+        return len(rows)
+    
+    @staticmethod
+    def compile(rows):
+        """规则行编译为 (角色集合, 分类集合, {(角色, 分类): LoanPolicy})"""
+        rules = {(row['role'], row['category']): row for row in rows}
+        roles = {role for role, _ in rules} | {'*'}
+        categories = {category for _, category in rules} | {'*'}
+        defaults = LoanPolicy(LOAN_DAYS, LOAN_MAX_ACTIVE, FINE_PER_DAY)
+        table = {}
+        for role in roles:
+            for category in categories:
+                chain = [rules[key] for key in ((role, category), (role, '*'), ('*', category), ('*', '*'))
+                         if key in rules]
+                table[(role, category)] = LoanPolicy(*(
+                    next((row[field] for row in chain if row[field] is not None), defaults[i])
+                    for i, field in enumerate(LoanPolicy._fields)))
+        return frozenset(roles), frozenset(categories), table
+    
+    def load_main(self):
+        """从总馆数据库加载规则（可在任意分馆的请求中调用）"""
+        pool = get_pool(DATABASE)
+        conn = pool.acquire()
+        try:
+            return self.load(conn)
+        finally:
+            pool.release(conn)
+    
+    def lookup(self, role, category):
+        """读者角色和图书分类对应的规则（首次调用时从总馆加载）"""
+        compiled = self._compiled
+        if compiled is None:
+            self.load_main()
+            compiled = self._compiled
+        _, roles, categories, table = compiled
+        return table[(role if role in roles else '*', category if category in categories else '*')]
+    
+    def overrides(self, role):
+        """该角色下与其默认规则不同的分类规则，[(分类, LoanPolicy)]"""
+        base = self.lookup(role, '*')
+        _, _, categories, _ = self._compiled
+        result = []
+        for category in sorted(categories - {'*'}):
+            policy = self.lookup(role, category)
+            if policy != base:
+                result.append((category, policy))
+        return result
+    
+    def version(self):
+        """已加载规则的版本号（首次调用时从总馆加载）"""
+        if self._compiled is None:
+            self.load_main()
+        return self._compiled[0]
+    
+    def reload_if_changed(self, db):
+        """其他进程修改规则后重新加载，返回加载的规则条数（未变化时为0）；db须为总馆连接"""
+        compiled = self._compiled
+        version = db.execute(
+            "SELECT version FROM change_counters WHERE name = 'loan_policies'").fetchone()[0]
+        if compiled is not None and compiled[0] == version:
+            return 0
+        return self.load(db)
+    
+    def info(self):
+        """运行指标：当前版本、查找表条目数、加载次数"""
+        compiled = self._compiled
+        return {
+            'version': compiled[0] if compiled else None,
+            'entries': len(compiled[3]) if compiled else 0,
+            'loads': self.loads,
+        }
+
+loan_policies = PolicyTable()
+
+def reload_loan_policies(db):
+    """后台任务：检查规则版本，有变化时重新加载"""
+    return loan_policies.reload_if_changed(db)
+
+def check_loan_limit(policy, active_loans):
+    """按规则检查读者当前的在借总数，超出时抛出LoanError
+    
+    max_loans取自所借图书分类对应的规则，为0表示该分类不外借
+    """
+    if policy.max_loans <= 0:
+        raise LoanError('该图书仅限馆内阅览，不能外借', 'warning', 'limit')
+    if active_loans >= policy.max_loans:
+        raise LoanError(f'最多只能同时借阅{policy.max_loans}本书', 'warning', 'limit')
+
+def _borrow(db, user_id, book_id):
+    """借书事务主体"""
+    book = db.execute('SELECT id, title, category FROM books WHERE id = ?', (book_id,)).fetchone()
+    if not book:
+        raise LoanError('图书不存在', 'danger', 'not_found')
+    
+    # 检查用户是否已借阅该图书且未归还
+    existing_loan = db.execute('''
+        SELECT id FROM loans 
+        WHERE user_id = ? AND book_id = ? AND is_returned = 0
+    ''', (user_id, book_id)).fetchone()
+    if existing_loan:
+        raise LoanError('您已经借阅了这本书', 'warning', 'duplicate')
+    
+    # 检查用户当前借阅数量（规则按读者角色和图书分类从内存查找表中取得）
+    patron = db.execute('''
+        SELECT role, (SELECT COUNT(*) FROM loans WHERE user_id = users.id AND is_returned = 0) AS count
+        FROM users WHERE id = ?
+    ''', (user_id,)).fetchone()
+    if not patron:
+        raise LoanError('用户不存在', 'danger', 'not_found')
+    policy = loan_policies.lookup(patron['role'], book['category'])
+    check_loan_limit(policy, patron['count'])
+    
+    # 预约到书的读者直接取走为其保留的副本
+    cursor = db.execute('''
+        UPDATE holds SET status = 'fulfilled'
+        WHERE user_id = ? AND book_id = ? AND status = 'ready'
+    ''', (user_id, book_id))
+    if cursor.rowcount == 0:
+        # 条件扣减库存，影响行数为0说明已无库存
+        cursor = db.execute('''
+            UPDATE books 
+            SET available_copies = available_copies - 1 
+            WHERE id = ? AND available_copies > 0
+        ''', (book_id,))
+        if cursor.rowcount == 0:
+            raise LoanError('该图书暂无库存，可以预约排队', 'warning', 'unavailable')
+    
+    # 创建借阅记录，罚金标准随借阅记录保存；借阅日期与应还、归还日期一样使用本地时间
+    now = datetime.now()
+    due_date = (now + timedelta(days=policy.loan_days)).strftime('%Y-%m-%d %H:%M:%S')
+    cursor = db.execute('''
+        INSERT INTO loans (user_id, book_id, loan_date, due_date, fine_per_day)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, book_id, now.strftime('%Y-%m-%d %H:%M:%S'), due_date, policy.fine_per_day))
+    
+    return {'loan_id': cursor.lastrowid, 'book_id': book_id, 'title': book['title'], 'due_date': due_date,
+            'loan_days': policy.loan_days}
+
+def _return(db, loan_id, user_id):
+    """还书事务主体，返回 (逾期费用, 图书id)"""
+    loan = db.execute('''
+        SELECT book_id, due_date, is_returned, fine_per_day FROM loans 
+        WHERE id = ? AND user_id = ?
+    ''', (loan_id, user_id)).fetchone()
+    if not loan:
+        raise LoanError('借阅记录不存在', 'danger', 'not_found')
+    
+    current_date = datetime.now()
+    fine_amount = overdue_fine(loan['due_date'], current_date, loan['fine_per_day'])
+    
+    # 条件更新，防止重复归还
+    cursor = db.execute('''
+        UPDATE loans 
+        SET is_returned = 1, return_date = ?, fine_amount = ?, is_overdue = 0, accrued_fine = 0
+        WHERE id = ? AND is_returned = 0
+    ''', (current_date.strftime('%Y-%m-%d %H:%M:%S'), fine_amount, loan_id))
+    if cursor.rowcount == 0:
+        raise LoanError('该图书已归还', 'warning', 'returned')
+    
+    # 有人排队时副本直接保留给队首读者，否则放回库存
+    _release_copy(db, loan['book_id'], current_date)
+    
+    return fine_amount, loan['book_id']
+
+def overdue_fine(due_date, now, fine_per_day):
+    """按应还日期和借出时确定的罚金标准计算到now为止的逾期费用"""
+    due_date = parse_datetime(due_date)
+    if now <= due_date:
+        return 0
+    return (now - due_date).days * fine_per_day
+
+def _release_copy(db, book_id, now):
+    """把一个空出的副本分配给等待队列的队首，返回获得副本的预约id（无人排队时为None）"""
+    hold = db.execute('''
+        SELECT id FROM holds
+        WHERE book_id = ? AND status = 'waiting'
+        ORDER BY priority DESC, created_at, id
+        LIMIT 1
+    ''', (book_id,)).fetchone()
+    if hold is None:
+        db.execute('UPDATE books SET available_copies = available_copies + 1 WHERE id = ?', (book_id,))
+        return None
+    
+    db.execute('''
+        UPDATE holds SET status = 'ready', ready_at = ?, expires_at = ?
+        WHERE id = ?
+    ''', (now.strftime('%Y-%m-%d %H:%M:%S'),
+          (now + timedelta(days=HOLD_PICKUP_DAYS)).strftime('%Y-%m-%d %H:%M:%S'), hold['id']))
+    return hold['id']
+
+def _place_hold(db, user_id, book_id):
+    """预约事务主体，返回预约id和排队位置"""
+    book = db.execute('SELECT id, title, available_copies FROM books WHERE id = ?', (book_id,)).fetchone()
+    if not book:
+        raise LoanError('图书不存在', 'danger', 'not_found')
+    if book['available_copies'] > 0:
+        raise LoanError('该图书有库存，可以直接借阅', 'info', 'available')
+    
+    if db.execute('''
+        SELECT id FROM loans WHERE user_id = ? AND book_id = ? AND is_returned = 0
+    ''', (user_id, book_id)).fetchone():
+        raise LoanError('您已经借阅了这本书', 'warning', 'duplicate')
+    
+    holds = db.execute('''
+        SELECT book_id FROM holds WHERE user_id = ? AND status IN ('waiting', 'ready')
+    ''', (user_id,)).fetchall()
+    if any(hold['book_id'] == book_id for hold in holds):
+        raise LoanError('您已经预约了这本书', 'warning', 'duplicate')
+    if len(holds) >= HOLD_MAX_PER_USER:
+        raise LoanError(f'最多只能同时预约{HOLD_MAX_PER_USER}本书', 'warning', 'limit')
+    
+    cursor = db.execute('''
+        INSERT INTO holds (user_id, book_id, priority)
+        SELECT id, ?, hold_priority FROM users WHERE id = ?
+    ''', (book_id, user_id))
+    hold_id = cursor.lastrowid
+    return {'hold_id': hold_id, 'book_id': book_id, 'title': book['title'],
+            'position': hold_position(db, hold_id)}
+
+def _cancel_hold(db, hold_id, user_id):
+    """取消预约事务主体，返回图书id；已到书的预约取消后副本转给下一位"""
+    hold = db.execute('''
+        SELECT book_id, status FROM holds WHERE id = ? AND user_id = ?
+    ''', (hold_id, user_id)).fetchone()
+    if not hold:
+        raise LoanError('预约记录不存在', 'danger', 'not_found')
+    
+    cursor = db.execute('''
+        UPDATE holds SET status = 'cancelled'
+        WHERE id = ? AND status IN ('waiting', 'ready')
+    ''', (hold_id,))
+    if cursor.rowcount == 0:
+        raise LoanError('该预约已结束', 'warning', 'returned')
+    if hold['status'] == 'ready':
+        _release_copy(db, hold['book_id'], datetime.now())
+    return hold['book_id']
+
+# 预约h在队列中的位置（从1开始）：排在前面的是优先级更高、或同优先级更早提交的预约
+HOLD_POSITION_SQL = '''(
+    SELECT COUNT(*) + 1 FROM holds q
+    WHERE q.book_id = h.book_id AND q.status = 'waiting'
+      AND (q.priority > h.priority
+           OR (q.priority = h.priority AND (q.created_at, q.id) < (h.created_at, h.id)))
+)'''
+
+def hold_position(db, hold_id):
+    """预约在队列中的位置，不在等待中时返回None"""
+    row = db.execute(f'''
+        SELECT {HOLD_POSITION_SQL} AS position
+        FROM holds h WHERE h.id = ? AND h.status = 'waiting'
+    ''', (hold_id,)).fetchone()
+    return row['position'] if row else None
+
+def borrow(db, user_id, book_id):
+    """借书（原子事务），失败时抛出LoanError"""
+    loan = run_transaction(db, _borrow, user_id, book_id)
+    audit_log.record('borrow', user_id, book_id, loan['loan_id'], due_date=loan['due_date'])
+    return loan
+
+def return_loan(db, loan_id, user_id):
+    """还书（原子事务），返回逾期费用，失败时抛出LoanError"""
+    fine_amount, book_id = run_transaction(db, _return, loan_id, user_id)
+    audit_loan_return(user_id, book_id, loan_id, fine_amount)
+    return fine_amount
+
+def audit_loan_return(user_id, book_id, loan_id, fine_amount):
+    """记录还书事件，有逾期费用时另记一条罚金事件"""
+    audit_log.record('return', user_id, book_id, loan_id)
+    if fine_amount:
+        audit_log.record('fine', user_id, book_id, loan_id, amount=fine_amount)
+
+def place_hold(db, user_id, book_id):
+    """预约图书（原子事务），失败时抛出LoanError"""
+    hold = run_transaction(db, _place_hold, user_id, book_id)
+    audit_log.record('hold', user_id, book_id, hold_id=hold['hold_id'])
+    return hold
+
+def cancel_hold(db, hold_id, user_id):
+    """取消预约（原子事务），失败时抛出LoanError"""
+    book_id = run_transaction(db, _cancel_hold, hold_id, user_id)
+    audit_log.record('hold_cancel', user_id, book_id, hold_id=hold_id)
+
+def resolve_desk_items(db, items):
+    """解析借还书台扫描的条目：整数（或不足10位的数字串）为图书id，其余按ISBN查找
+    
+    返回与items等长的列表，元素为图书行，无法解析时为LoanError
+    """
+    parsed, ids, keys = [], set(), set()
+    for item in items:
+        if isinstance(item, int) and not isinstance(item, bool):
+            parsed.append(('id', item))
+            ids.add(item)
+        elif isinstance(item, str) and item.strip().isdigit() and len(item.strip()) < 10:
+            parsed.append(('id', int(item)))
+            ids.add(int(item))
+        elif isinstance(item, str) and item.strip():
+            try:
+                lookup = isbn_lookup_keys(normalize_isbn(item))
+            except ValueError:
+                # 校验位不对的旧数据按与ISBN_KEY_SQL相同的规则匹配
+                lookup = [item.upper().replace('-', '').replace(' ', '')]
+            parsed.append(('isbn', lookup))
+            keys.update(lookup)
+        else:
+            parsed.append(('error', LoanError('条目应为图书id或ISBN', 'danger', 'invalid')))
+    
+    by_id, by_key = {}, {}
+    if ids:
+        placeholders = ','.join('?' * len(ids))
+        for row in db.execute(f'SELECT id, title, category FROM books WHERE id IN ({placeholders})', list(ids)):
+            by_id[row['id']] = row
+    if keys:
+        placeholders = ','.join('?' * len(keys))
+        for row in db.execute(f'SELECT id, title, category, {ISBN_KEY_SQL} AS isbn_key FROM books '
+                              f'WHERE {ISBN_KEY_SQL} IN ({placeholders})', list(keys)):
+            by_key.setdefault(row['isbn_key'], row)
+    
+    books = []
+    for kind, value in parsed:
+        if kind == 'error':
+            books.append(value)
+            continue
+        if kind == 'id':
+            book = by_id.get(value)
+        else:
+            book = next((by_key[key] for key in value if key in by_key), None)
+        books.append(book or LoanError('图书不存在', 'danger', 'not_found'))
+    return books
+
+def _desk_error(item, error):
+    """批量借还中单个条目的失败结果"""
+    return {'item': item, 'ok': False, 'code': error.code, 'error': error.message}
+
+def _checkout_batch(db, user_id, items):
+    """批量借书事务主体：读者的在借记录和到书预约只查询一次，借阅规则查内存表，逐项返回结果
+    
+    单项失败（无库存、重复借阅、超出上限等）不影响其他条目。
+    """
+    patron = db.execute('SELECT role FROM users WHERE id = ? AND is_active = 1', (user_id,)).fetchone()
+    if not patron:
+        raise LoanError('读者不存在或已停用', 'danger', 'not_found')
+    
+    books = resolve_desk_items(db, items)
+    active = {row['book_id'] for row in db.execute(
+        'SELECT book_id FROM loans WHERE user_id = ? AND is_returned = 0', (user_id,))}
+    ready = {row['book_id'] for row in db.execute(
+        "SELECT book_id FROM holds WHERE user_id = ? AND status = 'ready'", (user_id,))}
+    now = datetime.now()
+    
+    results = []
+    for item, book in zip(items, books):
+        if isinstance(book, LoanError):
+            results.append(_desk_error(item, book))
+            continue
+        book_id = book['id']
+        if book_id in active:
+            results.append(_desk_error(item, LoanError('读者已经借阅了这本书', 'warning', 'duplicate')))
+            continue
+        policy = loan_policies.lookup(patron['role'], book['category'])
+        try:
+            check_loan_limit(policy, len(active))
+        except LoanError as e:
+            results.append(_desk_error(item, e))
+            continue
+    
+        if book_id in ready:
+            db.execute('''
+                UPDATE holds SET status = 'fulfilled'
+                WHERE user_id = ? AND book_id = ? AND status = 'ready'
+            ''', (user_id, book_id))
+            ready.discard(book_id)
+        elif db.execute('''
+            UPDATE books SET available_copies = available_copies - 1
+            WHERE id = ? AND available_copies > 0
+        ''', (book_id,)).rowcount == 0:
+            results.append(_desk_error(item, LoanError('该图书暂无库存', 'warning', 'unavailable')))
+            continue
+    
+        due_date = (now + timedelta(days=policy.loan_days)).strftime('%Y-%m-%d %H:%M:%S')
+        cursor = db.execute('''
+            INSERT INTO loans (user_id, book_id, loan_date, due_date, fine_per_day) VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, book_id, now.strftime('%Y-%m-%d %H:%M:%S'), due_date, policy.fine_per_day))
+        active.add(book_id)
+        results.append({'item': item, 'ok': True, 'book_id': book_id, 'title': book['title'],
+                        'loan_id': cursor.lastrowid, 'due_date': due_date})
+    return results
+
+def _checkin_batch(db, user_id, items):
+    """批量还书事务主体：读者的相关在借记录一次查出，逐项返回结果与逾期费用"""
+    books = resolve_desk_items(db, items)
+    book_ids = list({book['id'] for book in books if not isinstance(book, LoanError)})
+    loans = {}
+    if book_ids:
+        placeholders = ','.join('?' * len(book_ids))
+        loans = {row['book_id']: row for row in db.execute(f'''
+            SELECT id, book_id, due_date, fine_per_day FROM loans
+            WHERE user_id = ? AND is_returned = 0 AND book_id IN ({placeholders})
+        ''', [user_id] + book_ids)}
+    now = datetime.now()
+    
+    results = []
+    for item, book in zip(items, books):
+        if isinstance(book, LoanError):
+            results.append(_desk_error(item, book))
+            continue
+        # 同一本书扫描两次时，第二次按“未借阅”处理
+        loan = loans.pop(book['id'], None)
+        if loan is None:
+            results.append(_desk_error(item, LoanError('读者没有在借这本书', 'warning', 'not_found')))
+            continue
+    
+        fine_amount = overdue_fine(loan['due_date'], now, loan['fine_per_day'])
+        db.execute('''
+            UPDATE loans
+            SET is_returned = 1, return_date = ?, fine_amount = ?, is_overdue = 0, accrued_fine = 0
+            WHERE id = ?
+        ''', (now.strftime('%Y-%m-%d %H:%M:%S'), fine_amount, loan['id']))
+        # hold_id不为空时，这本书应放到预约取书架而不是上架
+        hold_id = _release_copy(db, book['id'], now)
+        results.append({'item': item, 'ok': True, 'book_id': book['id'], 'title': book['title'],
+                        'loan_id': loan['id'], 'fine_amount': fine_amount, 'hold_id': hold_id})
+    return results
+
+def checkout_batch(db, user_id, items):
+    """批量借书（单个事务），返回逐项结果；读者无效时抛出LoanError"""
+    results = run_transaction(db, _checkout_batch, user_id, items)
+    for result in results:
+        if result['ok']:
+            audit_log.record('borrow', user_id, result['book_id'], result['loan_id'], due_date=result['due_date'])
+    return results
+
+def checkin_batch(db, user_id, items):
+    """批量还书（单个事务），返回逐项结果"""
+    results = run_transaction(db, _checkin_batch, user_id, items)
+    for result in results:
+        if result['ok']:
+            audit_loan_return(user_id, result['book_id'], result['loan_id'], result['fine_amount'])
+    return results
+
+def _expire_holds(db, now):
+    """到书后逾期未取的预约作废，副本转给下一位，返回作废数量"""
+    expired = db.execute('''
+        SELECT id, book_id FROM holds
+        WHERE status = 'ready' AND expires_at < ?
+    ''', (now.strftime('%Y-%m-%d %H:%M:%S'),)).fetchall()
+    for hold in expired:
+        db.execute("UPDATE holds SET status = 'expired' WHERE id = ?", (hold['id'],))
+        _release_copy(db, hold['book_id'], now)
+    return len(expired)
+
+def expire_holds(db, now=None):
+    """处理过期未取的预约（原子事务）"""
+    return run_transaction(db, _expire_holds, now or datetime.now())
+
+def _refresh_overdue(db, now):
+    """批量更新逾期状态与应计罚金，返回发生变化的借阅数"""
+    now_str = now.strftime('%Y-%m-%d %H:%M:%S')
+    # 逾期整天数 × 借出时确定的每天罚金，与归还时的计算方式一致
+    cursor = db.execute('''
+        UPDATE loans
+        SET is_overdue = 1,
+            accrued_fine = CAST(julianday(:now) - julianday(due_date) AS INTEGER) * fine_per_day
+        WHERE is_returned = 0 AND due_date < :now
+          AND (is_overdue = 0
+               OR accrued_fine != CAST(julianday(:now) - julianday(due_date) AS INTEGER) * fine_per_day)
+    ''', {'now': now_str})
+    changed = cursor.rowcount
+    db.execute('''
+        UPDATE library_stats
+        SET value = (SELECT COUNT(*) FROM loans WHERE is_returned = 0 AND is_overdue = 1)
+        WHERE name = 'overdue_loans'
+    ''')
+    return changed
+
+def refresh_overdue(db, now=None):
+    """重新计算逾期状态（原子事务）"""
+    return run_transaction(db, _refresh_overdue, now or datetime.now())
+
+def suggestion_terms(title, author):
+    """图书的前缀索引词：归一化书名、作者及书名拼音首字母"""
+    terms = {fold_text(title), fold_text(author), pinyin_initials(title)}
+    terms.discard('')
+    return terms
+
+def suggestion_prefixes(term):
+    """索引词的各个前缀（长度1到SUGGEST_PREFIX_LENGTH）"""
+    return {term[:length] for length in range(1, SUGGEST_PREFIX_LENGTH + 1)}
+
+def _refresh_suggestions(db, limit):
+    """处理一批待更新的图书，返回处理数量"""
+    book_ids = [row[0] for row in db.execute('SELECT book_id FROM suggest_dirty LIMIT ?', (limit,))]
+    if not book_ids:
+        return 0
+    
+    placeholders = ','.join('?' * len(book_ids))
+    books = db.execute(f'SELECT id, title, author, loan_count FROM books WHERE id IN ({placeholders})',
+                       book_ids).fetchall()
+    db.execute(f'DELETE FROM book_suggestions WHERE book_id IN ({placeholders})', book_ids)
+    db.executemany('INSERT INTO book_suggestions (prefix, term, book_id, loan_count) VALUES (?, ?, ?, ?)',
+                   ((prefix, term, book[0], book[3])
+                    for book in books
+                    for term in suggestion_terms(book[1], book[2])
+                    for prefix in suggestion_prefixes(term)))
+    db.execute(f'DELETE FROM suggest_dirty WHERE book_id IN ({placeholders})', book_ids)
+    return len(book_ids)
+
+def refresh_suggestions(db, limit=SUGGEST_BATCH_SIZE, drain=False):
+    """更新搜索建议索引，drain为True时处理完所有待更新图书"""
+    total = 0
+    while True:
+        processed = run_transaction(db, _refresh_suggestions, limit)
+        total += processed
+        if not drain or processed < limit:
+            return total
+
+def _refresh_rollups(db, limit):
+    """把一批借出/归还事件累加到汇总表，返回处理的事件数"""
+    last_id = db.execute('''
+        SELECT MAX(id) FROM (SELECT id FROM loan_events ORDER BY id LIMIT ?)
+    ''', (limit,)).fetchone()[0]
+    if last_id is None:
+        return 0
+    
+    db.execute('''
+        INSERT INTO circulation_monthly (month, category, loans)
+        SELECT substr(l.loan_date, 1, 7), COALESCE(b.category, '未分类'), COUNT(*)
+        FROM loan_events e
+        JOIN loans l ON l.id = e.loan_id
+        JOIN books b ON b.id = l.book_id
+        WHERE e.id <= ? AND e.kind = 'loan'
+        GROUP BY 1, 2
+        ON CONFLICT (month, category) DO UPDATE SET loans = loans + excluded.loans
+    ''', (last_id,))
+    db.execute('''
+        INSERT INTO circulation_monthly (month, category, returns, loan_days, late_returns, fines)
+        SELECT substr(l.return_date, 1, 7), COALESCE(b.category, '未分类'), COUNT(*),
+               SUM(julianday(l.return_date) - julianday(l.loan_date)),
+               SUM(l.return_date > l.due_date), SUM(COALESCE(l.fine_amount, 0))
+        FROM loan_events e
+        JOIN loans l ON l.id = e.loan_id
+        JOIN books b ON b.id = l.book_id
+        WHERE e.id <= ? AND e.kind = 'return' AND l.return_date IS NOT NULL
+        GROUP BY 1, 2
+        ON CONFLICT (month, category) DO UPDATE SET
+            returns = returns + excluded.returns,
+            loan_days = loan_days + excluded.loan_days,
+            late_returns = late_returns + excluded.late_returns,
+            fines = fines + excluded.fines
+    ''', (last_id,))
+    db.execute('''
+        INSERT INTO borrower_monthly (month, user_id, loans)
+        SELECT substr(l.loan_date, 1, 7), l.user_id, COUNT(*)
+        FROM loan_events e
+        JOIN loans l ON l.id = e.loan_id
+        WHERE e.id <= ? AND e.kind = 'loan'
+        GROUP BY 1, 2
+        ON CONFLICT (month, user_id) DO UPDATE SET loans = loans + excluded.loans
+    ''', (last_id,))
+    cursor = db.execute('DELETE FROM loan_events WHERE id <= ?', (last_id,))
+    db.execute('''
+        INSERT INTO library_stats (name, value) VALUES ('rollup_refreshed_at', strftime('%s', 'now'))
+        ON CONFLICT (name) DO UPDATE SET value = excluded.value
+    ''')
+    return cursor.rowcount
+
+def refresh_rollups(db, limit=ROLLUP_BATCH_SIZE, drain=False):
+    """增量更新借阅统计汇总表，drain为True时处理完所有事件"""
+    total = 0
+    while True:
+        processed = run_transaction(db, _refresh_rollups, limit)
+        total += processed
+        if not drain or processed < limit:
+            return total
+
+def report_months(start=None, end=None, today=None):
+    """解析报表的月份范围（YYYY-MM），默认最近REPORT_DEFAULT_MONTHS个月"""
+    today = today or date.today()
+    try:
+        end = datetime.strptime(end, '%Y-%m').date() if end else today.replace(day=1)
+        if start:
+            start = datetime.strptime(start, '%Y-%m').date()
+        else:
+            months = end.year * 12 + end.month - REPORT_DEFAULT_MONTHS
+            start = date(months // 12, months % 12 + 1, 1)
+    except ValueError:
+        raise ValueError('月份格式应为YYYY-MM')
+    if start > end:
+        raise ValueError('开始月份不能晚于结束月份')
+    return start.strftime('%Y-%m'), end.strftime('%Y-%m')
+
+def circulation_report(db, start, end, top=10):
+    """借阅统计报表：每月各分类借出数、周转率、平均借阅天数、借阅最多的读者
+    
+    只读取汇总表，与借阅记录和馆藏总量无关。周转率 = 期间借出次数 / 该分类当前馆藏册数。
+    """
+    monthly = db.execute('''
+        SELECT month, category, loans, returns, loan_days, late_returns, fines
+        FROM circulation_monthly
+        WHERE month BETWEEN ? AND ?
+        ORDER BY month, category
+    ''', (start, end)).fetchall()
+    
+    categories = {}
+    for row in monthly:
+        totals = categories.setdefault(row['category'], {'loans': 0, 'returns': 0, 'loan_days': 0.0,
+                                                         'late_returns': 0, 'fines': 0.0})
+        for key in totals:
+            totals[key] += row[key]
+    
+    copies = {row['category']: row['copies']
+              for row in db.execute('SELECT category, copies FROM category_copies')}
+    for category, totals in categories.items():
+        totals['copies'] = copies.get(category, 0)
+        totals['turnover'] = round(totals['loans'] / totals['copies'], 2) if totals['copies'] else None
+        totals['avg_loan_days'] = round(totals['loan_days'] / totals['returns'], 1) if totals['returns'] else None
+        totals['late_rate'] = round(totals['late_returns'] / totals['returns'], 3) if totals['returns'] else None
+    
+    loans = sum(totals['loans'] for totals in categories.values())
+    returns = sum(totals['returns'] for totals in categories.values())
+    top_borrowers = db.execute('''
+        SELECT b.user_id, u.username, SUM(b.loans) AS loans
+        FROM borrower_monthly b
+        JOIN users u ON u.id = b.user_id
+        WHERE b.month BETWEEN ? AND ?
+        GROUP BY b.user_id
+        ORDER BY loans DESC, b.user_id
+        LIMIT ?
+    ''', (start, end, top)).fetchall()
+    refreshed = db.execute("SELECT value FROM library_stats WHERE name = 'rollup_refreshed_at'").fetchone()
+    
+    return {
+        'start': start,
+        'end': end,
+        'months': sorted({row['month'] for row in monthly}),
+        'monthly': [dict(row) for row in monthly],
+        'categories': categories,
+        'total_loans': loans,
+        'total_returns': returns,
+        'avg_loan_days': round(sum(t['loan_days'] for t in categories.values()) / returns, 1) if returns else None,
+        'late_rate': round(sum(t['late_returns'] for t in categories.values()) / returns, 3) if returns else None,
+        'top_borrowers': [dict(row) for row in top_borrowers],
+        'refreshed_at': datetime.fromtimestamp(refreshed['value']).strftime('%Y-%m-%d %H:%M:%S') if refreshed else None,
+    }
+
+NOTIFY_TEMPLATES = {
+    'due_soon': ('借阅即将到期', '{username}，您借阅的《{title}》将于{date}到期，请按时归还。'),
+    'overdue': ('借阅已逾期', '{username}，您借阅的《{title}》已于{date}到期，逾期每天收取{fine_per_day:g}元费用，请尽快归还。'),
+    'hold_ready': ('预约图书已到', '{username}，您预约的《{title}》已到书，请在{date}前借阅。'),
+}
+
+def _schedule_notifications(db, now):
+    """扫描即将到期、已逾期的借阅和已到书的预约，把尚未生成的提醒写入发件箱
+    
+    每条提醒有去重键：到期提醒每笔借阅一次，逾期提醒每NOTIFY_OVERDUE_REPEAT_DAYS天一次。
+    """
+    now_text = now.strftime('%Y-%m-%d %H:%M:%S')
+    soon_text = (now + timedelta(days=NOTIFY_DUE_SOON_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    overdue_key = f"'overdue:' || l.id || ':' || CAST((julianday(?) - julianday(l.due_date)) / {NOTIFY_OVERDUE_REPEAT_DAYS} AS INTEGER)"
+    candidates = db.execute(f'''
+        SELECT 'due_soon' AS kind, 'due_soon:' || l.id AS dedup_key, l.user_id, l.due_date AS date,
+               b.title, u.username, COALESCE(u.email, u.username) AS recipient, l.fine_per_day
+        FROM loans l
+        JOIN books b ON b.id = l.book_id
+        JOIN users u ON u.id = l.user_id
+        WHERE l.is_returned = 0 AND l.due_date >= ? AND l.due_date < ?
+          AND NOT EXISTS (SELECT 1 FROM notifications n WHERE n.dedup_key = 'due_soon:' || l.id)
+        UNION ALL
+        SELECT 'overdue', {overdue_key}, l.user_id, l.due_date,
+               b.title, u.username, COALESCE(u.email, u.username), l.fine_per_day
+        FROM loans l
+        JOIN books b ON b.id = l.book_id
+        JOIN users u ON u.id = l.user_id
+        WHERE l.is_returned = 0 AND l.due_date < ?
+          AND NOT EXISTS (SELECT 1 FROM notifications n WHERE n.dedup_key = {overdue_key})
+        UNION ALL
+        SELECT 'hold_ready', 'hold_ready:' || h.id, h.user_id, h.expires_at,
+               b.title, u.username, COALESCE(u.email, u.username), NULL
+        FROM holds h
+        JOIN books b ON b.id = h.book_id
+        JOIN users u ON u.id = h.user_id
+        WHERE h.status = 'ready' AND h.expires_at > ?
+          AND NOT EXISTS (SELECT 1 FROM notifications n WHERE n.dedup_key = 'hold_ready:' || h.id)
+    ''', (now_text, soon_text, now_text, now_text, now_text, now_text)).fetchall()
+    
+    rows = []
+    for row in candidates:
+        subject, body = NOTIFY_TEMPLATES[row['kind']]
+        rows.append((row['user_id'], row['kind'], row['dedup_key'], row['recipient'], subject,
+                     body.format(username=row['username'], title=row['title'], date=row['date'][:10],
+                                 fine_per_day=row['fine_per_day']),
+                     now_text))
+    db.executemany('''
+        INSERT OR IGNORE INTO notifications (user_id, kind, dedup_key, recipient, subject, body, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    return len(rows)
+
+def schedule_notifications(db, now=None):
+    """生成到期/逾期/到书提醒（原子事务），返回新增数量"""
+    return run_transaction(db, _schedule_notifications, now or datetime.now())
+
+class NotificationError(Exception):
+    """通知发送失败；permanent为True时不再重试"""
+    
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+class FileTransport:
+    """把通知按天追加到JSON Lines文件，供开发调试或交给外部程序投递"""
+    
+    def __init__(self, directory=NOTIFY_OUTBOX_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    def send(self, notification):
+        path = os.path.join(self.directory, f'{datetime.now():%Y-%m-%d}.jsonl')
+        line = json.dumps({
+            'id': notification['id'],
+            'to': notification['recipient'],
+            'subject': notification['subject'],
+            'body': notification['body'],
+            'sent_at': datetime.now().isoformat(timespec='seconds'),
+        }, ensure_ascii=False)
+        try:
+            with self._lock, open(path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            raise NotificationError(str(e))
+
+class SMTPTransport:
+    """通过SMTP发送邮件，每封邮件一个连接"""
+    
+    def __init__(self, host=NOTIFY_SMTP_HOST, port=NOTIFY_SMTP_PORT, sender=NOTIFY_SMTP_SENDER, timeout=10):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.timeout = timeout
+    
+    def send(self, notification):
+        if '@' not in notification['recipient']:
+            raise NotificationError('用户没有邮箱地址', permanent=True)
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = notification['recipient']
+        message['Subject'] = notification['subject']
+        message.set_content(notification['body'])
+        try:
+            with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+                smtp.send_message(message)
+        except smtplib.SMTPRecipientsRefused as e:
+            raise NotificationError(f'收件人被拒绝: {e}', permanent=True)
+        except (OSError, smtplib.SMTPException) as e:
+            raise NotificationError(str(e))
+
+NOTIFY_TRANSPORTS = {
+    'file': FileTransport,
+    'smtp': SMTPTransport,
+}
+
+class RateLimiter:
+    """令牌桶限速，多个线程共享"""
+    
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+def _claim_notifications(db, now, limit):
+    """领取一批到期的通知并加租约；租约过期（发送进程崩溃）的会被重新领取"""
+    return db.execute('''
+        UPDATE notifications
+        SET status = 'sending', attempts = attempts + 1, next_attempt_at = ?
+        WHERE id IN (
+            SELECT id FROM notifications
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+            ORDER BY next_attempt_at, id
+            LIMIT ?
+        )
+        RETURNING id, user_id, kind, recipient, subject, body, attempts
+    ''', ((now + timedelta(seconds=NOTIFY_LEASE_SECONDS)).strftime('%Y-%m-%d %H:%M:%S'),
+          now.strftime('%Y-%m-%d %H:%M:%S'), limit)).fetchall()
+
+def _record_deliveries(db, sent, retry, failed):
+    """批量写回发送结果"""
+    db.executemany("UPDATE notifications SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?", sent)
+    db.executemany("UPDATE notifications SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+                   retry)
+    db.executemany("UPDATE notifications SET status = 'failed', last_error = ? WHERE id = ?", failed)
+
+class NotificationDispatcher:
+    """通知发送器
+    
+    调度线程从发件箱按批领取通知，交给工作线程通过transport并发发送（共享限速），
+    一批发送完后把结果在一个事务中写回。全部在后台线程中进行，不占用请求处理。
+    """
+    
+    def __init__(self, transport=None, workers=NOTIFY_WORKERS, rate=NOTIFY_RATE_PER_SECOND,
+                 batch_size=NOTIFY_BATCH_SIZE):
+        self.transport = transport or NOTIFY_TRANSPORTS[NOTIFY_TRANSPORT]()
+        self.workers = workers
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate)
+        self._tasks = queue.Queue()
+        self._results = []
+        self._results_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self._started = time.monotonic()
+        self._stats = {'batches': 0, 'claimed': 0, 'sent': 0, 'retried': 0, 'failed': 0, 'send_seconds': 0.0}
+    
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for key, value in deltas.items():
+                self._stats[key] += value
+    
+    def _deliver(self, notification):
+        """发送一条通知并记录结果"""
+        self.limiter.acquire()
+        start = time.perf_counter()
+        error = None
+        try:
+            self.transport.send(notification)
+        except NotificationError as e:
+            error = e
+        except Exception as e:
+            # transport的意外错误按可重试处理，避免工作线程退出
+            error = NotificationError(f'{type(e).__name__}: {e}')
+        elapsed = time.perf_counter() - start
+        with self._results_lock:
+            self._results.append((notification, error))
+        self._count(send_seconds=elapsed)
+    
+    def _worker(self):
+        while True:
+            notification = self._tasks.get()
+            try:
+                if notification is None:
+                    return
+                self._deliver(notification)
+            finally:
+                self._tasks.task_done()
+    
+    def _flush(self, db):
+        """把已完成的发送结果写回数据库"""
+        with self._results_lock:
+            results, self._results = self._results, []
+        if not results:
+            return
+        now = datetime.now()
+        sent, retry, failed = [], [], []
+        for notification, error in results:
+            if error is None:
+                sent.append((now.strftime('%Y-%m-%d %H:%M:%S'), notification['id']))
+            elif error.permanent or notification['attempts'] >= NOTIFY_MAX_ATTEMPTS:
+                failed.append((str(error), notification['id']))
+            else:
+                delay = NOTIFY_RETRY_DELAY * 2 ** (notification['attempts'] - 1)
+                retry.append(((now + timedelta(seconds=delay)).strftime('%Y-%m-%d %H:%M:%S'),
+                              str(error), notification['id']))
+        run_transaction(db, _record_deliveries, sent, retry, failed)
+        self._count(sent=len(sent), retried=len(retry), failed=len(failed))
+    
+    def _ensure_workers(self):
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f'notify-worker-{len(self._threads)}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def run_once(self, now=None, database=None):
+        """从一个分馆（默认为当前分馆）领取并发送一批通知，返回本批数量"""
+        self._ensure_workers()
+        pool = get_pool(database)
+        db = pool.acquire()
+        try:
+            batch = run_transaction(db, _claim_notifications, now or datetime.now(), self.batch_size)
+            for row in batch:
+                self._tasks.put(dict(row))
+            self._tasks.join()
+            self._flush(db)
+        finally:
+            pool.release(db)
+        self._count(batches=1 if batch else 0, claimed=len(batch))
+        return len(batch)
+    
+    def _loop(self):
+        while not self._stop.is_set():
+            claimed = 0
+            for branch_name, database in branch_databases().values():
+                try:
+                    claimed += self.run_once(database=database)
+                except sqlite3.Error as e:
+                    print(f"通知发送出错（{branch_name}）: {e}")
+            if not claimed:
+                self._stop.wait(NOTIFY_POLL_INTERVAL)
+    
+    def start(self):
+        """启动调度线程和工作线程"""
+        thread = threading.Thread(target=self._loop, name='notify-dispatcher', daemon=True)
+        thread.start()
+        return thread
+    
+    def stop(self):
+        """停止调度并等待工作线程退出"""
+        self._stop.set()
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+    
+    def stats(self):
+        """发送指标"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        elapsed = time.monotonic() - self._started
+        stats['transport'] = type(self.transport).__name__
+        stats['throughput_per_second'] = round(stats['sent'] / elapsed, 2) if elapsed else 0
+        stats['avg_send_ms'] = round(stats.pop('send_seconds') * 1000 / stats['claimed'], 3) if stats['claimed'] else 0
+        return stats
+
+class BackupRestarted(Exception):
+    """备份期间源数据库被其他连接写入，sqlite从头重新复制的次数过多"""
+
+backup_stats = {'snapshots': 0, 'restarts': 0, 'last_seconds': None, 'last_bytes': None, 'last_path': None}
+_backup_lock = threading.Lock()
+
+def database_path(db):
+    """连接的主数据库文件路径"""
+    return next(row[2] for row in db.execute('PRAGMA database_list') if row[1] == 'main')
+
+def snapshot_name(database, when=None):
+    """快照文件名：<数据库名>-<时间>.db.gz，按名称排序即按时间排序"""
+    stem = os.path.splitext(os.path.basename(database))[0]
+    return f'{stem}-{(when or datetime.now()):%Y%m%d-%H%M%S}.db.gz'
+
+def list_backups(database, directory=BACKUP_DIR):
+    """该数据库的全部快照路径，从旧到新"""
+    stem = os.path.splitext(os.path.basename(database))[0]
+    pattern = re.compile(re.escape(stem) + r'-\d{8}-\d{6}\.db\.gz')
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if pattern.fullmatch(name)]
+
+def rotate_backups(database, directory=BACKUP_DIR, keep=BACKUP_KEEP):
+    """只保留最新的keep份快照，返回删除的份数"""
+    expired = list_backups(database, directory)[:-keep] if keep > 0 else []
+    for path in expired:
+        os.remove(path)
+    return len(expired)
+
+def _copy_pages(db, target, pages, pause):
+    """按页分步复制，返回重启次数；源库被其他连接写入时sqlite会从第一页重新开始"""
+    state = {'remaining': None, 'restarts': 0}
+    
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > BACKUP_MAX_RESTARTS:
+                raise BackupRestarted(f'备份期间数据库被写入，已重启 {state["restarts"]} 次')
+        state['remaining'] = remaining
+        # 备份API的sleep只在某一步遇到锁（BUSY/LOCKED）时停顿，正常复制完一步不会停；
+        # 这里只在正常的步间停顿，遇锁的那一步已由sleep停过，不再重复。
+        # 两步之间不持有源库的锁，写入可以进行
+        if status == sqlite3.SQLITE_OK and remaining and pause:
+            time.sleep(pause)
+    
+    db.backup(target, pages=pages, progress=progress, sleep=pause)
+    return state['restarts']
+
+def backup_database(db, directory=BACKUP_DIR, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE):
+    """在线备份：用sqlite备份API把db复制为压缩快照，不阻塞读写
+    
+    WAL模式下一步复制完：只占用一个读快照，写入不受影响（分步复制反而会因
+    其他连接的写入不断从头重启）。回滚日志模式下每步复制pages页，步间停顿
+    pause秒让写入进行，反复重启时改为一步复制完。先写临时文件，完成后再改名，
+    目录中不会出现不完整的快照。返回快照信息。
+    """
+    start = time.perf_counter()
+    database = database_path(db)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, snapshot_name(database))
+    raw_path = path + '.tmp'
+    
+    if db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+        pages = -1
+    target = sqlite3.connect(raw_path)
+    try:
+        try:
+            restarts = _copy_pages(db, target, pages, pause)
+        except BackupRestarted:
+            restarts = BACKUP_MAX_RESTARTS + 1
+            db.backup(target)
+        # 快照改为回滚日志模式，单个文件即可打开
+        target.execute('PRAGMA journal_mode = DELETE')
+        page_count = target.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        target.close()
+    
+    try:
+        with open(raw_path, 'rb') as src, gzip.open(path + '.part', 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(path + '.part', path)
+        size = os.path.getsize(raw_path)
+    finally:
+        os.remove(raw_path)
+        if os.path.exists(path + '.part'):
+            os.remove(path + '.part')
+    
+    elapsed = time.perf_counter() - start
+    with _backup_lock:
+        backup_stats['snapshots'] += 1
+        backup_stats['restarts'] += restarts
+        backup_stats['last_seconds'] = round(elapsed, 3)
+        backup_stats['last_bytes'] = size
+        backup_stats['last_path'] = path
+    return {
+        'path': path,
+        'pages': page_count,
+        'bytes': size,
+        'compressed_bytes': os.path.getsize(path),
+        'restarts': restarts,
+        'seconds': elapsed,
+    }
+
+def open_snapshot(path, directory=None):
+    """把压缩快照解压到临时文件并打开，返回 (连接, 临时文件路径)，用完后由调用方关闭并删除"""
+    fd, raw_path = tempfile.mkstemp(suffix='.db', dir=directory)
+    with os.fdopen(fd, 'wb') as dst, gzip.open(path, 'rb') as src:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    conn = sqlite3.connect(raw_path, uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn, raw_path
+
+def restore_database(snapshot, db):
+    """用快照（已打开的连接）的内容整体替换db，返回复制的页数
+    
+    通过备份API写入，其他连接看到的始终是完整的数据库。变更计数在恢复后
+    调到比恢复前更大，各进程的页面缓存、ETag和借阅规则都会随之失效重新加载。
+    """
+    versions = dict(db.execute('SELECT name, version FROM change_counters').fetchall())
+    snapshot.backup(db)
+    db.executemany('UPDATE change_counters SET version = ?, updated_at = CURRENT_TIMESTAMP WHERE name = ?',
+                   [(version + 1, name) for name, version in versions.items()])
+    db.commit()
+    return db.execute('PRAGMA page_count').fetchone()[0]
+
+# 数据完整性检查：(图标, 检查项, 统计问题数的SQL)
+INTEGRITY_CHECKS = [
+    ('🔗', '孤儿借阅记录', """
+        SELECT COUNT(*) FROM loans l
+        LEFT JOIN users u ON l.user_id = u.id
+        WHERE u.id IS NULL
+    """),
+    ('📕', '图书缺失的借阅记录', """
+        SELECT COUNT(*) FROM loans l
+        LEFT JOIN books b ON l.book_id = b.id
+        WHERE b.id IS NULL
+    """),
+    ('📦', '库存异常记录', """
+        SELECT COUNT(*) FROM books
+        WHERE available_copies > total_copies OR available_copies < 0
+    """),
+]
+
+def check_integrity(conn):
+    """数据完整性检查（用于备份快照的校验和恢复后的检查），返回 [(图标, 检查项, 问题数)]，问题数为0表示通过
+    
+    分馆的读者账户在总馆：连接已通过share_main_users附加总馆时，借阅、预约指向的
+    用户由孤儿借阅检查经users视图核对，外键检查不再对照分馆文件中不用的users表。
+    """
+    messages = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+    results = [('🧱', '页面与索引结构错误', 0 if messages == ['ok'] else len(messages))]
+    shared_users = conn.execute(
+        "SELECT 1 FROM sqlite_temp_master WHERE type = 'view' AND name = 'users'"
+    ).fetchone() is not None
+    violations = [row for row in conn.execute('PRAGMA foreign_key_check')
+                  if not (shared_users and row[2] == 'users')]
+    results.append(('🔑', '外键不一致记录', len(violations)))
+    for icon, label, sql in INTEGRITY_CHECKS:
+        results.append((icon, label, conn.execute(sql).fetchone()[0]))
+    return results
+
+def print_integrity(results):
+    """输出完整性检查结果，全部通过时返回True"""
+    for icon, label, count in results:
+        print(f"{icon} {label}：{count} (应该为0)")
+    return not any(count for _, _, count in results)
+
+def scheduled_backup(db):
+    """后台任务：距上次快照超过BACKUP_INTERVAL时备份并轮换，返回新建的快照数"""
+    backups = list_backups(database_path(db))
+    if backups and time.time() - os.path.getmtime(backups[-1]) < BACKUP_INTERVAL:
+        return 0
+    backup_database(db)
+    rotate_backups(database_path(db))
+    return 1
+
+def audit_partition(month):
+    """月份（YYYYMM）对应的审计分区表名"""
+    return f'audit_{month}'
+
+def _write_audit_events(db, events):
+    """把一批事件按月写入各分区表，分区不存在时先建表"""
+    by_month = {}
+    for event in events:
+        by_month.setdefault(datetime.fromtimestamp(event[0] / 1000).strftime('%Y%m'), []).append(event)
+    for month, rows in by_month.items():
+        table = audit_partition(month)
+        if db.execute('SELECT 1 FROM audit_partitions WHERE month = ?', (month,)).fetchone() is None:
+            db.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    ts INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    actor_id INTEGER,
+                    user_id INTEGER,
+                    book_id INTEGER,
+                    loan_id INTEGER,
+                    data TEXT
+                )
+            ''')
+            db.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_ts ON {table} (ts)')
+            db.execute('INSERT OR IGNORE INTO audit_partitions (month) VALUES (?)', (month,))
+        db.executemany(f'''
+            INSERT INTO {table} (ts, kind, actor_id, user_id, book_id, loan_id, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+class AuditLog:
+    """只追加的审计日志
+    
+    借还、罚金、预约和管理操作在事务提交后记录，先进入按数据库区分的内存缓冲，
+    满AUDIT_BATCH_SIZE条或由后台任务每AUDIT_FLUSH_INTERVAL秒批量写入，
+    记录本身不给请求增加一次数据库写入。事件按月写入分区表，时间为毫秒时间戳，
+    附加信息为紧凑JSON。进程异常退出时最多丢失缓冲中尚未写入的事件。
+    """
+    
+    def __init__(self, batch_size=AUDIT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._buffers = {}  # 数据库文件 -> [事件]
+        self.stats = {'recorded': 0, 'written': 0, 'batches': 0, 'errors': 0}
+    
+    def record(self, kind, user_id=None, book_id=None, loan_id=None, **data):
+        """记录一条当前分馆的事件，操作人取当前登录用户"""
+        actor_id = session.get('user_id') if has_request_context() else None
+        event = (int(time.time() * 1000), kind, actor_id, user_id, book_id, loan_id,
+                 json.dumps(data, ensure_ascii=False, separators=(',', ':')) if data else None)
+        database = branch_database(current_branch())
+        with self._lock:
+            buffer = self._buffers.setdefault(os.path.abspath(database), [])
+            buffer.append(event)
+            self.stats['recorded'] += 1
+            full = len(buffer) >= self.batch_size
+        if full:
+            pool = get_pool(database)
+            conn = pool.acquire()
+            try:
+                self.flush(conn)
+            except sqlite3.Error as e:
+                # 写入失败的事件已放回缓冲，留给下一次写入
+                print(f"审计日志写入出错: {e}")
+            finally:
+                pool.release(conn)
+    
+    def flush(self, db):
+        """把db所在数据库的缓冲事件写入分区表，返回写入条数；失败时事件放回缓冲"""
+        database = os.path.abspath(database_path(db))
+        with self._lock:
+            events = self._buffers.pop(database, [])
+        if not events:
+            return 0
+        try:
+            run_transaction(db, _write_audit_events, events)
+        except sqlite3.Error:
+            with self._lock:
+                self._buffers[database] = events + self._buffers.get(database, [])
+                self.stats['errors'] += 1
+            raise
+        with self._lock:
+            self.stats['written'] += len(events)
+            self.stats['batches'] += 1
+        return len(events)
+    
+    def flush_all(self):
+        """写入全部数据库的缓冲事件（进程退出前调用）"""
+        with self._lock:
+            databases = list(self._buffers)
+        for database in databases:
+            pool = get_pool(database)
+            conn = pool.acquire()
+            try:
+                self.flush(conn)
+            except sqlite3.Error as e:
+                print(f"审计日志写入出错（{database}）: {e}")
+            finally:
+                pool.release(conn)
+    
+    def info(self):
+        with self._lock:
+            return dict(self.stats, buffered=sum(len(buffer) for buffer in self._buffers.values()))
+
+audit_log = AuditLog()
+atexit.register(audit_log.flush_all)
+
+def flush_audit_log(db):
+    """后台任务：写入缓冲中的审计事件"""
+    return audit_log.flush(db)
+
+def audit_timestamp(value, end=False):
+    """YYYY-MM-DD或YYYY-MM-DD HH:MM:SS转为毫秒时间戳；end为True且只有日期时取次日零点"""
+    try:
+        moment = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        try:
+            moment = datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            raise ValueError(f'时间格式应为YYYY-MM-DD或YYYY-MM-DD HH:MM:SS: {value}')
+        if end:
+            moment += timedelta(days=1)
+    return int(moment.timestamp() * 1000)
+
+def iter_audit_events(db, start=None, end=None, kinds=None):
+    """按时间顺序流式读取[start, end)之间的审计事件（毫秒时间戳，None表示不限）
+    
+    只读取时间范围覆盖的月份分区，每个分区按ts索引顺序扫描，不在内存中排序或缓存。
+    """
+    partitions = [row[0] for row in db.execute('''
+        SELECT month FROM audit_partitions
+        WHERE month >= ? AND month <= ?
+        ORDER BY month
+    ''', (datetime.fromtimestamp(start / 1000).strftime('%Y%m') if start is not None else '',
+          datetime.fromtimestamp(end / 1000).strftime('%Y%m') if end is not None else '999999'))]
+    
+    conditions, params = ['1=1'], []
+    if start is not None:
+        conditions.append('ts >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('ts < ?')
+        params.append(end)
+    if kinds:
+        conditions.append(f"kind IN ({','.join('?' * len(kinds))})")
+        params.extend(kinds)
+    for month in partitions:
+        cursor = db.execute(f'''
+            SELECT ts, kind, actor_id, user_id, book_id, loan_id, data FROM {audit_partition(month)}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY ts
+        ''', params)
+        for ts, kind, actor_id, user_id, book_id, loan_id, data in cursor:
+            yield {
+                'time': datetime.fromtimestamp(ts / 1000).isoformat(timespec='milliseconds'),
+                'kind': kind,
+                'actor_id': actor_id,
+                'user_id': user_id,
+                'book_id': book_id,
+                'loan_id': loan_id,
+                'data': json.loads(data) if data else None,
+            }
+
+notification_dispatcher = None
+
+def start_notification_dispatcher():
+    """启动全局通知发送器"""
+    global notification_dispatcher
+    notification_dispatcher = NotificationDispatcher()
+    notification_dispatcher.start()
+    return notification_dispatcher
+
+def claim_job(db, name, interval):
+    """领取共享任务本轮的执行权：到期时把下次执行时间推后，只有一个进程能领取成功
+    
+    推后interval的九成，领取成功的进程下一轮按本地计时稍晚一点检查时不会正好错过。
+    """
+    def claim(db):
+        now = time.time()
+        db.execute('INSERT OR IGNORE INTO job_schedule (name) VALUES (?)', (name,))
+        return db.execute('UPDATE job_schedule SET next_run = ? WHERE name = ? AND next_run <= ?',
+                          (now + interval * 0.9, name, now)).rowcount == 1
+    return run_transaction(db, claim)
+
+def start_background_worker():
+    """启动后台线程，按各自的间隔执行维护任务
+    
+    每个分馆的数据各自维护；借阅规则全馆统一，只检查总馆。多进程部署时每个进程
+    都运行本线程：共享任务（shared）通过job_schedule表领取，每个间隔只由一个进程
+    执行；审计日志缓冲和借阅规则缓存属于各进程，每个进程自己执行。单个任务出错
+    只记录日志，不影响其他任务和之后的执行。
+    """
+    jobs = [
+        ('逾期状态', OVERDUE_REFRESH_INTERVAL, refresh_overdue, True, True),
+        ('搜索建议', SUGGEST_REFRESH_INTERVAL, refresh_suggestions, True, True),
+        ('预约到期', HOLD_EXPIRY_INTERVAL, expire_holds, True, True),
+        ('到期提醒', NOTIFY_SCAN_INTERVAL, schedule_notifications, True, True),
+        ('借阅统计', ROLLUP_REFRESH_INTERVAL, refresh_rollups, True, True),
+        ('借阅规则', POLICY_RELOAD_INTERVAL, reload_loan_policies, False, False),
+        ('审计日志', AUDIT_FLUSH_INTERVAL, flush_audit_log, True, False),
+        ('数据备份', BACKUP_INTERVAL, scheduled_backup, True, True),
+    ]
+    
+    def worker():
+        next_run = {name: 0 for name, _, _, _, _ in jobs}
+        while True:
+            for name, interval, job, per_branch, shared in jobs:
+                if time.monotonic() < next_run[name]:
+                    continue
+                next_run[name] = time.monotonic() + interval
+                branches = branch_databases() if per_branch else {MAIN_BRANCH: (MAIN_BRANCH_NAME, DATABASE)}
+                for code, (branch_name, database) in branches.items():
+                    label = name if code == MAIN_BRANCH else f'{branch_name}/{name}'
+                    pool = get_pool(database)
+                    db = pool.acquire()
+                    try:
+                        if shared and not claim_job(db, job.__name__, interval):
+                            continue
+                        changed = job(db)
+                        if changed:
+                            print(f"后台任务[{label}]已更新: {changed} 条")
+                    except Exception as e:
+                        # 线程只有一个，任何异常（如备份时磁盘已满）都不能让它退出
+                        print(f"后台任务[{label}]出错: {e!r}")
+                        traceback.print_exc()
+                    finally:
+                        pool.release(db)
+            time.sleep(max(0.5, min(next_run.values()) - time.monotonic()))
+    
+    thread = threading.Thread(target=worker, name='background-worker', daemon=True)
+    thread.start()
+    return thread
+
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_services():
+    """在当前进程中启动后台任务线程和通知发送器，每个进程只启动一次；已启动过时返回False"""
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return False
+        _background_started = True
+    start_background_worker()
+    start_notification_dispatcher()
+    return True
+
+@app.before_request
+def ensure_background_services():
+    """处理请求的进程在第一个请求时启动后台任务
+    
+    不在导入模块时启动：命令行脚本也会导入本模块，gunicorn --preload在fork之前导入，
+    fork后线程不会带到worker进程中。debug模式下重载器的父进程不处理请求，也就不会启动。
+    测试客户端（app.testing）不启动，测试中直接调用各个任务。
+    """
+    if BACKGROUND_JOBS_ENABLED and not _background_started and not app.testing:
+        start_background_services()
+
+class LRUCache:
+    """进程内LRU缓存，按条目数和总字节数限制大小"""
+    
+    def __init__(self, max_entries=PAGE_CACHE_MAX_ENTRIES, max_bytes=PAGE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0}
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+    
+    def set(self, key, value):
+        size = len(json.dumps(value, ensure_ascii=False).encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self.stats['sets'] += 1
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats['evictions'] += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def info(self):
+        with self._lock:
+            return dict(self.stats, backend='memory', entries=len(self._entries), bytes=self._bytes)
+
+class FileCache:
+    """文件缓存，多个worker进程共享同一目录；超出条目上限时删除最旧的文件"""
+    
+    def __init__(self, directory=PAGE_CACHE_DIR, max_entries=PAGE_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0}
+    
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.json')
+    
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        with self._lock:
+            # 文件名是键的哈希，还需核对完整的键
+            if entry is None or entry.get('key') != key:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+        return entry['value']
+    
+    def set(self, key, value):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'value': value}, f, ensure_ascii=False)
+        # 原子替换，其他进程不会读到写了一半的文件
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.stats['sets'] += 1
+            prune = self.stats['sets'] % 50 == 0
+        if prune:
+            self._prune()
+    
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
             try:
-                db.execute('''
-                    INSERT INTO books (isbn, title, author, category, description, total_copies, available_copies)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', book_data)
-                db.commit()
-            except Exception as e:
-                print(f"添加图书时出错: {e}")
-        
-        print("示例图书数据已初始化")
-    else:
-        print(f"数据库中已有 {existing_books_count} 本图书，跳过示例数据初始化")
+                os.remove(path)
+                with self._lock:
+                    self.stats['evictions'] += 1
+            except OSError:
+                pass
+    
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                os.remove(entry.path)
+    
+    def info(self):
+        with self._lock:
+            return dict(self.stats, backend='file', directory=self.directory)
 
-def hash_password(password):
-    """密码哈希"""
-    return hashlib.sha256(password.encode()).hexdigest()
+page_cache = FileCache() if PAGE_CACHE_BACKEND == 'file' else LRUCache()
 
-def login_required(f):
-    """登录装饰器"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('请先登录', 'warning')
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
+def catalog_version(db):
+    """目录版本：图书、借阅、用户、借阅规则任一表写入后都会变化，旧的缓存键随之失效
+    
+    用户保存在总馆，取总馆的变更计数；借阅规则也在总馆，取本进程已加载的规则版本
+    （与页面上展示的规则一致）。
+    """
+    rows = db.execute("SELECT name, version FROM change_counters WHERE name IN ('books', 'loans')").fetchall()
+    rows += get_main_db().execute("SELECT name, version FROM change_counters WHERE name = 'users'").fetchall()
+    versions = [f'{name}{version}' for name, version in rows]
+    versions.append(f'loan_policies{loan_policies.version()}')
+    return '.'.join(versions)
 
-def admin_required(f):
-    """管理员装饰器"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('请先登录', 'warning')
-            return redirect(url_for('login'))
-        
-        db = get_db()
-        user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-        
-        if not user or not user['is_admin']:
-            flash('您没有权限访问此页面', 'danger')
-            return redirect(url_for('index'))
-        
-        return f(*args, **kwargs)
-    return decorated_function
+def user_role():
+    """页面缓存按角色区分：guest / user:读者角色 / admin:读者角色（借阅规则因读者角色而异）"""
+    user = current_user()
+    if user is None:
+        return 'guest'
+    return f"{'admin' if user['is_admin'] else 'user'}:{user['role']}"
 
-def current_user():
-    """获取当前用户"""
-    if 'user_id' in session:
-        db = get_db()
-        return db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    return None
+def patron_role():
+    """当前用户的读者角色，游客按默认角色展示借阅规则"""
+    user = current_user()
+    return user['role'] if user else DEFAULT_USER_ROLE
 
-@app.before_request
-def before_request():
-    """请求前设置当前用户"""
-    g.user = current_user()
+def render_fragment(template_name, context):
+    """只渲染页面模板的title和content块"""
+    template = app.jinja_env.get_template(template_name)
+    context = dict(context)
+    app.update_template_context(context)
+    template_context = template.new_context(context)
+    return {
+        'title': ''.join(template.blocks['title'](template_context)),
+        'content': ''.join(template.blocks['content'](template_context)),
+    }
+
+def render_cached(template_name, build):
+    """渲染带缓存的页面
+    
+    页面正文按 分馆+路由+查询参数+用户角色+目录版本 缓存；导航栏、用户名和提示消息
+    属于每个用户自己的部分，仍然每次渲染。build(db)返回模板变量，返回响应对象
+    （如重定向）时不缓存。
+    """
+    db = get_db()
+    key = '|'.join([current_branch(), template_name, request.full_path, user_role(), catalog_version(db)])
+    fragment = page_cache.get(key)
+    if fragment is None:
+        context = build(db)
+        if not isinstance(context, dict):
+            return context
+        fragment = render_fragment(template_name, context)
+        page_cache.set(key, fragment)
+    return render_template('cached_page_simple.html',
+                           page_title=Markup(fragment['title']),
+                           page_content=Markup(fragment['content']))
 
 # 路由定义
 @app.route('/')
 def index():
     """首页"""
-    db = get_db()
-    
-    # 统计信息
-    total_books = db.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
-    total_users = db.execute('SELECT COUNT(*) as count FROM users').fetchone()['count']
-    active_loans = db.execute('SELECT COUNT(*) as count FROM loans WHERE is_returned = 0').fetchone()['count']
-    
-    # 热门图书
-    popular_books = db.execute('''
-        SELECT b.*, COUNT(l.id) as loan_count 
-        FROM books b 
-        LEFT JOIN loans l ON b.id = l.book_id 
-        GROUP BY b.id 
-        ORDER BY loan_count DESC, b.created_at DESC 
-        LIMIT 6
-    ''').fetchall()
+    def build(db):
+        # 统计信息
+        stats = get_stats(db)
+        
+        # 热门图书
+        popular_books = db.execute('''
+            SELECT * FROM books 
+            ORDER BY loan_count DESC, created_at DESC 
+            LIMIT 6
+        ''').fetchall()
+        
+        return dict(total_books=stats['total_books'],
+                    total_users=get_stats(get_main_db())['total_users'],
+                    active_loans=stats['active_loans'],
+                    popular_books=popular_books)
     
-    return render_template('index_simple.html', 
-                         total_books=total_books,
-                         total_users=total_users,
-                         active_loans=active_loans,
-                         popular_books=popular_books)
+    return render_cached('index_simple.html', build)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -210,7 +3035,8 @@ def register():
             flash('密码长度至少6位', 'danger')
             return render_template('register_simple.html')
         
-        db = get_db()
+        # 读者账户全馆统一，保存在总馆
+        db = get_main_db()
         
         # 检查用户名是否已存在
         existing_user = db.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
@@ -238,13 +3064,20 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        db = get_db()
+        db = get_main_db()
         user = db.execute('''
             SELECT * FROM users 
             WHERE username = ? AND is_active = 1
         ''', (username,)).fetchone()
         
-        if user and user['password_hash'] == hash_password(password):
+        if user and verify_password(password, user['password_hash']):
+            # 旧版SHA-256或参数已调整的哈希，在登录成功时透明升级
+            if password_needs_rehash(user['password_hash']):
+                db.execute('UPDATE users SET password_hash = ? WHERE id = ?',
+                           (hash_password(password), user['id']))
+                db.commit()
+                invalidate_user(user['id'])
+            
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['is_admin'] = user['is_admin']
@@ -259,119 +3092,231 @@ def login():
 
 @app.route('/logout')
 def logout():
-    """用户登出"""
+    """用户登出（保留所选分馆）"""
+    branch = session.get('branch')
     session.clear()
+    if branch:
+        session['branch'] = branch
     flash('已成功登出', 'info')
     return redirect(url_for('index'))
 
-@app.route('/books')
-def books():
-    """图书浏览"""
-    db = get_db()
+@app.route('/branch/<code>')
+def switch_branch(code):
+    """切换分馆；读者账户全馆统一，切换后保持登录"""
+    if code != MAIN_BRANCH and code not in BRANCHES:
+        flash('分馆不存在', 'danger')
+        return redirect(url_for('index'))
+    if code != current_branch():
+        if code == MAIN_BRANCH:
+            session.pop('branch', None)
+        else:
+            session['branch'] = code
+        flash(f'已切换到{branch_databases()[code][0]}', 'info')
+    return redirect(url_for('index'))
+
+@app.context_processor
+def inject_branches():
+    """导航栏的分馆切换菜单"""
+    return {'branches': branch_databases() if BRANCHES else {}, 'current_branch': current_branch()}
+
+def has_search_index(db, table='books_fts'):
+    """检查全文索引（默认trigram索引，books_fts_short为短词索引）是否可用"""
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+def build_books_query(db, search, category):
+    """构建图书查询，返回 (query, params, 排序键, 是否降序)
     
-    search = request.args.get('search', '')
-    category = request.args.get('category', '')
+    有全文索引时按bm25相关度排序：词都不少于3个字符时用trigram索引，包含短词时
+    用短词索引（其余长词再用trigram索引筛选）；索引不可用时回退到LIKE查询并按上架时间排序
+    """
+    fts_query = build_search_query(search) if search else None
+    short_query = build_short_search_query(search) if search and not fts_query else None
+    
+    index = None
+    if fts_query and has_search_index(db):
+        index, match = 'books_fts', fts_query
+    elif (short_query and has_search_index(db, 'books_fts_short')
+          and (short_query[1] is None or has_search_index(db))):
+        index, match = 'books_fts_short', short_query[0]
+    
+    if index:
+        query = f'''
+            SELECT b.*, bm25({index}, %s, %s, %s, %s) AS rank FROM {index}
+            JOIN books b ON b.id = {index}.rowid
+            WHERE {index} MATCH ?
+        ''' % SEARCH_RANK_WEIGHTS
+        params = [match]
+        if index == 'books_fts_short' and short_query[1]:
+            query += ' AND b.id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)'
+            params.append(short_query[1])
+        if category:
+            query += ' AND b.category = ?'
+            params.append(category)
+        return query, params, ('rank', 'id'), False
     
-    # 构建查询
     query = 'SELECT * FROM books WHERE 1=1'
     params = []
     
     if search:
-        query += ' AND (title LIKE ? OR author LIKE ? OR isbn LIKE ?)'
+        query += ' AND (title LIKE ? OR author LIKE ? OR isbn LIKE ? OR description LIKE ?)'
         search_param = f'%{search}%'
-        params.extend([search_param, search_param, search_param])
+        params.extend([search_param] * 4)
     
     if category:
         query += ' AND category = ?'
         params.append(category)
     
-    query += ' ORDER BY created_at DESC'
+    return query, params, ('created_at', 'id'), True
+
+def search_books(db, search, category, limit=None):
+    """搜索图书并返回全部结果（或前limit条）"""
+    query, params, keys, descending = build_books_query(db, search, category)
+    order = ' DESC' if descending else ''
+    query += ' ORDER BY ' + ', '.join(key + order for key in keys)
+    if limit is not None:
+        query += ' LIMIT ?'
+        params = params + [limit]
+    return db.execute(query, params).fetchall()
+
+_branch_executor = None
+_branch_executor_lock = threading.Lock()
+
+def get_branch_executor():
+    """跨分馆搜索的线程池，首次使用时创建"""
+    global _branch_executor
+    if _branch_executor is None:
+        with _branch_executor_lock:
+            if _branch_executor is None:
+                _branch_executor = ThreadPoolExecutor(BRANCH_SEARCH_WORKERS, thread_name_prefix='branch-search')
+    return _branch_executor
+
+def search_branch(database, search, category, limit):
+    """在一个分馆中搜索，用该分馆连接池的连接，返回前limit条"""
+    pool = get_pool(database)
+    conn = pool.acquire()
+    try:
+        return search_books(conn, search, category, limit)
+    finally:
+        pool.release(conn)
+
+def holding_key(book):
+    """跨分馆合并馆藏的键：ISBN（规范化后），没有ISBN时用书名+作者"""
+    if book['isbn']:
+        try:
+            return normalize_isbn(book['isbn'])
+        except ValueError:
+            return book['isbn'].upper().replace('-', '').replace(' ', '')
+    return (book['title'], book['author'])
+
+def search_all_branches(search, category, limit):
+    """并发搜索全部分馆并合并结果
+    
+    各分馆各取前limit条，有相关度的结果按bm25升序排在前，其余按上架时间倒序；
+    同一ISBN的图书合并为一条，holdings列出各分馆的馆藏。等待超过
+    BRANCH_SEARCH_TIMEOUT或出错的分馆记入errors，不影响其他分馆的结果。
+    返回 (合并后的图书列表, {分馆代码: 错误原因})
+    """
+    branches = branch_databases()
+    executor = get_branch_executor()
+    futures = {executor.submit(search_branch, database, search, category, limit): code
+               for code, (_, database) in branches.items()}
+    done, not_done = wait(futures, timeout=BRANCH_SEARCH_TIMEOUT)
     
-    books_list = db.execute(query, params).fetchall()
+    errors = {}
+    ranked, recent = [], []
+    for future in not_done:
+        future.cancel()
+        errors[futures[future]] = '超时'
+    for future in done:
+        code = futures[future]
+        try:
+            rows = future.result()
+        except sqlite3.Error as e:
+            errors[code] = str(e)
+            continue
+        for row in rows:
+            (ranked if 'rank' in row.keys() else recent).append((code, row))
+    ranked.sort(key=lambda item: item[1]['rank'])
+    recent.sort(key=lambda item: item[1]['created_at'], reverse=True)
     
-    # 获取所有分类
-    categories = db.execute('SELECT DISTINCT category FROM books WHERE category IS NOT NULL').fetchall()
+    merged = OrderedDict()
+    for code, row in ranked + recent:
+        holdings = merged.setdefault(holding_key(row), (row, []))[1]
+        holdings.append({
+            'branch': code,
+            'name': branches[code][0],
+            'book_id': row['id'],
+            'available_copies': row['available_copies'],
+            'total_copies': row['total_copies'],
+        })
+    return list(merged.values())[:limit], errors
+
+def book_categories(db):
+    """现有图书的分类（按名称排序，不含没有分类的图书），取自分类汇总表"""
+    return [row['category'] for row in db.execute(
+        "SELECT category FROM category_copies WHERE books > 0 AND category != '未分类' ORDER BY category")]
+
+@app.route('/books')
+def books():
+    """图书浏览"""
+    def build(db):
+        search = request.args.get('search', '')
+        category = request.args.get('category', '')
+        
+        query, params, keys, descending = build_books_query(db, search, category)
+        page = paginate(db, query, params, keys, descending)
+        
+        # 获取所有分类
+        categories = book_categories(db)
+        
+        return dict(books=page['items'], 
+                    page=page,
+                    categories=categories,
+                    search=search,
+                    selected_category=category)
     
-    return render_template('books_simple.html', 
-                         books=books_list, 
-                         categories=categories,
-                         search=search,
-                         selected_category=category)
+    return render_cached('books_simple.html', build)
 
 @app.route('/book/<int:book_id>')
 def book_detail(book_id):
     """图书详情"""
-    db = get_db()
-    book = db.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    
-    if not book:
-        flash('图书不存在', 'danger')
-        return redirect(url_for('books'))
-    
-    # 获取借阅历史
-    loan_history = db.execute('''
-        SELECT l.*, u.username 
-        FROM loans l 
-        JOIN users u ON l.user_id = u.id 
-        WHERE l.book_id = ? 
-        ORDER BY l.loan_date DESC 
-        LIMIT 10
-    ''', (book_id,)).fetchall()
+    def build(db):
+        book = db.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+        
+        if not book:
+            flash('图书不存在', 'danger')
+            return redirect(url_for('books'))
+        
+        # 获取借阅历史
+        loan_history = db.execute('''
+            SELECT l.*, u.username 
+            FROM loans l 
+            JOIN users u ON l.user_id = u.id 
+            WHERE l.book_id = ? 
+            ORDER BY l.loan_date DESC 
+            LIMIT 10
+        ''', (book_id,)).fetchall()
+        
+        policy = loan_policies.lookup(patron_role(), book['category'])
+        return dict(book=book, loan_history=loan_history, policy=policy)
     
-    return render_template('book_detail_simple.html', book=book, loan_history=loan_history)
+    return render_cached('book_detail_simple.html', build)
 
 @app.route('/borrow/<int:book_id>', methods=['POST'])
 @login_required
 def borrow_book(book_id):
     """借阅图书"""
-    db = get_db()
-    
-    # 检查图书是否存在且可借
-    book = db.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    if not book:
-        flash('图书不存在', 'danger')
-        return redirect(url_for('books'))
-    
-    if book['available_copies'] <= 0:
-        flash('该图书暂无库存', 'warning')
-        return redirect(url_for('book_detail', book_id=book_id))
-    
-    # 检查用户是否已借阅该图书且未归还
-    existing_loan = db.execute('''
-        SELECT * FROM loans 
-        WHERE user_id = ? AND book_id = ? AND is_returned = 0
-    ''', (session['user_id'], book_id)).fetchone()
-    
-    if existing_loan:
-        flash('您已经借阅了这本书', 'warning')
-        return redirect(url_for('book_detail', book_id=book_id))
-    
-    # 检查用户当前借阅数量
-    current_loans = db.execute('''
-        SELECT COUNT(*) as count FROM loans 
-        WHERE user_id = ? AND is_returned = 0
-    ''', (session['user_id'],)).fetchone()['count']
-    
-    if current_loans >= 5:
-        flash('最多只能同时借阅5本书', 'warning')
+    try:
+        loan = borrow(get_db(), session['user_id'], book_id)
+    except LoanError as e:
+        flash(e.message, e.category)
+        if e.code == 'not_found':
+            return redirect(url_for('books'))
         return redirect(url_for('book_detail', book_id=book_id))
     
-    # 创建借阅记录
-    due_date = datetime.now() + timedelta(days=14)
-    db.execute('''
-        INSERT INTO loans (user_id, book_id, due_date)
-        VALUES (?, ?, ?)
-    ''', (session['user_id'], book_id, due_date))
-    
-    # 更新图书库存
-    db.execute('''
-        UPDATE books 
-        SET available_copies = available_copies - 1 
-        WHERE id = ?
-    ''', (book_id,))
-    
-    db.commit()
-    flash(f'成功借阅《{book["title"]}》，请在14天内归还', 'success')
+    flash(f'成功借阅《{loan["title"]}》，请在{loan["loan_days"]}天内归还', 'success')
     return redirect(url_for('book_detail', book_id=book_id))
 
 @app.route('/my_loans')
@@ -388,68 +3333,59 @@ def my_loans():
         ORDER BY l.loan_date DESC
     ''', (session['user_id'],)).fetchall()
     
-    # 计算逾期状态
-    current_date = datetime.now()
-    loans_with_status = []
+    holds = db.execute(f'''
+        SELECT h.*, b.title, b.author,
+               CASE WHEN h.status = 'waiting' THEN {HOLD_POSITION_SQL} END AS position
+        FROM holds h
+        JOIN books b ON h.book_id = b.id
+        WHERE h.user_id = ? AND h.status IN ('waiting', 'ready')
+        ORDER BY h.created_at
+    ''', (session['user_id'],)).fetchall()
     
-    for loan in loans:
-        loan_dict = dict(loan)
-        if loan_dict['due_date']:
-            due_date = datetime.strptime(loan_dict['due_date'], '%Y-%m-%d %H:%M:%S')
-            loan_dict['is_overdue'] = not loan_dict['is_returned'] and current_date > due_date
-        else:
-            loan_dict['is_overdue'] = False
-        loans_with_status.append(loan_dict)
+    role = patron_role()
+    # 逾期状态由后台任务预先计算
+    return render_template('my_loans_simple.html', loans=loans, holds=holds, current_date=datetime.now(),
+                           policy=loan_policies.lookup(role, '*'),
+                           category_policies=loan_policies.overrides(role),
+                           hold_pickup_days=HOLD_PICKUP_DAYS)
+
+@app.route('/hold/<int:book_id>', methods=['POST'])
+@login_required
+def hold_book(book_id):
+    """预约图书"""
+    try:
+        hold = place_hold(get_db(), session['user_id'], book_id)
+    except LoanError as e:
+        flash(e.message, e.category)
+        if e.code == 'not_found':
+            return redirect(url_for('books'))
+        return redirect(url_for('book_detail', book_id=book_id))
     
-    return render_template('my_loans_simple.html', loans=loans_with_status, current_date=current_date)
+    flash(f'已预约《{hold["title"]}》，当前排在第{hold["position"]}位，到书后保留{HOLD_PICKUP_DAYS}天', 'success')
+    return redirect(url_for('my_loans'))
+
+@app.route('/hold/<int:hold_id>/cancel', methods=['POST'])
+@login_required
+def cancel_hold_route(hold_id):
+    """取消预约"""
+    try:
+        cancel_hold(get_db(), hold_id, session['user_id'])
+    except LoanError as e:
+        flash(e.message, e.category)
+    else:
+        flash('预约已取消', 'info')
+    return redirect(url_for('my_loans'))
 
 @app.route('/return/<int:loan_id>', methods=['POST'])
 @login_required
 def return_book(loan_id):
     """归还图书"""
-    db = get_db()
-    
-    # 检查借阅记录是否存在且属于当前用户
-    loan = db.execute('''
-        SELECT l.*, b.id as book_id
-        FROM loans l 
-        JOIN books b ON l.book_id = b.id 
-        WHERE l.id = ? AND l.user_id = ?
-    ''', (loan_id, session['user_id'])).fetchone()
-    
-    if not loan:
-        flash('借阅记录不存在', 'danger')
-        return redirect(url_for('my_loans'))
-    
-    if loan['is_returned']:
-        flash('该图书已归还', 'warning')
+    try:
+        fine_amount = return_loan(get_db(), loan_id, session['user_id'])
+    except LoanError as e:
+        flash(e.message, e.category)
         return redirect(url_for('my_loans'))
     
-    # 计算逾期费用
-    current_date = datetime.now()
-    due_date = datetime.strptime(loan['due_date'], '%Y-%m-%d %H:%M:%S')
-    fine_amount = 0
-    
-    if current_date > due_date:
-        days_overdue = (current_date - due_date).days
-        fine_amount = days_overdue * 0.5
-    
-    # 更新借阅记录
-    db.execute('''
-        UPDATE loans 
-        SET is_returned = 1, return_date = ?, fine_amount = ?
-        WHERE id = ?
-    ''', (current_date, fine_amount, loan_id))
-    
-    # 更新图书库存
-    db.execute('''
-        UPDATE books 
-        SET available_copies = available_copies + 1 
-        WHERE id = ?
-    ''', (loan['book_id'],))
-    
-    db.commit()
-    
     if fine_amount > 0:
         flash(f'图书已归还，逾期费用：{fine_amount:.2f}元', 'info')
     else:
@@ -464,49 +3400,642 @@ def admin():
     db = get_db()
     
     # 统计数据
-    total_books = db.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
-    total_users = db.execute('SELECT COUNT(*) as count FROM users').fetchone()['count']
-    active_loans = db.execute('SELECT COUNT(*) as count FROM loans WHERE is_returned = 0').fetchone()['count']
-    overdue_loans = db.execute('''
-        SELECT COUNT(*) as count FROM loans 
-        WHERE is_returned = 0 AND due_date < ?
-    ''', (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),)).fetchone()['count']
-    
-    # 所有数据
-    books = db.execute('SELECT * FROM books ORDER BY created_at DESC').fetchall()
-    users = db.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
-    loans_raw = db.execute('''
+    stats = get_stats(db)
+    
+    # 分页数据
+    books_page = paginate(db, 'SELECT * FROM books', [], ('created_at', 'id'), prefix='books_')
+    users_page = paginate(db, 'SELECT * FROM users', [], ('created_at', 'id'), prefix='users_')
+    loans_page = paginate(db, '''
         SELECT l.*, u.username, b.title 
         FROM loans l 
         JOIN users u ON l.user_id = u.id 
-        JOIN books b ON l.book_id = b.id 
-        ORDER BY l.loan_date DESC
+        JOIN books b ON l.book_id = b.id
+    ''', [], ('loan_date', 'id'), prefix='loans_')
+    
+    return render_template('admin_simple.html',
+                         user_roles=USER_ROLES,
+                         total_books=stats['total_books'],
+                         total_users=get_stats(get_main_db())['total_users'],
+                         active_loans=stats['active_loans'],
+                         overdue_loans=stats['overdue_loans'],
+                         books=books_page['items'],
+                         users=users_page['items'],
+                         loans=loans_page['items'],
+                         books_page=books_page,
+                         users_page=users_page,
+                         loans_page=loans_page,
+                         current_date=datetime.now())
+
+@app.route('/admin/reports')
+@admin_required
+def reports():
+    """借阅统计报表（读取汇总表，由后台任务增量更新）"""
+    try:
+        start, end = report_months(request.args.get('start'), request.args.get('end'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        start, end = report_months()
+    
+    report = circulation_report(get_db(), start, end)
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    
+    # 月份 × 分类 的借出数透视表
+    pivot = {}
+    for row in report['monthly']:
+        pivot.setdefault(row['month'], {})[row['category']] = row['loans']
+    return render_template('reports_simple.html', report=report, pivot=pivot,
+                           category_names=sorted(report['categories']))
+
+@app.route('/admin/policies')
+@admin_required
+def policies():
+    """借阅规则管理：规则列表与按角色、分类合并后的生效规则"""
+    db = get_db()
+    rules = get_main_db().execute('''
+        SELECT * FROM loan_policies
+        ORDER BY role = '*' DESC, role, category = '*' DESC, category
     ''').fetchall()
+    categories = book_categories(db)
+    # 生效规则表的列：有专门规则的分类，其余分类都按“*”
+    rule_categories = sorted({rule['category'] for rule in rules} - {'*'})
+    effective = {role: [loan_policies.lookup(role, category) for category in ['*'] + rule_categories]
+                 for role in USER_ROLES}
+    return render_template('policies_simple.html', rules=rules, categories=categories,
+                           rule_categories=rule_categories, effective=effective, user_roles=USER_ROLES)
+
+def parse_policy_field(name, label, cast, minimum):
+    """读取规则表单中的一个字段，留空表示继承（返回None）"""
+    value = request.form.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        value = cast(value)
+    except ValueError:
+        raise ValueError(f'{label}应为数字')
+    if value < minimum:
+        raise ValueError(f'{label}不能小于{minimum}')
+    return value
+
+@app.route('/admin/policies', methods=['POST'])
+@admin_required
+def save_policy():
+    """新增或修改一条借阅规则，保存后立即重新加载规则表"""
+    role = request.form.get('role', '*').strip() or '*'
+    category = request.form.get('category', '*').strip() or '*'
+    try:
+        if role != '*' and role not in USER_ROLES:
+            raise ValueError(f'未知的读者角色: {role}')
+        values = (parse_policy_field('loan_days', '借阅天数', int, 1),
+                  parse_policy_field('max_loans', '最多在借数量', int, 0),
+                  parse_policy_field('fine_per_day', '每天罚金', float, 0))
+        if (role, category) == ('*', '*') and None in values:
+            raise ValueError('默认规则的各项都必须填写')
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('policies'))
     
-    # 预处理借阅数据，转换日期格式
-    loans = []
-    current_date = datetime.now()
-    for loan in loans_raw:
-        loan_dict = dict(loan)
-        # 转换due_date为datetime对象进行比较
-        if loan_dict['due_date']:
-            loan_dict['due_date_dt'] = datetime.strptime(loan_dict['due_date'], '%Y-%m-%d %H:%M:%S')
-        loans.append(loan_dict)
+    db = get_main_db()
+    # 内容没有变化时不更新，避免无谓地使页面缓存失效
+    db.execute('''
+        INSERT INTO loan_policies (role, category, loan_days, max_loans, fine_per_day)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(role, category) DO UPDATE SET
+            loan_days = excluded.loan_days,
+            max_loans = excluded.max_loans,
+            fine_per_day = excluded.fine_per_day,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE loan_days IS NOT excluded.loan_days
+           OR max_loans IS NOT excluded.max_loans
+           OR fine_per_day IS NOT excluded.fine_per_day
+    ''', (role, category) + values)
+    db.commit()
+    loan_policies.load(db)
+    audit_log.record('policy_save', role=role, category=category,
+                     **dict(zip(('loan_days', 'max_loans', 'fine_per_day'), values)))
     
-    return render_template('admin_simple.html',
-                         total_books=total_books,
-                         total_users=total_users,
-                         active_loans=active_loans,
-                         overdue_loans=overdue_loans,
-                         books=books,
-                         users=users,
-                         loans=loans,
-                         current_date=current_date)
+    flash('借阅规则已保存，新借出的图书按新规则执行', 'success')
+    return redirect(url_for('policies'))
+
+@app.route('/admin/policies/<int:policy_id>/delete', methods=['POST'])
+@admin_required
+def delete_policy(policy_id):
+    """删除一条借阅规则（默认规则不能删除）"""
+    db = get_main_db()
+    cursor = db.execute('''
+        DELETE FROM loan_policies WHERE id = ? AND NOT (role = '*' AND category = '*')
+    ''', (policy_id,))
+    db.commit()
+    if cursor.rowcount == 0:
+        flash('规则不存在或不能删除', 'warning')
+    else:
+        loan_policies.load(db)
+        audit_log.record('policy_delete', policy_id=policy_id)
+        flash('借阅规则已删除', 'success')
+    return redirect(url_for('policies'))
+
+@app.route('/admin/user_role', methods=['POST'])
+@admin_required
+def set_user_role():
+    """设置读者角色"""
+    username = request.form.get('username', '').strip()
+    role = request.form.get('role', '')
+    if role not in USER_ROLES:
+        flash(f'未知的读者角色: {role}', 'danger')
+        return redirect(url_for('policies'))
+    
+    db = get_main_db()
+    user = db.execute('SELECT id, role FROM users WHERE username = ?', (username,)).fetchone()
+    if not user:
+        flash('用户不存在', 'danger')
+        return redirect(url_for('policies'))
+    if user['role'] != role:
+        db.execute('UPDATE users SET role = ? WHERE id = ?', (role, user['id']))
+        db.commit()
+        invalidate_user(user['id'])
+        audit_log.record('user_role', user['id'], previous=user['role'], role=role)
+    
+    flash(f'{username} 的读者角色已设为{USER_ROLES[role]}', 'success')
+    return redirect(url_for('policies'))
+
+@app.route('/admin/runtime_stats')
+@admin_required
+def runtime_stats():
+    """运行时指标：连接池、缓存、通知、借阅规则、备份与审计日志"""
+    with _user_cache_lock:
+        user_cache = dict(user_cache_stats, size=len(_user_cache))
+    return jsonify({
+        'db_pools': [pool.stats() for pool in list(_pools.values())],
+        'user_cache': user_cache,
+        'page_cache': page_cache.info(),
+        'notifications': notification_dispatcher.stats() if notification_dispatcher else None,
+        'loan_policies': loan_policies.info(),
+        'backups': dict(backup_stats),
+        'audit_log': audit_log.info(),
+    })
+
+# 可导出的表：(列名, FROM子句, 日期筛选列, 排序列, 支持的筛选条件)
+# 排序列都有索引，流式导出时不需要临时排序
+EXPORT_TABLES = {
+    'books': (
+        ('id', 'isbn', 'title', 'author', 'category', 'description', 'total_copies',
+         'available_copies', 'loan_count', 'created_at'),
+        'books', 'created_at', ('created_at', 'id'), {'category'},
+    ),
+    'users': (
+        ('id', 'username', 'email', 'is_admin', 'is_active', 'created_at'),
+        'users', 'created_at', ('created_at', 'id'), set(),
+    ),
+    'loans': (
+        ('l.id', 'l.user_id', 'u.username', 'l.book_id', 'b.title', 'b.category', 'l.loan_date',
+         'l.due_date', 'l.return_date', 'l.is_returned', 'l.is_overdue', 'l.accrued_fine', 'l.fine_amount'),
+        'loans l JOIN users u ON u.id = l.user_id JOIN books b ON b.id = l.book_id',
+        'l.loan_date', ('l.loan_date', 'l.id'), {'category', 'overdue'},
+    ),
+}
+
+def export_query(table, start=None, end=None, category=None, overdue=False):
+    """生成导出查询，返回 (sql, 参数, 表头)；日期为YYYY-MM-DD，end当天包含在内"""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f'不支持导出: {table}')
+    columns, source, date_column, order, filters = EXPORT_TABLES[table]
+    if category and 'category' not in filters:
+        raise ValueError('该表不支持按分类筛选')
+    if overdue and 'overdue' not in filters:
+        raise ValueError('该表不支持逾期筛选')
+    
+    where, params = [], []
+    try:
+        if start:
+            where.append(f'{date_column} >= ?')
+            params.append(date.fromisoformat(start).isoformat())
+        if end:
+            where.append(f'{date_column} < ?')
+            params.append((date.fromisoformat(end) + timedelta(days=1)).isoformat())
+    except ValueError:
+        raise ValueError('日期格式应为YYYY-MM-DD')
+    if category:
+        # 借阅记录按分类筛选时用+禁用图书分类索引，仍沿loan_date索引顺序扫描，避免整体排序
+        where.append(('+b.category' if table == 'loans' else 'category') + ' = ?')
+        params.append(category)
+    if overdue:
+        where.append('l.is_returned = 0 AND l.is_overdue = 1')
+    
+    sql = f"SELECT {', '.join(columns)} FROM {source}"
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY ' + ', '.join(order)
+    return sql, params, [column.split('.')[-1] for column in columns]
+
+def iter_csv(cursor, headers, chunk_rows=EXPORT_CHUNK_ROWS):
+    """逐块生成CSV文本；开头带BOM，Excel可直接识别UTF-8中文"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            break
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def stream_export(sql, params, headers, pool):
+    """用单独的连接流式读取，响应发送完（或客户端断开）后归还连接
+    
+    生成器在请求上下文之外执行，连接池须由调用方按当前分馆取好传入。
+    """
+    conn = pool.acquire()
+    try:
+        yield from iter_csv(conn.execute(sql, params), headers)
+    finally:
+        pool.release(conn)
+
+@app.route('/admin/export/<table>')
+@admin_required
+def export_table(table):
+    """导出CSV：start/end按日期筛选，category按分类，overdue=1只导出逾期未还"""
+    try:
+        sql, params, headers = export_query(table,
+                                            start=request.args.get('start'),
+                                            end=request.args.get('end'),
+                                            category=request.args.get('category'),
+                                            overdue=request.args.get('overdue') == '1')
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin'))
+    
+    filename = f'{current_branch()}-{table}-{datetime.now():%Y%m%d-%H%M%S}.csv'
+    response = app.response_class(stream_export(sql, params, headers, get_pool()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    # 禁止反向代理缓冲整份文件
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def stream_audit(pool, start, end, kinds):
+    """流式输出审计事件（JSON Lines），每EXPORT_CHUNK_ROWS条输出一块"""
+    conn = pool.acquire()
+    try:
+        lines = []
+        for event in iter_audit_events(conn, start, end, kinds):
+            lines.append(json.dumps(event, ensure_ascii=False))
+            if len(lines) >= EXPORT_CHUNK_ROWS:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+    finally:
+        pool.release(conn)
+
+@app.route('/admin/audit')
+@admin_required
+def audit_events():
+    """审计日志导出：start/end按时间筛选（end当天包含在内），kind按事件类型筛选（可多个）"""
+    try:
+        start = audit_timestamp(request.args['start']) if request.args.get('start') else None
+        end = audit_timestamp(request.args['end'], end=True) if request.args.get('end') else None
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin'))
+    
+    # 先写入缓冲中的事件，导出结果包含到目前为止的全部操作
+    audit_log.flush(get_db())
+    filename = f'{current_branch()}-audit-{datetime.now():%Y%m%d-%H%M%S}.jsonl'
+    response = app.response_class(stream_audit(get_pool(), start, end, request.args.getlist('kind')),
+                                  mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus_metrics():
+    """以Prometheus文本格式输出请求指标、连接池和缓存指标"""
+    lines = []
+    
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{_prometheus_label(val)}"' for key, val in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+    
+    endpoints = request_metrics.snapshot()
+    metric('library_requests_total', 'counter', '请求数', [
+        ({'endpoint': endpoint, 'status': status}, count)
+        for endpoint, entry in endpoints.items() for status, count in sorted(entry['statuses'].items())
+    ])
+    
+    lines.append('# HELP library_request_duration_seconds 请求耗时')
+    lines.append('# TYPE library_request_duration_seconds histogram')
+    for endpoint, entry in endpoints.items():
+        label = _prometheus_label(endpoint)
+        for bound, count in zip(request_metrics.buckets, entry['buckets']):
+            lines.append(f'library_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} {count}')
+        lines.append(f'library_request_duration_seconds_bucket{{endpoint="{label}",le="+Inf"}} {entry["count"]}')
+        lines.append(f'library_request_duration_seconds_sum{{endpoint="{label}"}} {entry["seconds"]:.6f}')
+        lines.append(f'library_request_duration_seconds_count{{endpoint="{label}"}} {entry["count"]}')
+    
+    metric('library_sql_statements_total', 'counter', '执行的SQL语句数', [
+        ({'endpoint': endpoint}, entry['sql_statements']) for endpoint, entry in endpoints.items()
+    ])
+    metric('library_sql_seconds_total', 'counter', 'SQL执行总耗时', [
+        ({'endpoint': endpoint}, f"{entry['sql_seconds']:.6f}") for endpoint, entry in endpoints.items()
+    ])
+    metric('library_sql_slowest_seconds', 'gauge', '最慢的一条SQL耗时', [
+        ({'endpoint': endpoint, 'statement': entry['slowest_sql']}, f"{entry['slowest_sql_seconds']:.6f}")
+        for endpoint, entry in endpoints.items() if entry['slowest_sql']
+    ])
+    
+    pools = [pool.stats() for pool in list(_pools.values())]
+    for key, name, kind, help_text in (('open_connections', 'open_connections', 'gauge', '已打开的连接数'),
+                                       ('idle_connections', 'idle_connections', 'gauge', '空闲连接数'),
+                                       ('checkouts', 'checkouts_total', 'counter', '借出连接次数'),
+                                       ('waits', 'waits_total', 'counter', '等待空闲连接次数')):
+        metric(f'library_db_pool_{name}', kind, help_text,
+               [({'database': pool['database']}, pool[key]) for pool in pools])
+    
+    with _user_cache_lock:
+        user_cache = dict(user_cache_stats)
+    page = page_cache.info()
+    for cache_name, label, stats in (('user', '用户', user_cache), ('page', '页面', page)):
+        metric(f'library_{cache_name}_cache_hits_total', 'counter', f'{label}缓存命中次数', [({}, stats['hits'])])
+        metric(f'library_{cache_name}_cache_misses_total', 'counter', f'{label}缓存未命中次数', [({}, stats['misses'])])
+    
+    if notification_dispatcher is not None:
+        notify = notification_dispatcher.stats()
+        for key, help_text in (('sent', '已发送通知数'), ('retried', '发送失败待重试次数'), ('failed', '最终发送失败通知数')):
+            metric(f'library_notifications_{key}_total', 'counter', help_text, [({}, notify[key])])
+    
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+@admin_required
+def metrics():
+    """Prometheus格式的运行指标（需设置LIBRARY_PROFILING=1开启PROFILING_ENABLED才有请求级数据）"""
+    return app.response_class(render_prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+# JSON API v1
+API_BOOK_FIELDS = ('id', 'isbn', 'title', 'author', 'category', 'description',
+                   'total_copies', 'available_copies', 'loan_count', 'created_at')
+API_BRANCH_BOOK_FIELDS = ('isbn', 'title', 'author', 'category', 'description')
+API_LOAN_FIELDS = ('id', 'book_id', 'title', 'loan_date', 'due_date', 'return_date',
+                   'is_returned', 'is_overdue', 'accrued_fine', 'fine_amount')
+API_ERROR_STATUS = {'not_found': 404, 'duplicate': 409, 'limit': 409, 'unavailable': 409, 'returned': 409,
+                    'available': 409}
+
+class ApiError(Exception):
+    """API请求错误，以JSON返回"""
+    
+    def __init__(self, message, status=400, code='bad_request'):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.code = code
+
+@app.errorhandler(ApiError)
+def handle_api_error(error):
+    """API错误响应"""
+    return jsonify({'error': error.message, 'code': error.code}), error.status
+
+def api_login_required(f):
+    """API登录装饰器：未登录返回401而不是跳转到登录页"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            raise ApiError('请先登录', 401, 'unauthorized')
+        return f(*args, **kwargs)
+    return decorated_function
+
+def api_admin_required(f):
+    """API管理员装饰器（借还书台等操作）"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            raise ApiError('请先登录', 401, 'unauthorized')
+        user = current_user()
+        if not user or not user['is_admin']:
+            raise ApiError('您没有权限执行此操作', 403, 'forbidden')
+        return f(*args, **kwargs)
+    return decorated_function
+
+def select_fields(allowed):
+    """解析fields参数（逗号分隔），未指定时返回全部字段"""
+    fields = request.args.get('fields')
+    if not fields:
+        return allowed
+    selected = tuple(field.strip() for field in fields.split(',') if field.strip())
+    unknown = [field for field in selected if field not in allowed]
+    if unknown:
+        raise ApiError(f'未知字段: {", ".join(unknown)}', 400, 'invalid_fields')
+    return selected
+
+def serialize(row, fields):
+    """按字段列表输出一行数据"""
+    return {field: row[field] for field in fields}
+
+def conditional_json(tables, build):
+    """基于表变更计数的条件GET
+    
+    ETag由相关表的版本号、分馆、请求地址和当前用户计算，每次写入都会改变版本号；
+    客户端缓存仍有效时直接返回304，不执行查询也不序列化数据。是否变化只按
+    If-None-Match判断：Last-Modified只精确到秒，同一秒内的两次写入无法区分，
+    所以仍然返回Last-Modified供参考，但不根据If-Modified-Since返回304。
+    单个资源的接口应先确认资源存在再调用，避免已删除的资源因ETag匹配返回304。
+    """
+    db = get_db()
+    placeholders = ','.join('?' * len(tables))
+    rows = db.execute(f'SELECT name, version, updated_at FROM change_counters WHERE name IN ({placeholders})',
+                      tables).fetchall()
+    versions = '.'.join(f"{row['name']}{row['version']}" for row in rows)
+    digest = hashlib.sha1(f"{current_branch()}|{versions}|{request.full_path}|{session.get('user_id')}"
+                          .encode()).hexdigest()[:16]
+    etag = f'{versions}-{digest}'
+    # CURRENT_TIMESTAMP为UTC时间
+    last_modified = max(parse_datetime(row['updated_at']) for row in rows).replace(tzinfo=timezone.utc)
+    
+    not_modified = request.if_none_match.contains(etag)
+    response = app.response_class(status=304) if not_modified else jsonify(build(db))
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+@app.route('/api/v1/books')
+def api_books():
+    """图书列表（支持search、category、fields及游标分页）"""
+    fields = select_fields(API_BOOK_FIELDS)
+    
+    def build(db):
+        query, params, keys, descending = build_books_query(
+            db, request.args.get('search', ''), request.args.get('category', ''))
+        page = paginate(db, query, params, keys, descending)
+        return {
+            'items': [serialize(row, fields) for row in page['items']],
+            'next_cursor': page['next_cursor'],
+            'prev_cursor': page['prev_cursor'],
+            'page_size': page['page_size'],
+        }
+    return conditional_json(('books',), build)
+
+@app.route('/api/v1/branches/books')
+def api_branch_books():
+    """跨分馆搜索图书（search、category、limit），同一ISBN的馆藏合并显示"""
+    start = time.perf_counter()
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE_DEFAULT, type=int), PAGE_SIZE_MAX))
+    books, errors = search_all_branches(request.args.get('search', ''), request.args.get('category', ''), limit)
+    items = []
+    for book, holdings in books:
+        item = serialize(book, API_BRANCH_BOOK_FIELDS)
+        item['available_copies'] = sum(holding['available_copies'] for holding in holdings)
+        item['holdings'] = holdings
+        items.append(item)
+    return jsonify({
+        'items': items,
+        'branches': len(branch_databases()),
+        'errors': errors,
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+    })
+
+@app.route('/api/v1/books/<int:book_id>')
+def api_book(book_id):
+    """图书详情（先确认图书存在，不存在或已删除时即使ETag匹配也返回404）"""
+    fields = select_fields(API_BOOK_FIELDS)
+    
+    def find(db):
+        book = db.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+        if not book:
+            raise ApiError('图书不存在', 404, 'not_found')
+        return book
+    
+    find(get_db())
+    return conditional_json(('books',), lambda db: serialize(find(db), fields))
+
+@app.route('/api/v1/loans')
+@api_login_required
+def api_loans():
+    """当前用户的借阅记录"""
+    fields = select_fields(API_LOAN_FIELDS)
+    
+    def build(db):
+        page = paginate(db, '''
+            SELECT l.*, b.title FROM loans l
+            JOIN books b ON l.book_id = b.id
+            WHERE l.user_id = ?
+        ''', [session['user_id']], ('loan_date', 'id'))
+        return {
+            'items': [serialize(row, fields) for row in page['items']],
+            'next_cursor': page['next_cursor'],
+            'prev_cursor': page['prev_cursor'],
+            'page_size': page['page_size'],
+        }
+    return conditional_json(('loans', 'books'), build)
+
+@app.route('/api/v1/suggest')
+def api_suggest():
+    """搜索建议：按书名、作者或书名拼音首字母前缀匹配，借阅次数多的图书优先"""
+    prefix = fold_text(request.args.get('q', ''))
+    limit = max(1, min(request.args.get('limit', SUGGEST_LIMIT, type=int), PAGE_SIZE_MAX))
+    if not prefix:
+        return jsonify({'items': []})
+    
+    # 索引按 (前缀, 借阅次数降序) 排列，沿索引取到的前几条就是最热门的；
+    # 更长的输入在前SUGGEST_PREFIX_LENGTH个字符的分组内再按词的范围过滤。
+    # 一本书最多有3个索引词，多取几倍再按图书去重
+    conditions, params = ['s.prefix = ?'], [prefix[:SUGGEST_PREFIX_LENGTH]]
+    if len(prefix) > SUGGEST_PREFIX_LENGTH:
+        conditions.append('s.term >= ? AND s.term < ?')
+        params += [prefix, prefix + '\U0010ffff']
+    rows = get_db().execute(f'''
+        SELECT s.book_id AS id, b.title, b.author
+        FROM book_suggestions s
+        JOIN books b ON b.id = s.book_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY s.loan_count DESC, s.book_id
+        LIMIT ?
+    ''', params + [limit * 3]).fetchall()
+    books = list({row['id']: row for row in rows}.values())
+    
+    response = jsonify({'items': [serialize(book, ('id', 'title', 'author')) for book in books[:limit]]})
+    response.cache_control.max_age = 60
+    return response
+
+@app.route('/api/v1/books/<int:book_id>/borrow', methods=['POST'])
+@api_login_required
+def api_borrow(book_id):
+    """借阅图书"""
+    try:
+        loan = borrow(get_db(), session['user_id'], book_id)
+    except LoanError as e:
+        raise ApiError(e.message, API_ERROR_STATUS.get(e.code, 400), e.code)
+    return jsonify(loan), 201
+
+@app.route('/api/v1/loans/<int:loan_id>/return', methods=['POST'])
+@api_login_required
+def api_return(loan_id):
+    """归还图书"""
+    try:
+        fine_amount = return_loan(get_db(), loan_id, session['user_id'])
+    except LoanError as e:
+        raise ApiError(e.message, API_ERROR_STATUS.get(e.code, 400), e.code)
+    return jsonify({'loan_id': loan_id, 'fine_amount': fine_amount})
+
+def desk_batch(process):
+    """解析借还书台请求 {"user_id": 读者id, "items": [图书id或ISBN, ...]} 并执行批量操作"""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        raise ApiError('请求体应为JSON对象', 400, 'bad_request')
+    user_id = payload.get('user_id')
+    items = payload.get('items')
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise ApiError('user_id应为整数', 400, 'bad_request')
+    if not isinstance(items, list) or not items:
+        raise ApiError('items应为非空列表', 400, 'bad_request')
+    if len(items) > DESK_BATCH_MAX:
+        raise ApiError(f'单次最多处理{DESK_BATCH_MAX}项', 400, 'too_many_items')
+    
+    start = time.perf_counter()
+    try:
+        results = process(get_db(), user_id, items)
+    except LoanError as e:
+        raise ApiError(e.message, API_ERROR_STATUS.get(e.code, 400), e.code)
+    elapsed = time.perf_counter() - start
+    
+    succeeded = sum(1 for result in results if result['ok'])
+    return jsonify({
+        'user_id': user_id,
+        'results': results,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'elapsed_ms': round(elapsed * 1000, 3),
+        'items_per_second': round(len(results) / elapsed, 1) if elapsed else None,
+    })
+
+@app.route('/api/v1/desk/checkout', methods=['POST'])
+@api_admin_required
+def api_desk_checkout():
+    """借还书台批量借书"""
+    return desk_batch(checkout_batch)
+
+@app.route('/api/v1/desk/checkin', methods=['POST'])
+@api_admin_required
+def api_desk_checkin():
+    """借还书台批量还书"""
+    return desk_batch(checkin_batch)
 
 if __name__ == '__main__':
     # 初始化数据库
     with app.app_context():
-        init_db()
+        init_branches()
+    
+    # 后台任务由实际处理请求的进程在第一个请求时启动（ensure_background_services），
+    # debug模式下重载器的父进程不处理请求，不会启动
     
     print("=" * 50)
     print("🎉 图书馆管理系统启动成功！")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按时间范围读取审计日志（借还书、罚金、预约和管理操作），用于审计或重建统计数据
+只读取时间范围覆盖的月份分区，逐条流式输出，内存占用与数据量无关
+
+用法: python audit_events.py [--start 2024-01-01] [--end 2024-01-31] [--kind borrow --kind return]
+      [--branch 代码] [--summary] [-o audit.jsonl]
+      不指定 -o 时输出到标准输出；--summary 只输出按日期和事件类型的统计
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+import time
+from collections import Counter
+
+from app_simple import MAIN_BRANCH, audit_timestamp, branch_database, iter_audit_events
+
+def main():
+    parser = argparse.ArgumentParser(description='读取审计日志')
+    parser.add_argument('--start', help='开始时间 YYYY-MM-DD[ HH:MM:SS]（含）')
+    parser.add_argument('--end', help='结束时间 YYYY-MM-DD[ HH:MM:SS]（只有日期时当天包含在内）')
+    parser.add_argument('--kind', action='append', help='事件类型，可重复指定')
+    parser.add_argument('--branch', default=MAIN_BRANCH, help='读取指定分馆，默认总馆')
+    parser.add_argument('--summary', action='store_true', help='只输出按日期和事件类型的统计')
+    parser.add_argument('-o', '--output', help='输出文件，默认标准输出')
+    args = parser.parse_args()
+
+    try:
+        database = branch_database(args.branch)
+        start = audit_timestamp(args.start) if args.start else None
+        end = audit_timestamp(args.end, end=True) if args.end else None
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+
+    began = time.perf_counter()
+    conn = sqlite3.connect(database, timeout=30)
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    events = 0
+    counts = Counter()
+    try:
+        for event in iter_audit_events(conn, start, end, args.kind):
+            events += 1
+            if args.summary:
+                counts[(event['time'][:10], event['kind'])] += 1
+            else:
+                output.write(json.dumps(event, ensure_ascii=False) + '\n')
+        for (day, kind), count in sorted(counts.items()):
+            output.write(f"{day}\t{kind}\t{count}\n")
+    finally:
+        conn.close()
+        if args.output:
+            output.close()
+
+    print(f"✅ 读取 {events} 条事件，耗时 {time.perf_counter() - began:.2f} 秒", file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据库在线备份、快照校验与恢复（Web服务进程中由后台线程按BACKUP_INTERVAL自动快照）
+备份通过sqlite备份API分步复制，服务运行时执行也不会阻塞借还书
+
+用法: python backup_db.py backup [--branch 代码] [--dir backups] [--keep 7]
+      python backup_db.py list [--branch 代码] [--dir backups]
+      python backup_db.py verify backups/library-20240101-020000.db.gz
+      python backup_db.py restore backups/library-20240101-020000.db.gz [--branch 代码] [--dir backups] --yes
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import app_simple
+from app_simple import (MAIN_BRANCH, backup_database, branch_database, branch_databases, check_integrity, get_pool,
+                        is_main_database, list_backups, open_snapshot, print_integrity, restore_database,
+                        rotate_backups, share_main_users)
+
+def selected_databases(branch):
+    """--branch指定的分馆，未指定时为全部分馆"""
+    if branch:
+        return [branch_database(branch)]
+    return [database for _, database in branch_databases().values()]
+
+def backup(args):
+    for database in selected_databases(args.branch):
+        pool = get_pool(database)
+        conn = pool.acquire()
+        try:
+            info = backup_database(conn, args.dir)
+        finally:
+            pool.release(conn)
+        removed = rotate_backups(database, args.dir, args.keep)
+        print(f"💾 {database} -> {info['path']}")
+        print(f"   {info['pages']} 页，{info['bytes'] / 1024 / 1024:.1f}MB 压缩为 "
+              f"{info['compressed_bytes'] / 1024 / 1024:.1f}MB，耗时 {info['seconds']:.2f} 秒"
+              + (f"，因写入重启 {info['restarts']} 次" if info['restarts'] else ""))
+        if removed:
+            print(f"🗑️ 已删除 {removed} 份过期快照")
+    return 0
+
+def list_snapshots(args):
+    for database in selected_databases(args.branch):
+        backups = list_backups(database, args.dir)
+        print(f"📋 {database}：{len(backups)} 份快照")
+        for path in reversed(backups):
+            print(f"   {os.path.basename(path)}  {os.path.getsize(path) / 1024 / 1024:.1f}MB")
+    return 0
+
+def snapshot_database(path):
+    """快照所属的数据库文件（按快照文件名匹配各分馆），无法确定时返回None"""
+    directory, name = os.path.split(path)
+    for _, database in branch_databases().values():
+        if any(os.path.basename(backup) == name for backup in list_backups(database, directory or '.')):
+            return database
+    return None
+
+def verify_snapshot(path, database=None):
+    """解压快照并执行完整性检查，全部通过时返回True
+    
+    分馆的快照不含读者账户，附加总馆后核对借阅记录指向的读者。
+    """
+    database = database or snapshot_database(path)
+    conn, raw_path = open_snapshot(path)
+    try:
+        if database and not is_main_database(database):
+            share_main_users(conn)
+        return print_integrity(check_integrity(conn))
+    finally:
+        conn.close()
+        os.remove(raw_path)
+
+def verify(args):
+    print(f"🔍 校验快照 {args.snapshot}")
+    if not verify_snapshot(args.snapshot):
+        print("❌ 快照校验未通过")
+        return 1
+    print("✅ 快照校验通过")
+    return 0
+
+def restore(args):
+    database = branch_database(args.branch)
+    if not args.yes:
+        print(f"⚠️ 恢复会用快照覆盖 {database} 的全部数据，确认后请加 --yes 重新执行")
+        return 1
+
+    print(f"🔍 校验快照 {args.snapshot}")
+    if not verify_snapshot(args.snapshot, database):
+        print("❌ 快照校验未通过，已取消恢复")
+        return 1
+
+    pool = get_pool(database)
+    conn = pool.acquire()
+    snapshot, raw_path = open_snapshot(args.snapshot)
+    try:
+        # 恢复前先给当前数据做一份快照，恢复错了还能回退
+        info = backup_database(conn, args.dir)
+        print(f"💾 当前数据已备份到 {info['path']}")
+        start = time.perf_counter()
+        pages = restore_database(snapshot, conn)
+        print(f"♻️ 已恢复 {pages} 页，耗时 {time.perf_counter() - start:.2f} 秒")
+        print("🔍 校验恢复后的数据库")
+        ok = print_integrity(check_integrity(conn))
+    finally:
+        snapshot.close()
+        os.remove(raw_path)
+        pool.release(conn)
+
+    if not ok:
+        print("❌ 恢复后的数据库校验未通过")
+        return 1
+    print("✅ 恢复完成")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='数据库在线备份与恢复')
+    commands = parser.add_subparsers(dest='command', required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--dir', default=app_simple.BACKUP_DIR, help='快照目录')
+
+    command = commands.add_parser('backup', help='生成快照并轮换旧快照', parents=[common])
+    command.add_argument('--branch', help='只备份指定分馆（默认全部分馆）')
+    command.add_argument('--keep', type=int, default=app_simple.BACKUP_KEEP, help='每个数据库保留的快照份数')
+    command.set_defaults(func=backup)
+
+    command = commands.add_parser('list', help='列出快照', parents=[common])
+    command.add_argument('--branch', help='只列出指定分馆（默认全部分馆）')
+    command.set_defaults(func=list_snapshots)
+
+    command = commands.add_parser('verify', help='校验快照的完整性')
+    command.add_argument('snapshot', help='快照文件')
+    command.set_defaults(func=verify)
+
+    command = commands.add_parser('restore', help='校验快照后恢复到数据库', parents=[common])
+    command.add_argument('snapshot', help='快照文件')
+    command.add_argument('--branch', default=MAIN_BRANCH, help='恢复到指定分馆，默认总馆')
+    command.add_argument('--yes', action='store_true', help='确认覆盖现有数据')
+    command.set_defaults(func=restore)
+
+    args = parser.parse_args()
+    try:
+        return args.func(args)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
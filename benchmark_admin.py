@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+管理员面板延迟对比：原实现（全量读取 + 逐行解析到期日）vs 当前实现（分页 + 预计算逾期状态）
+在临时数据库中生成合成借阅记录（默认100万条）后分别计时
+
+用法: python benchmark_admin.py [借阅记录数量]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import app_simple
+from app_simple import get_pool, init_db, refresh_overdue
+
+def populate(conn, loan_count):
+    """生成用户、图书和借阅记录，约5%未归还"""
+    users = max(loan_count // 100, 10)
+    books = max(loan_count // 100, 10)
+    conn.executemany('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                     ((f'reader{i}', '-') for i in range(users)))
+    conn.executemany('INSERT INTO books (title, author, description) VALUES (?, ?, ?)',
+                     ((f'图书{i}', f'作者{i % 500}', '') for i in range(books)))
+    
+    rng = random.Random(42)
+    now = datetime.now()
+    batch = []
+    for _ in range(loan_count):
+        loan_date = now - timedelta(days=rng.uniform(0, 720))
+        due_date = loan_date + timedelta(days=14)
+        returned = rng.random() > 0.05
+        batch.append((rng.randint(2, users + 1), rng.randint(6, books + 5),
+                      loan_date.strftime('%Y-%m-%d %H:%M:%S'), due_date.strftime('%Y-%m-%d %H:%M:%S'),
+                      int(returned)))
+        if len(batch) == 50000:
+            conn.executemany('''
+                INSERT INTO loans (user_id, book_id, loan_date, due_date, is_returned)
+                VALUES (?, ?, ?, ?, ?)
+            ''', batch)
+            batch = []
+    if batch:
+        conn.executemany('''
+            INSERT INTO loans (user_id, book_id, loan_date, due_date, is_returned)
+            VALUES (?, ?, ?, ?, ?)
+        ''', batch)
+    conn.commit()
+
+def legacy_admin(conn):
+    """原管理员面板的数据库与Python处理部分（不含模板渲染）"""
+    conn.execute('SELECT COUNT(*) FROM books').fetchone()
+    conn.execute('SELECT COUNT(*) FROM users').fetchone()
+    conn.execute('SELECT COUNT(*) FROM loans WHERE is_returned = 0').fetchone()
+    conn.execute('SELECT COUNT(*) FROM loans WHERE is_returned = 0 AND due_date < ?',
+                 (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),)).fetchone()
+    conn.execute('SELECT * FROM books ORDER BY created_at DESC').fetchall()
+    conn.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
+    loans = conn.execute('''
+        SELECT l.*, u.username, b.title
+        FROM loans l
+        JOIN users u ON l.user_id = u.id
+        JOIN books b ON l.book_id = b.id
+        ORDER BY l.loan_date DESC
+    ''').fetchall()
+    for loan in loans:
+        loan_dict = dict(loan)
+        loan_dict['due_date_dt'] = datetime.strptime(loan_dict['due_date'], '%Y-%m-%d %H:%M:%S')
+
+def timed(func, repeat=3):
+    """返回最快一次的耗时(ms)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    loan_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    app_simple.DATABASE = path
+    app_simple.app.config['TESTING'] = True
+    try:
+        with app_simple.app.app_context():
+            init_db()
+        
+        conn = get_pool().acquire()
+        print(f"📚 生成 {loan_count} 条借阅记录...")
+        start = time.perf_counter()
+        populate(conn, loan_count)
+        print(f"✅ 生成完成，耗时 {time.perf_counter() - start:.1f} 秒")
+        
+        refresh_ms = timed(lambda: refresh_overdue(conn), repeat=1)
+        legacy_ms = timed(lambda: legacy_admin(conn), repeat=1)
+        get_pool().release(conn)
+        
+        client = app_simple.app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        current_ms = timed(lambda: client.get('/admin'))
+        
+        print("\n" + "=" * 60)
+        print(f"原实现（仅查询与日期解析）：{legacy_ms:10.1f} ms")
+        print(f"当前 /admin（含模板渲染）：  {current_ms:10.1f} ms")
+        print(f"后台逾期计算（首次全量）：    {refresh_ms:10.1f} ms（不在请求路径上）")
+        print("=" * 60)
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+if __name__ == '__main__':
+    main()
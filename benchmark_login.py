@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+登录耗时测量：对不同的密码哈希参数，在指定并发下反复校验密码，输出p50/p99延迟和吞吐，
+并给出p99不超过预算的最高强度参数，用于设置 app_simple 中的 PASSWORD_* 配置
+
+用法: python benchmark_login.py [--concurrency 16] [--budget-ms 250] [--rounds 5] [--login]
+  --login  另外通过测试客户端走一遍完整的 /login 路由（使用当前配置）
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app_simple
+from app_simple import hash_password, verify_password
+
+# (名称, 配置覆盖)，按强度从低到高排列
+CANDIDATES = [
+    ('pbkdf2 100k', {'PASSWORD_HASH_METHOD': 'pbkdf2_sha256', 'PASSWORD_PBKDF2_ITERATIONS': 100000}),
+    ('pbkdf2 300k', {'PASSWORD_HASH_METHOD': 'pbkdf2_sha256', 'PASSWORD_PBKDF2_ITERATIONS': 300000}),
+    ('pbkdf2 600k', {'PASSWORD_HASH_METHOD': 'pbkdf2_sha256', 'PASSWORD_PBKDF2_ITERATIONS': 600000}),
+    ('scrypt n=2^14', {'PASSWORD_HASH_METHOD': 'scrypt', 'PASSWORD_SCRYPT_N': 2 ** 14}),
+    ('scrypt n=2^15', {'PASSWORD_HASH_METHOD': 'scrypt', 'PASSWORD_SCRYPT_N': 2 ** 15}),
+    ('scrypt n=2^16', {'PASSWORD_HASH_METHOD': 'scrypt', 'PASSWORD_SCRYPT_N': 2 ** 16}),
+]
+
+def percentile(values, pct):
+    """最近秩百分位数"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def apply_config(overrides):
+    """修改app_simple中的哈希配置，返回原配置用于恢复"""
+    previous = {name: getattr(app_simple, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(app_simple, name, value)
+    return previous
+
+def measure(concurrency, rounds):
+    """并发校验 concurrency*rounds 次密码，返回 (延迟列表毫秒, 总耗时秒)"""
+    password_hash = hash_password('benchmark-password')
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(rounds):
+            start = time.perf_counter()
+            assert verify_password('benchmark-password', password_hash)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return latencies, time.perf_counter() - start
+
+def benchmark_login_route(concurrency, rounds):
+    """在临时数据库上并发请求 /login，返回延迟列表（毫秒）"""
+    db_dir = tempfile.mkdtemp()
+    app_simple.DATABASE = os.path.join(db_dir, 'login_bench.db')
+    app_simple.app.config['TESTING'] = True
+    with app_simple.app.app_context():
+        app_simple.init_db()
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        client = app_simple.app.test_client()
+        for _ in range(rounds):
+            start = time.perf_counter()
+            response = client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+            elapsed = (time.perf_counter() - start) * 1000
+            assert response.status_code == 302
+            with lock:
+                latencies.append(elapsed)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description='测量不同密码哈希参数下的登录延迟')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发登录数（按高峰期估计）')
+    parser.add_argument('--budget-ms', type=float, default=250, help='登录p99延迟预算（毫秒）')
+    parser.add_argument('--rounds', type=int, default=5, help='每个并发线程的校验次数')
+    parser.add_argument('--login', action='store_true', help='额外测量完整的/login路由')
+    args = parser.parse_args()
+
+    print(f"🔐 密码哈希测量：并发 {args.concurrency}，每线程 {args.rounds} 次，p99预算 {args.budget_ms:.0f}ms，"
+          f"CPU核数 {os.cpu_count()}")
+    print(f"{'参数':<16}{'单次ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'次/秒':>10}")
+
+    chosen = None
+    for name, overrides in CANDIDATES:
+        previous = apply_config(overrides)
+        try:
+            single, _ = measure(1, 3)
+            latencies, elapsed = measure(args.concurrency, args.rounds)
+        finally:
+            apply_config(previous)
+        p99 = percentile(latencies, 99)
+        within = p99 <= args.budget_ms
+        if within:
+            chosen = (name, overrides)
+        print(f"{name:<16}{statistics.median(single):>10.1f}{percentile(latencies, 50):>10.1f}"
+              f"{p99:>10.1f}{len(latencies) / elapsed:>10.1f} {'✅' if within else '❌'}")
+
+    if chosen:
+        print(f"\n📌 预算内强度最高的参数: {chosen[0]}")
+        for config_name, value in chosen[1].items():
+            print(f"   {config_name} = {value!r}")
+    else:
+        print("\n⚠️  所有候选参数的p99都超出预算，请降低并发估计或提高预算")
+
+    if args.login:
+        latencies = benchmark_login_route(args.concurrency, args.rounds)
+        print(f"\n🌐 /login 路由（当前配置 {app_simple.PASSWORD_HASH_METHOD}）: "
+              f"p50 {percentile(latencies, 50):.1f}ms, p99 {percentile(latencies, 99):.1f}ms")
+
+if __name__ == '__main__':
+    sys.exit(main())
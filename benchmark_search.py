@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图书搜索性能对比：LIKE全表扫描 vs FTS5全文索引
+在临时数据库中生成合成图书目录（默认50万本）后分别计时
+
+用法: python benchmark_search.py [图书数量]
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from app_simple import init_search_index, init_short_search_index, search_books
+
+# 常用汉字池，用于生成接近真实分布的中文书名
+TITLE_CHARS = ('的一是在不了有人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动'
+               '同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自'
+               '二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日'
+               '那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变'
+               '条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总'
+               '次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指')
+AUTHORS = ['张伟', '王芳', '李娜', 'Eric Matthes', 'Thomas H. Cormen', 'Randal E. Bryant',
+           'Miguel Grinberg', '刘洋', '陈静', 'Donald Knuth']
+CATEGORIES = ['编程', 'Web开发', '计算机科学', '算法', '软件工程', '数学']
+
+def create_catalog(conn, count):
+    """生成合成图书目录"""
+    conn.execute('''
+        CREATE TABLE books (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            isbn TEXT,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            category TEXT,
+            description TEXT,
+            total_copies INTEGER DEFAULT 1,
+            available_copies INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    init_search_index(conn)
+    init_short_search_index(conn)
+    
+    rng = random.Random(42)
+    rows = []
+    for i in range(count):
+        title = ''.join(rng.choice(TITLE_CHARS) for _ in range(rng.randint(4, 10)))
+        author = rng.choice(AUTHORS)
+        isbn = f'978-7-111-{i:06d}-{i % 10}'
+        rows.append((isbn, title, author, rng.choice(CATEGORIES), f'{title}，作者{author}'))
+        if len(rows) == 10000:
+            conn.executemany('''
+                INSERT INTO books (isbn, title, author, category, description)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            rows = []
+    if rows:
+        conn.executemany('''
+            INSERT INTO books (isbn, title, author, category, description)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+    conn.commit()
+
+def pick_queries(conn):
+    """从生成的数据中挑选查询词：书名片段、作者、ISBN前缀，以及使用短词索引的两字词和单字"""
+    rng = random.Random(7)
+    max_id = conn.execute('SELECT MAX(id) FROM books').fetchone()[0]
+    queries = []
+    for _ in range(3):
+        title = conn.execute('SELECT title FROM books WHERE id = ?',
+                             (rng.randint(1, max_id),)).fetchone()[0]
+        queries.append(title[:4])
+    queries.append('Knuth')
+    queries.append(f'978-7-111-{max_id // 2:06d}')
+    queries.append(TITLE_CHARS[:2])
+    queries.append(TITLE_CHARS[2])
+    return queries
+
+def like_search(conn, search):
+    """原来的LIKE查询"""
+    param = f'%{search}%'
+    return conn.execute('''
+        SELECT * FROM books
+        WHERE title LIKE ? OR author LIKE ? OR isbn LIKE ? OR description LIKE ?
+        ORDER BY created_at DESC
+    ''', (param, param, param, param)).fetchall()
+
+def timed(func, repeat=3):
+    """返回最快一次的耗时(ms)和结果数量"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(rows)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        
+        print(f"📚 生成 {count} 本合成图书...")
+        start = time.perf_counter()
+        create_catalog(conn, count)
+        print(f"✅ 生成完成，耗时 {time.perf_counter() - start:.1f} 秒")
+        
+        print("\n" + "=" * 60)
+        print(f"{'查询':<16}{'LIKE(ms)':>12}{'FTS5(ms)':>12}{'加速':>8}{'结果数':>10}")
+        print("=" * 60)
+        for search in pick_queries(conn):
+            like_ms, like_rows = timed(lambda: like_search(conn, search))
+            fts_ms, fts_rows = timed(lambda: search_books(conn, search, ''))
+            speedup = like_ms / fts_ms if fts_ms else float('inf')
+            print(f"{search:<16}{like_ms:>12.1f}{fts_ms:>12.1f}{speedup:>7.1f}x{fts_rows:>10}")
+            if like_rows != fts_rows:
+                print(f"   ⚠️ 结果数不一致：LIKE {like_rows} / FTS5 {fts_rows}")
+        
+        conn.close()
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+性能基准测试
+datagen 生成指定规模的合成图书馆数据（借阅集中在热门图书上），
+runner 用Flask测试客户端依次及并发访问app_simple的全部路由，把吞吐量和延迟分位数写入JSON，
+便于在不同提交之间对比
+
+用法: python -m benchmarks [--users 2000] [--books 20000] [--loans 200000] [--output bench.json]
+      python -m benchmarks --compare 上次结果.json
+"""
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""命令行入口：python -m benchmarks --help"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+import app_simple
+
+from .datagen import generate
+from .runner import run_concurrent, run_sequential, uncovered_endpoints
+
+# 默认结果目录（已加入.gitignore），每次运行按时间命名，便于用--compare对比之前的结果
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def git_commit():
+    """当前提交（不在git仓库中时为None）"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_table(title, results):
+    print(f"\n{title}")
+    print(f"{'场景':<20}{'请求数':>8}{'次/秒':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'错误':>6}")
+    for name, row in results.items():
+        if row['requests']:
+            print(f"{name:<20}{row['requests']:>8}{row['throughput_rps']:>10}{row['p50_ms']:>10}"
+                  f"{row['p90_ms']:>10}{row['p99_ms']:>10}{row['errors']:>6}")
+
+def print_comparison(previous, current):
+    """按场景对比两次结果的p50/p99（比值>1表示变慢）"""
+    print(f"\n📊 与 {previous['meta'].get('commit')} 对比（当前/之前）")
+    print(f"{'场景':<20}{'p50':>10}{'p99':>10}")
+    rows = dict(current['sequential'])
+    rows['并发整体'] = current['concurrent']['overall']
+    old_rows = dict(previous['sequential'])
+    old_rows['并发整体'] = previous['concurrent']['overall']
+    for name, row in rows.items():
+        old = old_rows.get(name)
+        if not old or not old.get('requests') or not row.get('requests'):
+            continue
+        p50 = row['p50_ms'] / old['p50_ms'] if old['p50_ms'] else float('nan')
+        p99 = row['p99_ms'] / old['p99_ms'] if old['p99_ms'] else float('nan')
+        flag = ' ⚠️' if p99 > 1.2 else ''
+        print(f"{name:<20}{p50:>10.2f}{p99:>10.2f}{flag}")
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='图书馆系统路由基准测试')
+    parser.add_argument('--users', type=int, default=2000, help='合成读者数量')
+    parser.add_argument('--books', type=int, default=20000, help='合成图书数量')
+    parser.add_argument('--loans', type=int, default=200000, help='合成借阅记录数量')
+    parser.add_argument('--skew', type=float, default=1.1, help='图书热度的Zipf指数，越大越集中')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    parser.add_argument('--iterations', type=int, default=50, help='顺序阶段每个场景的请求次数')
+    parser.add_argument('--threads', type=int, default=8, help='并发阶段线程数')
+    parser.add_argument('--requests', type=int, default=200, help='并发阶段每个线程的请求次数')
+    parser.add_argument('--output', help='结果JSON文件，默认 benchmarks/results/时间.json')
+    parser.add_argument('--compare', help='与之前的结果JSON对比')
+    parser.add_argument('--keep-db', action='store_true', help='保留生成的临时数据库')
+    args = parser.parse_args()
+
+    missing = uncovered_endpoints()
+    if missing:
+        print(f"⚠️  以下路由没有基准场景: {', '.join(missing)}")
+
+    app_simple.app.config['TESTING'] = True
+    db_dir = tempfile.mkdtemp(prefix='library-bench-')
+    database = os.path.join(db_dir, 'bench.db')
+    try:
+        print(f"🏗️  生成数据：{args.users} 读者，{args.books} 图书，{args.loans} 借阅记录...")
+        data = generate(database, args.users, args.books, args.loans, args.skew, args.seed)
+        print(f"   完成，耗时 {data['seconds']} 秒，在借 {data['active_loans']} 条")
+
+        print(f"⏱️  顺序阶段：每个场景 {args.iterations} 次")
+        sequential = run_sequential(data, args.iterations, args.seed)
+        print_table('顺序阶段结果', sequential)
+
+        print(f"\n⏱️  并发阶段：{args.threads} 线程 × {args.requests} 次")
+        concurrent = run_concurrent(data, args.threads, args.requests, args.seed)
+        overall = concurrent['overall']
+        print_table('并发阶段结果', concurrent['scenarios'])
+        print(f"\n   整体: {overall['throughput_rps']} 次/秒, p50 {overall['p50_ms']}ms, "
+              f"p99 {overall['p99_ms']}ms, 错误 {overall['errors']}")
+    finally:
+        if args.keep_db:
+            print(f"\n💾 数据库保留在 {database}")
+        else:
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+    dataset = {key: value for key, value in data.items() if key not in ('user_ids', 'popular_books')}
+    result = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'page_cache_backend': app_simple.PAGE_CACHE_BACKEND,
+            'dataset': dataset,
+            'iterations': args.iterations,
+            'uncovered_endpoints': missing,
+        },
+        'sequential': sequential,
+        'concurrent': concurrent,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n📝 结果已写入 {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(json.load(f), result)
+
+if __name__ == '__main__':
+    sys.exit(main())
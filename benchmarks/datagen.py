@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+合成数据生成
+图书热度服从Zipf分布（少数热门书占大部分借阅），读者活跃度同样有偏；
+同一随机种子总是生成相同的数据
+"""
+
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import app_simple
+from app_simple import (FINE_PER_DAY, LOAN_DAYS, hash_password, init_db, isbn13_check_digit, refresh_overdue,
+                        refresh_rollups, refresh_suggestions)
+
+# 所有合成读者共用的密码（只哈希一次）
+BENCH_PASSWORD = 'bench-password'
+
+CATEGORIES = ['编程', 'Web开发', '计算机科学', '算法', '软件工程', '数学', '文学', '历史']
+TITLE_WORDS = ['Python', 'Java', 'Go', 'Rust', '数据', '算法', '网络', '系统', '设计', '分析',
+               '机器学习', '数据库', '编译', '架构', '测试', '历史', '小说', '入门', '实战', '原理']
+AUTHOR_SURNAMES = ['王', '李', '张', '刘', '陈', '杨', '赵', '黄', '周', '吴', 'Smith', 'Knuth']
+
+# 每人最多同时在借数量（低于默认借阅规则的上限，给压测中的借书留出余量）；
+# 借期和罚金按默认借阅规则（LOAN_DAYS、FINE_PER_DAY）生成
+MAX_ACTIVE_PER_USER = 3
+
+def zipf_weights(count, skew):
+    """排名为i的元素权重为 1/(i+1)^skew 的累积权重"""
+    cumulative = []
+    total = 0.0
+    for rank in range(count):
+        total += 1.0 / (rank + 1) ** skew
+        cumulative.append(total)
+    return cumulative
+
+def generate(database, users=2000, books=20000, loans=200000, skew=1.1, seed=42):
+    """在database中初始化库表并写入合成数据，返回生成摘要"""
+    start = time.perf_counter()
+    rng = random.Random(seed)
+
+    app_simple.DATABASE = database
+    with app_simple.app.app_context():
+        init_db()
+
+    conn = sqlite3.connect(database, timeout=30)
+    conn.execute('BEGIN')
+
+    password_hash = hash_password(BENCH_PASSWORD)
+    first_user = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM users').fetchone()[0]
+    conn.executemany('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+                     ((f'reader{i}', f'reader{i}@example.com', password_hash) for i in range(users)))
+    user_ids = list(range(first_user, first_user + users))
+
+    first_book = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM books').fetchone()[0]
+    copies = [rng.randint(1, 5) for _ in range(books)]
+    rows = []
+    for i in range(books):
+        digits = f'978{7000000 + i:09d}'
+        title = ' '.join(rng.sample(TITLE_WORDS, rng.randint(2, 3))) + f' 第{i % 7 + 1}版'
+        author = rng.choice(AUTHOR_SURNAMES) + str(i % 997)
+        rows.append((digits + isbn13_check_digit(digits), title, author, rng.choice(CATEGORIES),
+                     f'{title}，{author}著', copies[i], copies[i]))
+    conn.executemany('''
+        INSERT INTO books (isbn, title, author, category, description, total_copies, available_copies)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    book_ids = list(range(first_book, first_book + books))
+
+    # 热度排名与id无关，避免热门书都集中在前几页
+    popular_books = book_ids[:]
+    rng.shuffle(popular_books)
+    active_users = user_ids[:]
+    rng.shuffle(active_users)
+    book_weights = zipf_weights(books, skew)
+    user_weights = zipf_weights(users, skew * 0.7)
+
+    now = datetime.now()
+    active_per_user = {}
+    active_per_book = {}
+    batch = []
+
+    def flush():
+        conn.executemany('''
+            INSERT INTO loans (user_id, book_id, loan_date, due_date, return_date, is_returned, fine_amount,
+                               fine_per_day)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+        batch.clear()
+
+    for _ in range(loans):
+        book_id = rng.choices(popular_books, cum_weights=book_weights)[0]
+        user_id = rng.choices(active_users, cum_weights=user_weights)[0]
+        loan_date = now - timedelta(days=rng.uniform(0, 365))
+        due_date = loan_date + timedelta(days=LOAN_DAYS)
+
+        # 近一个月的借阅部分仍未归还（有库存且读者未到上限时）
+        book_index = book_id - first_book
+        if ((now - loan_date).days < 30 and rng.random() < 0.5
+                and active_per_user.get(user_id, 0) < MAX_ACTIVE_PER_USER
+                and active_per_book.get(book_id, 0) < copies[book_index]):
+            active_per_user[user_id] = active_per_user.get(user_id, 0) + 1
+            active_per_book[book_id] = active_per_book.get(book_id, 0) + 1
+            return_date, returned, fine = None, 0, 0
+        else:
+            return_date = loan_date + timedelta(days=rng.uniform(1, 20))
+            if return_date > now:
+                return_date = now
+            overdue_days = (return_date - due_date).days
+            returned, fine = 1, max(0, overdue_days) * FINE_PER_DAY
+            return_date = return_date.strftime('%Y-%m-%d %H:%M:%S')
+        batch.append((user_id, book_id, loan_date.strftime('%Y-%m-%d %H:%M:%S'),
+                      due_date.strftime('%Y-%m-%d %H:%M:%S'), return_date, returned, fine, FINE_PER_DAY))
+        if len(batch) >= 50000:
+            flush()
+    if batch:
+        flush()
+
+    conn.executemany('UPDATE books SET available_copies = available_copies - ? WHERE id = ?',
+                     ((count, book_id) for book_id, count in active_per_book.items()))
+    conn.commit()
+
+    refresh_overdue(conn)
+    refresh_suggestions(conn, drain=True)
+    refresh_rollups(conn, drain=True)
+    conn.close()
+
+    return {
+        'users': users,
+        'books': books,
+        'loans': loans,
+        'active_loans': sum(active_per_book.values()),
+        'skew': skew,
+        'seed': seed,
+        'seconds': round(time.perf_counter() - start, 2),
+        'user_ids': user_ids,
+        'popular_books': popular_books[:100],
+    }
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+路由基准测试
+顺序阶段：每个场景单独重复请求，得到各路由的延迟分位数；
+并发阶段：多个线程各自登录不同读者，按混合权重随机请求，得到整体吞吐量与延迟
+"""
+
+import random
+import re
+import sqlite3
+import statistics
+import threading
+import time
+
+import app_simple
+from app_simple import app
+
+from .datagen import BENCH_PASSWORD
+
+class BenchSession:
+    """一个测试客户端及其身份（游客/读者/管理员），供场景函数使用"""
+
+    def __init__(self, role, username=None, user_id=None, seed=0, popular_books=(), database=None):
+        self.role = role
+        self.user_id = user_id
+        self.client = app.test_client()
+        self.rng = random.Random(seed)
+        self.popular_books = list(popular_books)
+        self.database = database
+        self.desk_patron = None
+        self.desk_items = []
+        self._conn = None
+        if role == 'user':
+            self.login(username, BENCH_PASSWORD)
+        elif role == 'admin':
+            self.login('admin', 'admin123')
+
+    def login(self, username, password):
+        response = self.client.post('/login', data={'username': username, 'password': password})
+        assert response.status_code == 302, f'{username} 登录失败'
+
+    def book_id(self):
+        """按热度抽取一本书"""
+        index = min(int(self.rng.expovariate(0.1)), len(self.popular_books) - 1)
+        return self.popular_books[index]
+
+    def active_loan(self):
+        """当前读者的一条在借记录id，没有时先借一本（不计时）"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.database, timeout=30, check_same_thread=False)
+        row = self._conn.execute('SELECT id FROM loans WHERE user_id = ? AND is_returned = 0 LIMIT 1',
+                                 (self.user_id,)).fetchone()
+        if row:
+            return row[0]
+        for book_id in self.popular_books:
+            response = self.client.post(f'/api/v1/books/{book_id}/borrow')
+            if response.status_code == 201:
+                return response.get_json()['loan_id']
+        return 0
+
+    def prepare_loan(self):
+        self.loan_id = self.active_loan()
+
+    def prepare_hold(self):
+        """当前读者的一条有效预约id，没有时为0（请求走“预约不存在”分支）"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.database, timeout=30, check_same_thread=False)
+        row = self._conn.execute(
+            "SELECT id FROM holds WHERE user_id = ? AND status IN ('waiting', 'ready') LIMIT 1",
+            (self.user_id,)).fetchone()
+        self.hold_id = row[0] if row else 0
+
+    def prepare_desk_checkout(self):
+        """借还书台借书前先还回上一批（不计时），再按热度挑选本批图书"""
+        if self.desk_items:
+            self.client.post('/api/v1/desk/checkin', json={'user_id': self.desk_patron, 'items': self.desk_items})
+        self.desk_items = list({self.book_id() for _ in range(app_simple.LOAN_MAX_ACTIVE)})
+
+    def prepare_desk_checkin(self):
+        """借还书台还书前先借出本批图书（不计时）"""
+        self.prepare_desk_checkout()
+        self.client.post('/api/v1/desk/checkout', json={'user_id': self.desk_patron, 'items': self.desk_items})
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+SEARCH_TERMS = ['Python', '数据库', '算法', '机器学习', 'Rust 实战', '系统设计']
+CATEGORY_TERMS = ['编程', '数学', '文学', '历史']
+SUGGEST_PREFIXES = ['py', '数据', 'ru', '算', 'ja', '机器']
+_NEXT_PAGE = re.compile(r'href="(/books\?[^"]*after=[^"]*)"')
+
+def _next_page_url(session):
+    html = session.client.get('/books').get_data(as_text=True)
+    match = _NEXT_PAGE.search(html)
+    return match.group(1).replace('&amp;', '&') if match else '/books'
+
+def _borrow(session):
+    return session.client.post(f'/borrow/{session.book_id()}')
+
+def _return(session):
+    return session.client.post(f'/return/{session.loan_id}')
+
+def _api_borrow(session):
+    return session.client.post(f'/api/v1/books/{session.book_id()}/borrow')
+
+def _api_return(session):
+    return session.client.post(f'/api/v1/loans/{session.loan_id}/return')
+
+def _export(session):
+    # 流式响应需要读完才算完成
+    response = session.client.get('/admin/export/loans', query_string={'overdue': '1'})
+    response.get_data()
+    return response
+
+def _audit(session):
+    response = session.client.get('/admin/audit', query_string={'kind': 'borrow'})
+    response.get_data()
+    return response
+
+def _desk(action):
+    def request(session):
+        return session.client.post(f'/api/v1/desk/{action}',
+                                   json={'user_id': session.desk_patron, 'items': session.desk_items})
+    return request
+
+def _save_policy(session):
+    # 以原值重新保存默认规则：走完整的校验、UPSERT和重新加载，但不改变规则
+    return session.client.post('/admin/policies', data={
+        'role': '*', 'category': '*', 'loan_days': app_simple.LOAN_DAYS,
+        'max_loans': app_simple.LOAN_MAX_ACTIVE, 'fine_per_day': app_simple.FINE_PER_DAY})
+
+def _login(session):
+    # 用新的客户端登录，不改变游客会话的身份
+    return app.test_client().post('/login', data={'username': 'reader0', 'password': BENCH_PASSWORD})
+
+# (场景名, endpoint, 身份, 并发阶段权重, 请求函数)
+SCENARIOS = [
+    ('index', 'index', 'guest', 10, lambda s: s.client.get('/')),
+    ('books', 'books', 'guest', 10, lambda s: s.client.get('/books')),
+    ('books_next_page', 'books', 'guest', 5, lambda s: s.client.get(s.next_page)),
+    ('books_search', 'books', 'guest', 10,
+     lambda s: s.client.get('/books', query_string={'search': s.rng.choice(SEARCH_TERMS)})),
+    ('books_category', 'books', 'guest', 5,
+     lambda s: s.client.get('/books', query_string={'category': s.rng.choice(CATEGORY_TERMS)})),
+    ('book_detail', 'book_detail', 'guest', 20, lambda s: s.client.get(f'/book/{s.book_id()}')),
+    ('register_form', 'register', 'guest', 1, lambda s: s.client.get('/register')),
+    ('login_form', 'login', 'guest', 1, lambda s: s.client.get('/login')),
+    ('login', 'login', 'guest', 1, _login),
+    ('logout', 'logout', 'guest', 1, lambda s: s.client.get('/logout')),
+    ('switch_branch', 'switch_branch', 'guest', 1, lambda s: s.client.get(f'/branch/{app_simple.MAIN_BRANCH}')),
+    ('my_loans', 'my_loans', 'user', 5, lambda s: s.client.get('/my_loans')),
+    ('borrow', 'borrow_book', 'user', 2, _borrow),
+    ('return', 'return_book', 'user', 2, _return),
+    ('hold', 'hold_book', 'user', 1, lambda s: s.client.post(f'/hold/{s.book_id()}')),
+    ('cancel_hold', 'cancel_hold_route', 'user', 1, lambda s: s.client.post(f'/hold/{s.hold_id}/cancel')),
+    ('admin', 'admin', 'admin', 1, lambda s: s.client.get('/admin')),
+    ('reports', 'reports', 'admin', 1, lambda s: s.client.get('/admin/reports')),
+    ('runtime_stats', 'runtime_stats', 'admin', 1, lambda s: s.client.get('/admin/runtime_stats')),
+    ('metrics', 'metrics', 'admin', 1, lambda s: s.client.get('/metrics')),
+    ('export_overdue', 'export_table', 'admin', 1, _export),
+    ('audit_log', 'audit_events', 'admin', 1, _audit),
+    ('policies', 'policies', 'admin', 1, lambda s: s.client.get('/admin/policies')),
+    ('save_policy', 'save_policy', 'admin', 1, _save_policy),
+    ('delete_policy', 'delete_policy', 'admin', 1, lambda s: s.client.post('/admin/policies/0/delete')),
+    ('set_user_role', 'set_user_role', 'admin', 1,
+     lambda s: s.client.post('/admin/user_role', data={'username': 'reader0', 'role': 'reader'})),
+    ('desk_checkout', 'api_desk_checkout', 'admin', 1, _desk('checkout')),
+    ('desk_checkin', 'api_desk_checkin', 'admin', 1, _desk('checkin')),
+    ('api_books', 'api_books', 'guest', 5, lambda s: s.client.get('/api/v1/books')),
+    ('api_books_search', 'api_books', 'guest', 3,
+     lambda s: s.client.get('/api/v1/books', query_string={'search': s.rng.choice(SEARCH_TERMS)})),
+    ('api_branch_books', 'api_branch_books', 'guest', 3,
+     lambda s: s.client.get('/api/v1/branches/books', query_string={'search': s.rng.choice(SEARCH_TERMS)})),
+    ('api_book', 'api_book', 'guest', 5, lambda s: s.client.get(f'/api/v1/books/{s.book_id()}')),
+    ('api_suggest', 'api_suggest', 'guest', 10,
+     lambda s: s.client.get('/api/v1/suggest', query_string={'q': s.rng.choice(SUGGEST_PREFIXES)})),
+    ('api_loans', 'api_loans', 'user', 3, lambda s: s.client.get('/api/v1/loans')),
+    ('api_borrow', 'api_borrow', 'user', 2, _api_borrow),
+    ('api_return', 'api_return', 'user', 2, _api_return),
+]
+
+# 计时前的准备步骤：归还场景先查出（必要时借出）一条在借记录，借还书台场景先准备本批图书
+PREPARE = {
+    'return': BenchSession.prepare_loan,
+    'api_return': BenchSession.prepare_loan,
+    'cancel_hold': BenchSession.prepare_hold,
+    'desk_checkout': BenchSession.prepare_desk_checkout,
+    'desk_checkin': BenchSession.prepare_desk_checkin,
+}
+
+def uncovered_endpoints():
+    """app中没有对应场景的endpoint"""
+    covered = {endpoint for _, endpoint, _, _, _ in SCENARIOS}
+    return sorted({rule.endpoint for rule in app.url_map.iter_rules()} - covered - {'static'})
+
+def percentile(values, pct):
+    """最近秩百分位数"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(latencies, seconds, errors=0):
+    """延迟列表（毫秒）汇总为分位数与吞吐量"""
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / seconds, 1) if seconds else None,
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(max(latencies), 3),
+    }
+
+def _timed(name, func, session):
+    """执行一次请求，返回 (毫秒, 是否出错)；5xx算作错误"""
+    prepare = PREPARE.get(name)
+    if prepare is not None:
+        prepare(session)
+    start = time.perf_counter()
+    response = func(session)
+    elapsed = (time.perf_counter() - start) * 1000
+    return elapsed, response.status_code >= 500
+
+def _make_session(role, data, index, seed):
+    username = user_id = None
+    if role == 'user':
+        reader = index % len(data['user_ids'])
+        username, user_id = f'reader{reader}', data['user_ids'][reader]
+    session = BenchSession(role, username, user_id, seed=seed + index,
+                           popular_books=data['popular_books'], database=app_simple.DATABASE)
+    # 借还书台为另一端的读者办理，不与读者会话的借阅互相影响
+    session.desk_patron = data['user_ids'][-1 - index % len(data['user_ids'])]
+    session.next_page = _next_page_url(session)
+    return session
+
+def run_sequential(data, iterations, seed=0):
+    """每个场景单独请求iterations次"""
+    sessions = {role: _make_session(role, data, 0, seed) for role in ('guest', 'user', 'admin')}
+    results = {}
+    for name, _, role, _, func in SCENARIOS:
+        session = sessions[role]
+        _timed(name, func, session)  # 预热
+        latencies, errors = [], 0
+        start = time.perf_counter()
+        for _ in range(iterations):
+            elapsed, failed = _timed(name, func, session)
+            latencies.append(elapsed)
+            errors += failed
+        results[name] = summarize(latencies, time.perf_counter() - start, errors)
+    for session in sessions.values():
+        session.close()
+    return results
+
+def run_concurrent(data, threads, requests_per_thread, seed=0):
+    """threads个线程按场景权重混合请求，返回整体与分场景汇总"""
+    weights = [weight for _, _, _, weight, _ in SCENARIOS]
+    latencies = {name: [] for name, _, _, _, _ in SCENARIOS}
+    errors = {name: 0 for name, _, _, _, _ in SCENARIOS}
+    lock = threading.Lock()
+
+    # 登录（scrypt）不计入压测时间
+    workers = [{role: _make_session(role, data, index + 1, seed) for role in ('guest', 'user', 'admin')}
+               for index in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(sessions, rng):
+        barrier.wait()
+        local = []
+        for _ in range(requests_per_thread):
+            name, _, role, _, func = rng.choices(SCENARIOS, weights=weights)[0]
+            elapsed, failed = _timed(name, func, sessions[role])
+            local.append((name, elapsed, failed))
+        with lock:
+            for name, elapsed, failed in local:
+                latencies[name].append(elapsed)
+                errors[name] += failed
+
+    pool = [threading.Thread(target=worker, args=(sessions, random.Random(seed * 1000 + i)))
+            for i, sessions in enumerate(workers)]
+    for thread in pool:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for sessions in workers:
+        for session in sessions.values():
+            session.close()
+
+    everything = [value for values in latencies.values() for value in values]
+    return {
+        'threads': threads,
+        'overall': summarize(everything, elapsed, sum(errors.values())),
+        'scenarios': {name: summarize(values, elapsed, errors[name])
+                      for name, values in latencies.items() if values},
+    }
@@ -1,114 +1,218 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+清理重复的书籍记录
+按规范化ISBN、以及规范化的书名+作者（忽略大小写、全半角和标点）聚类，
+合并库存到每组ID最小的记录，并在同一个事务中把借阅和预约记录指向保留的图书
 
+用法: python cleanup_duplicates.py [--dry-run] [--branch 代码]
+"""
+
+import argparse
 import sqlite3
-import os
+import time
 
-DATABASE = 'library.db'
+from app_simple import MAIN_BRANCH, branch_database, fold_text, normalize_isbn, run_transaction
 
-def cleanup_duplicate_books():
-    """清理重复的书籍记录"""
-    
-    print("🧹 开始清理重复书籍...")
-    
-    # 连接数据库
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+def isbn_key(isbn):
+    """ISBN聚类键：有效ISBN统一为ISBN-13，无效的只去掉分隔符"""
+    if not isbn:
+        return None
+    try:
+        return normalize_isbn(isbn)
+    except ValueError:
+        return isbn.replace('-', '').replace(' ', '').upper() or None
+
+def find_duplicate_clusters(conn):
+    """扫描一次books表，返回 {保留id: [重复id...]} 和每本书的库存信息
+
+    同一ISBN直接合并；书名+作者相同的记录只有在不会把两个不同ISBN合并到一起时才合并。
+    """
+    parent = {}
+
+    def find(book_id):
+        root = book_id
+        while parent[root] != root:
+            root = parent[root]
+        while parent[book_id] != root:
+            parent[book_id], book_id = root, parent[book_id]
+        return root
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            # 保留较小的id作为根
+            parent[max(a, b)] = min(a, b)
+
+    books = {}
+    by_isbn = {}
+    by_title = {}
+    for book_id, isbn, title, author, total, available in conn.execute(
+            'SELECT id, isbn, title, author, total_copies, available_copies FROM books'):
+        parent[book_id] = book_id
+        key = isbn_key(isbn)
+        books[book_id] = (key, total or 0, available or 0)
+        if key:
+            if key in by_isbn:
+                union(by_isbn[key], book_id)
+            else:
+                by_isbn[key] = book_id
+        by_title.setdefault((fold_text(title), fold_text(author)), []).append(book_id)
+
+    for ids in by_title.values():
+        if len(ids) < 2:
+            continue
+        roots = {find(book_id) for book_id in ids}
+        isbns = {books[book_id][0] for book_id in ids if books[book_id][0]}
+        isbns |= {books[root][0] for root in roots if books[root][0]}
+        if len(isbns) <= 1:
+            for book_id in ids[1:]:
+                union(ids[0], book_id)
+
+    clusters = {}
+    for book_id in books:
+        root = find(book_id)
+        if root != book_id:
+            clusters.setdefault(root, []).append(book_id)
+    return clusters, books
+
+def _merge_clusters(conn, clusters, books):
+    """在一个事务中合并库存、改指借阅和预约记录并删除重复图书
     
-    # 1. 找出所有重复的书籍标题
-    cursor.execute('''
-        SELECT title, COUNT(*) as count, GROUP_CONCAT(id) as ids
-        FROM books 
-        GROUP BY title 
-        HAVING COUNT(*) > 1
-        ORDER BY count DESC
+    返回 (改指的借阅数, 改指的预约数, 取消的重复预约数)
+    """
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS dedup_map (old_id INTEGER PRIMARY KEY, keep_id INTEGER NOT NULL)')
+    conn.execute('DELETE FROM dedup_map')
+    conn.executemany('INSERT INTO dedup_map (old_id, keep_id) VALUES (?, ?)',
+                     ((old_id, keep_id) for keep_id, ids in clusters.items() for old_id in ids))
+
+    # 保留记录的库存为整组之和，缺少ISBN时用组内其他记录的ISBN补齐
+    updates = []
+    for keep_id, ids in clusters.items():
+        group = [keep_id] + ids
+        isbn = next((books[book_id][0] for book_id in group if books[book_id][0]), None)
+        updates.append((sum(books[book_id][1] for book_id in group),
+                        sum(books[book_id][2] for book_id in group),
+                        isbn, keep_id))
+    conn.executemany('''
+        UPDATE books SET total_copies = ?, available_copies = ?, isbn = COALESCE(isbn, ?)
+        WHERE id = ?
+    ''', updates)
+
+    cursor = conn.execute('''
+        UPDATE loans SET book_id = (SELECT keep_id FROM dedup_map WHERE old_id = loans.book_id)
+        WHERE book_id IN (SELECT old_id FROM dedup_map)
     ''')
-    
-    duplicate_groups = cursor.fetchall()
-    
-    if not duplicate_groups:
+    repointed = cursor.rowcount
+
+    # 同一读者在一组重复图书上的多个有效预约只保留一个（优先已到书的，其次最早的），
+    # 取消的已到书预约把为其保留的副本放回库存
+    rows = conn.execute('''
+        SELECT h.id, h.user_id, h.status, COALESCE(m.keep_id, h.book_id) AS keep_id
+        FROM holds h LEFT JOIN dedup_map m ON m.old_id = h.book_id
+        WHERE h.status IN ('waiting', 'ready')
+          AND (h.book_id IN (SELECT old_id FROM dedup_map) OR h.book_id IN (SELECT keep_id FROM dedup_map))
+        ORDER BY h.user_id, keep_id, h.status = 'ready' DESC, h.created_at, h.id
+    ''').fetchall()
+    seen = set()
+    cancelled = []
+    for hold_id, user_id, status, keep_id in rows:
+        if (user_id, keep_id) in seen:
+            cancelled.append((hold_id, status, keep_id))
+        seen.add((user_id, keep_id))
+    conn.executemany("UPDATE holds SET status = 'cancelled' WHERE id = ?",
+                     ((hold_id,) for hold_id, _, _ in cancelled))
+    conn.executemany('UPDATE books SET available_copies = available_copies + 1 WHERE id = ?',
+                     ((keep_id,) for _, status, keep_id in cancelled if status == 'ready'))
+
+    cursor = conn.execute('''
+        UPDATE holds SET book_id = (SELECT keep_id FROM dedup_map WHERE old_id = holds.book_id)
+        WHERE book_id IN (SELECT old_id FROM dedup_map)
+    ''')
+    repointed_holds = cursor.rowcount
+
+    conn.execute('DELETE FROM books WHERE id IN (SELECT old_id FROM dedup_map)')
+    conn.execute('DELETE FROM dedup_map')
+    return repointed, repointed_holds, len(cancelled)
+
+def cleanup_duplicate_books(dry_run=False, database=None):
+    """清理重复的书籍记录"""
+
+    print("🧹 开始清理重复书籍..." + ("（演练模式，不修改数据）" if dry_run else ""))
+    start = time.perf_counter()
+
+    # 连接数据库
+    conn = sqlite3.connect(database or branch_database(MAIN_BRANCH), timeout=30)
+
+    clusters, books = find_duplicate_clusters(conn)
+
+    if not clusters:
         print("✅ 没有发现重复书籍！")
         conn.close()
         return
-    
-    print(f"📚 发现 {len(duplicate_groups)} 组重复书籍：")
-    total_removed = 0
-    total_preserved = 0
-    
-    for title, count, ids_str in duplicate_groups:
-        ids = [int(id_str) for id_str in ids_str.split(',')]
-        print(f"\n📖 书籍: {title}")
-        print(f"   重复数量: {count} 本 (ID: {ids})")
-        
-        # 获取所有重复记录的信息
-        placeholders = ','.join('?' * len(ids))
-        cursor.execute(f'''
-            SELECT id, total_copies, available_copies, author, category, description, isbn
-            FROM books WHERE id IN ({placeholders})
-        ''', ids)
-        
-        records = cursor.fetchall()
-        print(f"   详细信息:")
-        for record in records:
-            book_id, total, available, author, category, description, isbn = record
-            print(f"     ID:{book_id} | 总数:{total} | 可借:{available} | 作者:{author}")
-        
-        # 合并所有副本数量到第一个记录
-        first_record = records[0]
-        first_id = first_record[0]
-        total_copies_sum = sum(record[1] for record in records)  # total_copies
-        available_copies_sum = sum(record[2] for record in records)  # available_copies
-        
-        print(f"   ✅ 保留 ID:{first_id}，合并副本: 总数{total_copies_sum}, 可借{available_copies_sum}")
-        
-        # 更新保留记录的副本数量
-        cursor.execute('''
-            UPDATE books 
-            SET total_copies = ?, available_copies = ?
-            WHERE id = ?
-        ''', (total_copies_sum, available_copies_sum, first_id))
-        
-        total_preserved += 1
-        
-        # 删除其他重复记录（除了第一个）
-        duplicate_ids = ids[1:]
-        placeholders = ','.join('?' * len(duplicate_ids))
-        cursor.execute(f'DELETE FROM books WHERE id IN ({placeholders})', duplicate_ids)
-        
-        removed_count = len(duplicate_ids)
-        total_removed += removed_count
-        print(f"   🗑️  删除 {removed_count} 个重复记录")
-        
-        # 提交这个组的处理
-        conn.commit()
-    
-    print(f"\n🎉 清理完成！")
+
+    total_removed = sum(len(ids) for ids in clusters.values())
+    print(f"📚 扫描 {len(books)} 本书，发现 {len(clusters)} 组重复书籍，"
+          f"耗时 {time.perf_counter() - start:.2f} 秒")
+
+    # 展示重复最多的几组
+    for keep_id, ids in sorted(clusters.items(), key=lambda item: -len(item[1]))[:10]:
+        title, author = conn.execute('SELECT title, author FROM books WHERE id = ?', (keep_id,)).fetchone()
+        total = sum(books[book_id][1] for book_id in [keep_id] + ids)
+        available = sum(books[book_id][2] for book_id in [keep_id] + ids)
+        print(f"\n📖 书籍: {title} - {author}")
+        print(f"   ✅ 保留 ID:{keep_id}，合并 {len(ids)} 条重复记录，副本: 总数{total}, 可借{available}")
+    if len(clusters) > 10:
+        print(f"\n   ……其余 {len(clusters) - 10} 组省略")
+
+    if dry_run:
+        affected_loans = 0
+        ids = [book_id for group in clusters.values() for book_id in group]
+        for offset in range(0, len(ids), 500):
+            chunk = ids[offset:offset + 500]
+            affected_loans += conn.execute(
+                f'SELECT COUNT(*) FROM loans WHERE book_id IN ({",".join("?" * len(chunk))})',
+                chunk).fetchone()[0]
+        print(f"\n📝 演练结果：将删除 {total_removed} 条重复记录，改指 {affected_loans} 条借阅记录")
+        conn.close()
+        return
+
+    repointed, repointed_holds, cancelled_holds = run_transaction(conn, _merge_clusters, clusters, books)
+
+    print(f"\n🎉 清理完成！耗时 {time.perf_counter() - start:.2f} 秒")
     print(f"   📊 统计结果:")
-    print(f"   - 保留书籍: {total_preserved} 本")
+    print(f"   - 保留书籍: {len(clusters)} 本")
     print(f"   - 删除重复: {total_removed} 本")
-    print(f"   - 节省空间: {total_removed} 条记录")
-    
+    print(f"   - 改指借阅: {repointed} 条")
+    print(f"   - 改指预约: {repointed_holds} 条（取消重复预约 {cancelled_holds} 条）")
+
     # 显示清理后的统计信息
-    total_books = cursor.execute('SELECT COUNT(*) FROM books').fetchone()[0]
-    
+    total_books = conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+
     # 按分类统计
-    cursor.execute('''
+    categories = conn.execute('''
         SELECT category, COUNT(*) as count, SUM(total_copies) as total_copies
-        FROM books 
-        GROUP BY category 
+        FROM books
+        GROUP BY category
         ORDER BY count DESC
-    ''')
-    
-    categories = cursor.fetchall()
-    
+    ''').fetchall()
+
     print(f"\n📈 清理后的数据库统计:")
     print(f"   总书籍数量: {total_books} 本")
     print(f"\n📚 分类统计:")
     for category, count, total_copies in categories:
         print(f"   {category}: {count} 本 (总副本: {total_copies})")
-    
+
     conn.close()
     print(f"\n✅ 数据库清理完成！")
 
 if __name__ == '__main__':
-    cleanup_duplicate_books()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='清理重复的书籍记录')
+    parser.add_argument('--dry-run', action='store_true', help='只输出报告，不修改数据')
+    parser.add_argument('--branch', default=MAIN_BRANCH, help='清理指定分馆的书籍，默认总馆')
+    args = parser.parse_args()
+    try:
+        database = branch_database(args.branch)
+    except ValueError as e:
+        parser.error(str(e))
+    cleanup_duplicate_books(dry_run=args.dry_run, database=database)
@@ -7,6 +7,8 @@
 
 import sqlite3
 import os
+import re
+import sys
 from datetime import datetime
 
 def test_database_connection():
@@ -118,23 +120,8 @@ def test_database_connection():
         print("\n" + "=" * 40)
         print("🔍 数据完整性检查")
         print("=" * 40)
-        
-        # 检查孤儿借阅记录
-        cursor.execute("""
-            SELECT COUNT(*) FROM loans l 
-            LEFT JOIN users u ON l.user_id = u.id 
-            WHERE u.id IS NULL
-        """)
-        orphan_loans = cursor.fetchone()[0]
-        print(f"🔗 孤儿借阅记录：{orphan_loans} (应该为0)")
-        
-        # 检查库存一致性
-        cursor.execute("""
-            SELECT COUNT(*) FROM books 
-            WHERE available_copies > total_copies OR available_copies < 0
-        """)
-        inventory_issues = cursor.fetchone()[0]
-        print(f"📦 库存异常记录：{inventory_issues} (应该为0)")
+        from app_simple import check_integrity, print_integrity
+        print_integrity(check_integrity(conn))
         
         # 关闭连接
         conn.close()
@@ -193,6 +180,310 @@ def show_table_schemas():
     except sqlite3.Error as e:
         print(f"❌ 数据库错误：{e}")
 
+# 已知且暂时允许的全表扫描（按SQL片段匹配）
+KNOWN_FULL_SCANS = [
+    'FROM library_stats',  # 统计计数表只有固定的几行
+    'FROM loan_policies',  # 借阅规则条数很少，只在规则变更后整体加载编译
+    'FROM category_copies',  # 每个分类一行
+    # 待处理队列按插入顺序取一批，处理完即删除
+    'SELECT book_id FROM suggest_dirty LIMIT',
+    'SELECT id FROM loan_events ORDER BY id LIMIT',
+    # 不带筛选条件的导出本来就要读出全部行，按索引顺序流式输出，不在内存中排序
+    'FROM books ORDER BY created_at, id',
+    'ORDER BY l.loan_date, l.id',
+    'SELECT ts, kind, actor_id, user_id, book_id, loan_id, data FROM audit_',
+]
+
+def is_full_scan(sql, detail):
+    """查询计划的一行是否为全表扫描
+    
+    SCAN x（含按索引顺序遍历整个索引的 SCAN x USING [COVERING] INDEX），以及由
+    col IS NOT NULL 得到的范围查找 SEARCH x USING INDEX ... (col>?)，都会读完整张表或
+    整个索引，除非SQL带LIMIT只取前几条。子查询结果集（如 SCAN (subquery-1)）已由
+    内层语句限定大小，FTS5虚拟表和VALUES常量行也不算。
+    """
+    limited = re.search(r'\bLIMIT\b', sql, re.IGNORECASE) is not None
+    if detail.startswith('SCAN '):
+        if detail.startswith('SCAN (') or 'VIRTUAL TABLE' in detail or 'CONSTANT ROW' in detail:
+            return False
+        return 'USING' not in detail or not limited
+    match = re.search(r'\((\w+)>\?\)$', detail)
+    if detail.startswith('SEARCH ') and match:
+        return not limited and re.search(rf'\b{match.group(1)}\s+IS\s+NOT\s+NULL', sql, re.IGNORECASE) is not None
+    return False
+
+def test_query_plans():
+    """EXPLAIN QUERY PLAN回归测试：各路由和后台任务执行的SQL不应退化为全表扫描"""
+    import tempfile
+    import app_simple
+    
+    print("\n" + "=" * 60)
+    print("🔍 查询计划检查")
+    print("=" * 60)
+    
+    fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    
+    # 在临时数据库上驱动各个路由，记录实际执行的SQL；
+    # 导出、跨分馆搜索等直接从连接池取连接，所以在建立连接时挂上跟踪
+    executed = []
+    original_database = app_simple.DATABASE
+    original_connect = app_simple.ConnectionPool._connect
+    
+    def traced_connect(pool, *args, **kwargs):
+        conn = original_connect(pool, *args, **kwargs)
+        conn.set_trace_callback(executed.append)
+        return conn
+    
+    try:
+        app_simple.DATABASE = db_path
+        app_simple.ConnectionPool._connect = traced_connect
+        # 测试客户端不启动后台任务，下面直接调用各个任务
+        app_simple.app.config['TESTING'] = True
+        with app_simple.app.app_context():
+            app_simple.init_db()
+        # 建表和迁移语句不属于请求路径
+        del executed[:]
+        
+        reader = app_simple.app.test_client()
+        reader.post('/register', data={'username': 'plan_test', 'email': 'plan@test.com',
+                                       'password': 'plan123', 'confirm_password': 'plan123'})
+        reader.post('/login', data={'username': 'plan_test', 'password': 'plan123'})
+        admin = app_simple.app.test_client()
+        admin.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        
+        # 借书、预约排队、还书后副本转给队首、取消预约
+        reader.post('/borrow/1')
+        reader.post('/borrow/4')
+        admin.post('/hold/4')
+        for url in ['/', '/books', '/books?search=Python', '/books?search=算法', '/books?search=Python 编程',
+                    '/books?category=编程',
+                    '/book/1', '/book/4', '/my_loans', '/api/v1/books', '/api/v1/books/1',
+                    '/api/v1/branches/books?search=Python', '/api/v1/loans', '/api/v1/suggest?q=py']:
+            reader.get(url)
+        reader.post('/return/2')
+        admin.get('/my_loans')
+        admin.post('/hold/1/cancel')
+        reader.post('/return/1')
+        reader.post('/api/v1/books/2/borrow')
+        reader.post('/api/v1/loans/3/return')
+        
+        # 借还书台批量借还（图书id和ISBN混用）
+        desk = {'user_id': 2, 'items': [3, '978-7-111-56789-4']}
+        admin.post('/api/v1/desk/checkout', json=desk)
+        admin.post('/api/v1/desk/checkin', json=desk)
+        
+        # 后台任务：逾期计算、搜索建议、预约过期、到期提醒、借阅统计汇总、审计日志
+        pool = app_simple.get_pool(db_path)
+        conn = pool.acquire()
+        try:
+            for job in (app_simple.refresh_overdue, app_simple.refresh_suggestions, app_simple.expire_holds,
+                        app_simple.schedule_notifications, app_simple.refresh_rollups,
+                        app_simple.flush_audit_log):
+                job(conn)
+        finally:
+            pool.release(conn)
+        
+        # 管理页面、报表、导出（流式响应需要读完才会执行查询）
+        for url in ['/admin', '/admin/reports', '/admin/reports?format=json', '/admin/policies',
+                    '/admin/export/books', '/admin/export/books?category=编程',
+                    '/admin/export/users?start=2000-01-01&end=2099-12-31',
+                    '/admin/export/loans', '/admin/export/loans?overdue=1',
+                    '/admin/audit', '/admin/audit?kind=borrow&start=2000-01-01']:
+            admin.get(url).get_data()
+    finally:
+        app_simple.DATABASE = original_database
+        app_simple.ConnectionPool._connect = original_connect
+    
+    conn = sqlite3.connect(db_path)
+    checked = 0
+    full_scans = []
+    for sql in dict.fromkeys(executed):
+        if not sql.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+            continue
+        # 跳过系统表和FTS5内部语句
+        if 'sqlite_master' in sql or "'main'." in sql:
+            continue
+        if any(fragment in sql for fragment in KNOWN_FULL_SCANS):
+            continue
+        checked += 1
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+            if is_full_scan(sql, row[3]):
+                full_scans.append((' '.join(sql.split()), row[3]))
+    conn.close()
+    os.remove(db_path)
+    
+    print(f"📋 检查SQL语句：{checked} 条")
+    for sql, detail in full_scans:
+        print(f"❌ 全表扫描：{detail}\n   {sql}")
+    
+    assert not full_scans, f'发现 {len(full_scans)} 条全表扫描的SQL'
+    print("✅ 没有发现全表扫描")
+
+def test_short_search_index():
+    """两字、单字的中文查询使用短词索引而不是LIKE全表扫描，且结果与LIKE一致并随图书修改同步"""
+    import tempfile
+    import app_simple
+    
+    print("\n" + "=" * 60)
+    print("🔍 短词搜索索引检查")
+    print("=" * 60)
+    
+    fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    original_database = app_simple.DATABASE
+    app_simple.DATABASE = db_path
+    pool = app_simple.get_pool(db_path)
+    conn = pool.acquire()
+    try:
+        app_simple.setup_database(conn)
+        
+        def search_ids(search):
+            return sorted(row['id'] for row in app_simple.search_books(conn, search, ''))
+        
+        def like_ids(search):
+            param = f'%{search}%'
+            return sorted(row[0] for row in conn.execute(
+                'SELECT id FROM books WHERE title LIKE ? OR author LIKE ? OR isbn LIKE ? OR description LIKE ?',
+                (param,) * 4))
+        
+        query, params, _, _ = app_simple.build_books_query(conn, '算法', '')
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+        print(f"📋 “算法”的查询计划：{'；'.join(plan)}")
+        assert any('books_fts_short' in detail for detail in plan), '两字查询没有使用短词索引'
+        assert not any(detail.split()[:2] in (['SCAN', 'b'], ['SCAN', 'books']) for detail in plan), \
+            '两字查询仍在扫描books表'
+        
+        for search in ['算法', '法', '教材', 'Py', '编程 Python', 'X']:
+            expected = sorted(set(like_ids(search.split()[0])).intersection(*map(like_ids, search.split())))
+            assert search_ids(search) == expected, f'“{search}”的结果与LIKE不一致'
+        
+        conn.execute("UPDATE books SET title = '数据结构与算法' WHERE id = 1")
+        conn.execute('DELETE FROM books WHERE id = 4')
+        conn.commit()
+        assert search_ids('算法') == [1], '修改、删除图书后短词索引没有同步'
+        assert search_ids('入门') == [], '修改书名后旧书名仍能搜到'
+    finally:
+        pool.release(conn)
+        app_simple.DATABASE = original_database
+        os.remove(db_path)
+    
+    print("✅ 短词查询使用索引，结果与LIKE一致")
+
+def test_suggest_popularity():
+    """前缀相同的冷门书很多时，搜索建议仍按借阅次数返回最热门的图书"""
+    import tempfile
+    import app_simple
+    
+    print("\n" + "=" * 60)
+    print("💡 搜索建议热度检查")
+    print("=" * 60)
+    
+    fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    original_database = app_simple.DATABASE
+    app_simple.DATABASE = db_path
+    app_simple.app.config['TESTING'] = True
+    pool = app_simple.get_pool(db_path)
+    conn = pool.acquire()
+    try:
+        app_simple.setup_database(conn)
+        conn.executemany("""
+            INSERT INTO books (title, author, isbn, category, total_copies, available_copies)
+            VALUES (?, '佚名', ?, '编程', 1, 1)
+        """, [(f'Pa{i:03d}', f'isbn-pa-{i}') for i in range(100)])
+        conn.execute("UPDATE books SET loan_count = 1000 WHERE title LIKE 'Python%'")
+        conn.commit()
+        app_simple.refresh_suggestions(conn, drain=True)
+        
+        client = app_simple.app.test_client()
+        titles = [item['title'] for item in client.get('/api/v1/suggest?q=p').get_json()['items']]
+        assert titles and titles[0].startswith('Python'), f'热门图书没有排在搜索建议首位: {titles}'
+        
+        # 借阅次数变化后不等后台任务重建索引即生效
+        conn.execute("UPDATE books SET loan_count = 5000 WHERE title = 'Pa050'")
+        conn.commit()
+        titles = [item['title'] for item in client.get('/api/v1/suggest?q=pa05').get_json()['items']]
+        assert titles[:1] == ['Pa050'], f'借阅次数更新后搜索建议顺序没有变化: {titles}'
+    finally:
+        pool.release(conn)
+        app_simple.DATABASE = original_database
+        os.remove(db_path)
+    
+    print("✅ 搜索建议按借阅次数取候选")
+
+def test_branches():
+    """两个分馆：读者账户全馆统一，切换分馆保持登录，借阅写入所在分馆的数据库，跨分馆搜索合并馆藏"""
+    import json
+    import shutil
+    import tempfile
+    import app_simple
+    
+    print("\n" + "=" * 60)
+    print("🏢 多分馆检查")
+    print("=" * 60)
+    
+    directory = tempfile.mkdtemp()
+    config = {code: [name, os.path.join(directory, f'{code}.db')]
+              for code, name in [('east', '东区分馆'), ('west', '西区分馆')]}
+    original_database = app_simple.DATABASE
+    original_branches = app_simple.BRANCHES
+    try:
+        app_simple.DATABASE = os.path.join(directory, 'main.db')
+        app_simple.app.config['TESTING'] = True
+        app_simple.BRANCHES = app_simple.load_branches(json.dumps(config, ensure_ascii=False))
+        assert sorted(app_simple.BRANCHES) == ['east', 'west'], '分馆配置没有加载'
+        for bad in ['{"main": ["总馆", "x.db"]}', '{"east": "east.db"}', '[]']:
+            try:
+                app_simple.load_branches(bad)
+            except ValueError:
+                continue
+            raise AssertionError(f'无效的分馆配置没有报错: {bad}')
+        with app_simple.app.app_context():
+            app_simple.init_branches()
+        
+        reader = app_simple.app.test_client()
+        reader.post('/register', data={'username': 'branch_test', 'email': 'branch@test.com',
+                                       'password': 'test1234', 'confirm_password': 'test1234'})
+        reader.post('/login', data={'username': 'branch_test', 'password': 'test1234'})
+        for code, book_id in [('east', 1), ('west', 2)]:
+            reader.get(f'/branch/{code}')
+            assert reader.get('/my_loans').status_code == 200, f'切换到{code}后登录状态丢失'
+            reader.post(f'/borrow/{book_id}')
+        
+        def loans(database):
+            conn = sqlite3.connect(database)
+            try:
+                return conn.execute('SELECT user_id, book_id FROM loans').fetchall()
+            finally:
+                conn.close()
+        
+        main = sqlite3.connect(app_simple.DATABASE)
+        try:
+            user_id = main.execute("SELECT id FROM users WHERE username = 'branch_test'").fetchone()[0]
+        finally:
+            main.close()
+        assert loans(config['east'][1]) == [(user_id, 1)], '东区分馆的借阅没有写入东区数据库'
+        assert loans(config['west'][1]) == [(user_id, 2)], '西区分馆的借阅没有写入西区数据库'
+        assert loans(app_simple.DATABASE) == [], '分馆的借阅写入了总馆数据库'
+        
+        admin = app_simple.app.test_client()
+        admin.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        admin.get('/branch/west')
+        export = admin.get('/admin/export/loans').get_data(as_text=True)
+        assert 'branch_test' in export, '分馆的借阅导出没有关联到总馆的读者账户'
+        
+        result = reader.get('/api/v1/branches/books?search=Python').get_json()
+        assert result['branches'] == 3 and not result['errors'], f'跨分馆搜索出错: {result["errors"]}'
+        holdings = {holding['branch'] for item in result['items'] for holding in item['holdings']}
+        assert holdings == {'main', 'east', 'west'}, f'跨分馆搜索没有合并全部分馆: {holdings}'
+    finally:
+        app_simple.DATABASE = original_database
+        app_simple.BRANCHES = original_branches
+        shutil.rmtree(directory)
+    
+    print("✅ 两个分馆共用读者账户，借阅按分馆分开保存")
+
 if __name__ == "__main__":
     # 运行连接测试
     success = test_database_connection()
@@ -210,4 +501,14 @@ if __name__ == "__main__":
         print("3. 添加SQLite连接，文件路径：c:\\Users\\27970\\Documents\\trae_projects\\demo\\LibraryManager\\library.db")
         print("4. 连接名称：图书馆管理系统")
     else:
-        print("\n❌ 测试失败，请检查数据库文件")
\ No newline at end of file
+        print("\n❌ 测试失败，请检查数据库文件")
+    
+    # 以下检查使用临时数据库，不依赖library.db；发现全表扫描或检查失败时以非0状态退出
+    try:
+        test_query_plans()
+        test_short_search_index()
+        test_suggest_popularity()
+        test_branches()
+    except AssertionError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+导出图书、用户或借阅记录为CSV（带BOM，可用Excel直接打开）
+逐块从数据库读取并写出，内存占用与数据量无关
+
+用法: python export_data.py loans [--start 2024-01-01] [--end 2024-12-31] [--category 编程] [--overdue] [-o loans.csv]
+      [--branch 代码]
+      不指定 -o 时输出到标准输出
+"""
+
+import argparse
+import sys
+import time
+
+from app_simple import EXPORT_TABLES, MAIN_BRANCH, branch_database, export_query, get_pool, iter_csv
+
+class CountingCursor:
+    """记录fetchmany取出的行数"""
+    
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rows = 0
+    
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        self.rows += len(rows)
+        return rows
+
+def export(table, output, database, **filters):
+    """导出到文件对象，返回写出的数据行数"""
+    sql, params, headers = export_query(table, **filters)
+    # 连接池的分馆连接附加了总馆的读者账户，借阅记录可以关联到读者
+    pool = get_pool(database)
+    conn = pool.acquire()
+    try:
+        cursor = CountingCursor(conn.execute(sql, params))
+        for chunk in iter_csv(cursor, headers):
+            output.write(chunk)
+    finally:
+        pool.release(conn)
+    return cursor.rows
+
+def main():
+    parser = argparse.ArgumentParser(description='导出数据为CSV')
+    parser.add_argument('table', choices=sorted(EXPORT_TABLES), help='要导出的表')
+    parser.add_argument('--start', help='开始日期 YYYY-MM-DD（含）')
+    parser.add_argument('--end', help='结束日期 YYYY-MM-DD（含）')
+    parser.add_argument('--category', help='按图书分类筛选（books/loans）')
+    parser.add_argument('--overdue', action='store_true', help='只导出逾期未还的借阅（loans）')
+    parser.add_argument('-o', '--output', help='输出文件，默认标准输出')
+    parser.add_argument('--branch', default=MAIN_BRANCH, help='导出指定分馆的数据，默认总馆')
+    args = parser.parse_args()
+
+    filters = dict(start=args.start, end=args.end, category=args.category, overdue=args.overdue)
+    start = time.perf_counter()
+    try:
+        database = branch_database(args.branch)
+        if args.output:
+            # newline=''：csv模块自己输出行尾
+            with open(args.output, 'w', encoding='utf-8', newline='') as f:
+                rows = export(args.table, f, database, **filters)
+        else:
+            rows = export(args.table, sys.stdout, database, **filters)
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+
+    print(f"✅ 导出 {rows} 行，耗时 {time.perf_counter() - start:.2f} 秒", file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量导入图书目录
+支持CSV / JSONL / MARC-lite，分批流式读取，按ISBN去重，每批一个事务并记录断点，
+中断后再次运行同一文件会从上次提交的位置继续
+
+用法: python import_books.py books.csv [--format csv|jsonl|marc] [--batch-size 5000] [--restart] [--branch 代码]
+
+CSV/JSONL字段：isbn, title, author, category, description, copies
+MARC-lite：每条记录若干行“字段号 内容”，记录之间空行分隔，
+          020=ISBN 100=作者 245=书名 520=简介 650=分类
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+
+from app_simple import (ISBN_KEY_SQL, MAIN_BRANCH, branch_database, get_pool, isbn_lookup_keys, normalize_isbn,
+                        refresh_suggestions, run_transaction)
+
+MARC_FIELDS = {'020': 'isbn', '100': 'author', '245': 'title', '520': 'description', '650': 'category'}
+LOOKUP_CHUNK = 500  # 单条IN查询的参数个数上限
+
+def read_csv(path):
+    """逐行读取CSV"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        yield from csv.DictReader(f)
+
+def read_jsonl(path):
+    """逐行读取JSONL，无法解析的行返回None"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+def read_marc(path):
+    """读取MARC-lite文本记录"""
+    record = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                if record:
+                    yield record
+                record = {}
+                continue
+            tag, _, value = line.lstrip('=').partition(' ')
+            field = MARC_FIELDS.get(tag)
+            if field and field not in record:
+                # 去掉子字段标记，如“$a”
+                value = value.strip()
+                record[field] = value[2:].strip() if value.startswith('$') else value
+    if record:
+        yield record
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl, 'marc': read_marc}
+EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.mrk': 'marc', '.marc': 'marc'}
+
+def normalize_record(raw):
+    """校验并规范化一条记录，返回插入books表的参数元组，无效时抛出ValueError"""
+    if not isinstance(raw, dict):
+        raise ValueError('无法解析的记录')
+    
+    def text(key):
+        value = raw.get(key)
+        return str(value).strip() if value is not None else ''
+    
+    title, author = text('title'), text('author')
+    if not title or not author:
+        raise ValueError('缺少书名或作者')
+    
+    isbn = normalize_isbn(raw.get('isbn'))
+    try:
+        copies = int(raw.get('copies') or raw.get('total_copies') or 1)
+    except (TypeError, ValueError):
+        raise ValueError(f'库存数量错误: {raw.get("copies")}')
+    if copies < 1:
+        raise ValueError(f'库存数量错误: {copies}')
+    
+    return (isbn, title, author, text('category') or None, text('description'), copies, copies)
+
+def existing_isbn_keys(db, rows):
+    """查询本批ISBN中已存在于books表的规范化键"""
+    keys = [key for row in rows if row[0] for key in isbn_lookup_keys(row[0])]
+    found = set()
+    for start in range(0, len(keys), LOOKUP_CHUNK):
+        chunk = keys[start:start + LOOKUP_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        found.update(row[0] for row in db.execute(
+            f'SELECT {ISBN_KEY_SQL} FROM books WHERE {ISBN_KEY_SQL} IN ({placeholders})', chunk))
+    return found
+
+def _import_batch(db, rows, source, records_done, inserted_total):
+    """导入一批记录并在同一事务中更新断点，返回 (新增数, 重复数)"""
+    existing = existing_isbn_keys(db, rows)
+    new_rows = []
+    for row in rows:
+        if row[0]:
+            keys = isbn_lookup_keys(row[0])
+            if any(key in existing for key in keys):
+                continue
+            existing.update(keys)  # 同一批内的重复ISBN也只保留第一条
+        new_rows.append(row)
+    
+    db.executemany('''
+        INSERT INTO books (isbn, title, author, category, description, total_copies, available_copies)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', new_rows)
+    db.execute('''
+        INSERT INTO import_checkpoints (source, records_done, inserted, updated_at)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(source) DO UPDATE SET
+            records_done = excluded.records_done,
+            inserted = excluded.inserted,
+            updated_at = excluded.updated_at
+    ''', (source, records_done, inserted_total + len(new_rows)))
+    return len(new_rows), len(rows) - len(new_rows)
+
+def import_books(db, path, fmt, batch_size=5000, restart=False):
+    """流式导入图书文件，返回统计信息"""
+    source = os.path.abspath(path)
+    checkpoint = db.execute('SELECT records_done, inserted FROM import_checkpoints WHERE source = ?',
+                            (source,)).fetchone()
+    if checkpoint and not restart:
+        records_done, inserted_total = checkpoint
+        print(f"⏩ 从断点继续：跳过已处理的 {records_done} 条记录")
+    else:
+        records_done, inserted_total = 0, 0
+    
+    records = itertools.islice(READERS[fmt](path), records_done, None)
+    stats = {'processed': 0, 'inserted': 0, 'duplicates': 0, 'rejected': 0}
+    start = time.perf_counter()
+    
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        
+        rows = []
+        for offset, raw in enumerate(batch, records_done + 1):
+            try:
+                rows.append(normalize_record(raw))
+            except ValueError as e:
+                stats['rejected'] += 1
+                if stats['rejected'] <= 10:
+                    print(f"   ⚠️ 第 {offset} 条记录被跳过：{e}")
+        
+        records_done += len(batch)
+        inserted, duplicates = run_transaction(db, _import_batch, rows, source,
+                                               records_done, inserted_total)
+        inserted_total += inserted
+        stats['processed'] += len(batch)
+        stats['inserted'] += inserted
+        stats['duplicates'] += duplicates
+        
+        elapsed = time.perf_counter() - start
+        print(f"📦 已处理 {records_done} 条 | 新增 {stats['inserted']} | 重复 {stats['duplicates']} "
+              f"| 无效 {stats['rejected']} | {stats['processed'] / elapsed:.0f} 条/秒")
+    
+    stats['elapsed'] = time.perf_counter() - start
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='批量导入图书目录')
+    parser.add_argument('path', help='待导入的文件')
+    parser.add_argument('--format', choices=sorted(READERS), help='文件格式，默认按扩展名判断')
+    parser.add_argument('--batch-size', type=int, default=5000, help='每个事务导入的记录数')
+    parser.add_argument('--restart', action='store_true', help='忽略断点，从头导入')
+    parser.add_argument('--branch', default=MAIN_BRANCH, help='导入到指定分馆，默认总馆')
+    args = parser.parse_args()
+    try:
+        database = branch_database(args.branch)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    fmt = args.format or EXTENSIONS.get(os.path.splitext(args.path)[1].lower())
+    if fmt is None:
+        parser.error('无法根据扩展名判断文件格式，请使用 --format 指定')
+    
+    print(f"📥 开始导入 {args.path}（格式：{fmt}，每批 {args.batch_size} 条）")
+    pool = get_pool(database)
+    db = pool.acquire()
+    try:
+        stats = import_books(db, args.path, fmt, args.batch_size, args.restart)
+        if stats['inserted']:
+            print("🔤 更新搜索建议索引...")
+            refresh_suggestions(db, drain=True)
+    finally:
+        pool.release(db)
+    
+    print(f"\n🎉 导入完成：处理 {stats['processed']} 条，新增 {stats['inserted']} 本，"
+          f"重复 {stats['duplicates']} 条，无效 {stats['rejected']} 条")
+    if stats['elapsed'] > 0 and stats['processed']:
+        print(f"⏱️ 耗时 {stats['elapsed']:.1f} 秒，平均 {stats['processed'] / stats['elapsed']:.0f} 条/秒")
+
+if __name__ == '__main__':
+    main()
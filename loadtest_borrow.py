@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+借还书并发压力测试
+大量读者同时抢借同一本书、同时重复归还，检查库存不超借、不重复归还，并报告吞吐量
+
+用法: python loadtest_borrow.py [并发读者数] [库存数量]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import app_simple
+from app_simple import LoanError, borrow, get_pool, init_db, return_loan
+
+def run_concurrently(func, args_list):
+    """每组参数一个线程，同时起跑，返回 (结果列表, 耗时秒)"""
+    results = [None] * len(args_list)
+    barrier = threading.Barrier(len(args_list))
+    
+    def worker(index, args):
+        barrier.wait()
+        conn = get_pool().acquire()
+        try:
+            results[index] = func(conn, *args)
+        except LoanError as e:
+            results[index] = e.code
+        finally:
+            get_pool().release(conn)
+    
+    threads = [threading.Thread(target=worker, args=(i, args)) for i, args in enumerate(args_list)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+def main():
+    borrowers = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    app_simple.DATABASE = path
+    try:
+        with app_simple.app.app_context():
+            init_db()
+        
+        conn = get_pool().acquire()
+        conn.executemany('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                         [(f'reader{i}', '-') for i in range(borrowers)])
+        conn.execute('UPDATE books SET total_copies = ?, available_copies = ? WHERE id = 1',
+                     (copies, copies))
+        conn.commit()
+        user_ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE username LIKE 'reader%'")]
+        get_pool().release(conn)
+        
+        print("=" * 60)
+        print(f"🏃 {borrowers} 位读者并发借阅同一本书（库存 {copies} 本）")
+        print("=" * 60)
+        
+        results, elapsed = run_concurrently(borrow, [(user_id, 1) for user_id in user_ids])
+        loans = [result for result in results if isinstance(result, dict)]
+        unexpected = [result for result in results if not isinstance(result, dict) and result != 'unavailable']
+        print(f"✅ 借阅成功：{len(loans)}，无库存：{results.count('unavailable')}，其他：{len(unexpected)}")
+        print(f"⏱️ 耗时 {elapsed:.2f} 秒，吞吐量 {len(results) / elapsed:.0f} 次/秒")
+        
+        # 每笔借阅由两个线程同时归还
+        conn = get_pool().acquire()
+        owners = dict(conn.execute('SELECT id, user_id FROM loans').fetchall())
+        get_pool().release(conn)
+        return_args = [(loan['loan_id'], owners[loan['loan_id']]) for loan in loans] * 2
+        
+        print(f"\n🔁 {len(return_args)} 个并发归还请求（每笔借阅重复提交两次）")
+        results, elapsed = run_concurrently(return_loan, return_args)
+        returned = sum(1 for result in results if not isinstance(result, str))
+        print(f"✅ 归还成功：{returned}，重复归还被拒绝：{results.count('returned')}")
+        print(f"⏱️ 耗时 {elapsed:.2f} 秒，吞吐量 {len(results) / elapsed:.0f} 次/秒")
+        
+        # 一致性检查
+        conn = get_pool().acquire()
+        available, total = conn.execute(
+            'SELECT available_copies, total_copies FROM books WHERE id = 1').fetchone()
+        active = conn.execute('SELECT COUNT(*) FROM loans WHERE book_id = 1 AND is_returned = 0').fetchone()[0]
+        get_pool().release(conn)
+        
+        print("\n" + "=" * 60)
+        errors = []
+        if len(loans) != copies:
+            errors.append(f"借出 {len(loans)} 本，应为 {copies} 本")
+        if unexpected:
+            errors.append(f"出现意外结果：{set(unexpected)}")
+        if returned != len(loans):
+            errors.append(f"归还成功 {returned} 次，应为 {len(loans)} 次")
+        if available != total or active != 0:
+            errors.append(f"库存不一致：可借 {available} / 总数 {total}，未还借阅 {active}")
+        
+        for error in errors:
+            print(f"❌ {error}")
+        if not errors:
+            print("🎉 没有超借或重复归还，库存一致")
+        return not errors
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+重建图书全文索引
+用于索引损坏、SQLite升级或批量导入后重新构建books_fts（trigram）和books_fts_short（短词）
+
+用法: python rebuild_search_index.py [--branch 代码]
+"""
+
+import argparse
+import sqlite3
+import time
+
+from app_simple import (MAIN_BRANCH, branch_database, init_search_index, init_short_search_index,
+                        rebuild_search_index, rebuild_short_search_index)
+
+def main():
+    """重建全文索引"""
+    parser = argparse.ArgumentParser(description='重建图书全文索引')
+    parser.add_argument('--branch', default=MAIN_BRANCH, help='重建指定分馆的索引，默认总馆')
+    args = parser.parse_args()
+    try:
+        database = branch_database(args.branch)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    conn = sqlite3.connect(database)
+    
+    print("🔍 开始重建图书全文索引...")
+    start = time.perf_counter()
+    
+    if not init_search_index(conn):
+        print("❌ 当前SQLite不支持FTS5 trigram分词器，无法建立全文索引")
+        conn.close()
+        return
+    
+    rebuild_search_index(conn)
+    if init_short_search_index(conn):
+        rebuild_short_search_index(conn)
+    elapsed = time.perf_counter() - start
+    
+    total_books = conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+    conn.close()
+    
+    print(f"✅ 索引重建完成：{total_books} 本图书，耗时 {elapsed:.2f} 秒")
+
+if __name__ == '__main__':
+    main()
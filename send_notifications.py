@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成并发送到期/逾期/到书提醒（适合由cron定时执行；Web服务进程中由后台线程自动完成）
+先扫描借阅和预约生成提醒，再把发件箱中到期的通知全部发出，最后输出发送指标
+
+用法: python send_notifications.py [--transport file|smtp] [--no-schedule] [--workers 4] [--rate 20] [--branch 代码]
+"""
+
+import argparse
+import sys
+import time
+
+import app_simple
+from app_simple import (NOTIFY_TRANSPORTS, NotificationDispatcher, branch_database, branch_databases, get_pool,
+                        schedule_notifications)
+
+def main():
+    parser = argparse.ArgumentParser(description='生成并发送借阅提醒')
+    parser.add_argument('--transport', choices=sorted(NOTIFY_TRANSPORTS), default=app_simple.NOTIFY_TRANSPORT,
+                        help='发送方式')
+    parser.add_argument('--no-schedule', action='store_true', help='只发送发件箱中已有的通知')
+    parser.add_argument('--workers', type=int, default=app_simple.NOTIFY_WORKERS, help='并发发送线程数')
+    parser.add_argument('--rate', type=float, default=app_simple.NOTIFY_RATE_PER_SECOND, help='每秒最多发送数量')
+    parser.add_argument('--branch', help='只处理指定分馆（默认处理全部分馆）')
+    args = parser.parse_args()
+
+    if args.branch:
+        try:
+            databases = [branch_database(args.branch)]
+        except ValueError as e:
+            print(f"❌ {e}")
+            return 1
+    else:
+        databases = [database for _, database in branch_databases().values()]
+
+    if not args.no_schedule:
+        created = 0
+        for database in databases:
+            conn = get_pool(database).acquire()
+            try:
+                created += schedule_notifications(conn)
+            finally:
+                get_pool(database).release(conn)
+        print(f"📬 新生成提醒 {created} 条")
+
+    dispatcher = NotificationDispatcher(NOTIFY_TRANSPORTS[args.transport](), workers=args.workers, rate=args.rate)
+    start = time.perf_counter()
+    for database in databases:
+        while dispatcher.run_once(database=database):
+            pass
+    dispatcher.stop()
+
+    stats = dispatcher.stats()
+    print(f"✅ 发送完成，耗时 {time.perf_counter() - start:.2f} 秒（{stats['transport']}）")
+    print(f"   已发送: {stats['sent']}，待重试: {stats['retried']}，失败: {stats['failed']}，"
+          f"平均每条 {stats['avg_send_ms']}ms")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -30,24 +30,75 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
     
-    // 搜索功能增强
+    // 搜索建议：输入停顿后向服务器请求前缀匹配结果
     const searchInputs = document.querySelectorAll('input[name="search"]');
     searchInputs.forEach(input => {
+        const suggestionBox = document.createElement('div');
+        suggestionBox.className = 'list-group position-absolute w-100 shadow-sm';
+        suggestionBox.style.zIndex = '1000';
+        suggestionBox.style.display = 'none';
+        input.parentNode.style.position = 'relative';
+        input.parentNode.appendChild(suggestionBox);
+        input.setAttribute('autocomplete', 'off');
+        
+        let debounceTimer = null;
+        let latestRequest = 0;
+        
+        function hideSuggestions() {
+            suggestionBox.style.display = 'none';
+            suggestionBox.innerHTML = '';
+        }
+        
+        function renderSuggestions(items) {
+            suggestionBox.innerHTML = '';
+            items.forEach(item => {
+                const link = document.createElement('a');
+                link.className = 'list-group-item list-group-item-action';
+                link.href = '/book/' + item.id;
+                const title = document.createElement('div');
+                title.textContent = item.title;
+                const author = document.createElement('small');
+                author.className = 'text-muted';
+                author.textContent = item.author;
+                link.appendChild(title);
+                link.appendChild(author);
+                suggestionBox.appendChild(link);
+            });
+            suggestionBox.style.display = items.length ? '' : 'none';
+        }
+        
         input.addEventListener('input', function() {
-            const searchTerm = this.value.toLowerCase();
-            const bookCards = document.querySelectorAll('.book-card');
+            clearTimeout(debounceTimer);
+            const query = this.value.trim();
+            if (!query) {
+                hideSuggestions();
+                return;
+            }
             
-            bookCards.forEach(card => {
-                const title = card.querySelector('.card-title').textContent.toLowerCase();
-                const author = card.querySelector('.card-subtitle').textContent.toLowerCase();
-                const description = card.querySelector('.card-text').textContent.toLowerCase();
-                
-                if (title.includes(searchTerm) || author.includes(searchTerm) || description.includes(searchTerm)) {
-                    card.style.display = '';
-                } else {
-                    card.style.display = 'none';
-                }
-            });
+            debounceTimer = setTimeout(() => {
+                const requestId = ++latestRequest;
+                fetch('/api/v1/suggest?q=' + encodeURIComponent(query))
+                    .then(response => response.ok ? response.json() : {items: []})
+                    .then(data => {
+                        // 只显示最后一次请求的结果，避免乱序返回覆盖
+                        if (requestId === latestRequest) {
+                            renderSuggestions(data.items);
+                        }
+                    })
+                    .catch(() => hideSuggestions());
+            }, 200);
+        });
+        
+        input.addEventListener('keydown', function(e) {
+            if (e.key === 'Escape') {
+                hideSuggestions();
+            }
+        });
+        
+        document.addEventListener('click', function(e) {
+            if (!input.parentNode.contains(e.target)) {
+                hideSuggestions();
+            }
         });
     });
     
@@ -2,15 +2,18 @@
 # -*- coding: utf-8 -*-
 """
 查看当前数据库中的书籍
+
+用法: python view_current_books.py [--branch 代码]
 """
 
+import argparse
 import sqlite3
 
-DATABASE = 'library.db'
+from app_simple import MAIN_BRANCH, branch_database
 
-def view_current_books():
+def view_current_books(database=None):
     """查看当前书籍"""
-    conn = sqlite3.connect(DATABASE)
+    conn = sqlite3.connect(database or branch_database(MAIN_BRANCH))
     cursor = conn.cursor()
     
     books = cursor.execute('SELECT id, title, author, category, total_copies, available_copies FROM books ORDER BY title').fetchall()
@@ -33,4 +36,11 @@ def view_current_books():
     conn.close()
 
 if __name__ == "__main__":
-    view_current_books()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='查看书籍')
+    parser.add_argument('--branch', default=MAIN_BRANCH, help='查看指定分馆的书籍，默认总馆')
+    args = parser.parse_args()
+    try:
+        database = branch_database(args.branch)
+    except ValueError as e:
+        parser.error(str(e))
+    view_current_books(database)
\ No newline at end of file